@@ -6,27 +6,65 @@ from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, query, Q, DocType, Text, Keyword, GeoPoint
 from elasticsearch_dsl.connections import connections
 import elasticsearch
+import elasticsearch.helpers
 import datetime
 import re
 import json
 import asyncio
 import csv
+import gzip
 import time
+import os
+import logging
+import logging.handlers
+import contextlib
+import collections
+import heapq
+import hmac
+import io
+import itertools
+import math
+import sys
+import threading
+import traceback
+import socket
+import uuid
+import weakref
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy import (
     create_engine, Column, Integer,
     String, DateTime, Float, ForeignKey, Boolean, UniqueConstraint)
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import event, func, inspect, or_, select, text
 from asgiref.sync import async_to_sync
+import aiohttp
+from aiohttp import web
 import pytz
 from pytz import timezone
+try:
+    import numpy
+except ImportError:
+    numpy = None # GymCatalog falls back to plain Python
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None # Raid exports fall back to gzipped CSV
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None # Before Python 3.7, see TaskVar
 
 Base = declarative_base()
 
 SETTINGS = [
     "mirror",
     "mirror_nearby",
+    "mirror_webhook",
+    "board",
     "show_subscriptions",
     "delete_on_done",
     "location",
@@ -48,6 +86,7 @@ SETTINGS = [
     "enable_subscriptions",
     "log",
     "timezone",
+    "region",
 ]
 
 RE_DISCORD_MENTION = re.compile("\<@(?:\!|)(\d+)\>")
@@ -56,17 +95,182 @@ RE_MINUTESAFTER = re.compile("^(\d+)@(.+)$")
 
 TIME_STRING = "Invalid time specified, please use HH:MM, HHMM, HH.MM, Xm or \"YYYY-MM-DD HH:MM\""
 
+DATABASE_URL = os.environ.get("GYMS_DATABASE_URL", "sqlite:///gyms.db")
+SEARCH_HOSTS = os.environ.get("GYMS_ELASTICSEARCH", "localhost").split(",")
+SEARCH_TIMEOUT = 5 # Seconds before giving up on connecting to Elasticsearch
+SEARCH_RETRY = 30 # Seconds between attempts while Elasticsearch is down
+OUTBOX_BATCH = 500 # Search outbox entries pushed per bulk request
+OUTBOX_POLL = 5 # Seconds between outbox checks, for changes made by other processes
+OUTBOX_RETRY = 10 # Seconds to wait after a failed push
+OUTBOX_BACKOFF_MAX = 3600 # Longest wait before retrying a document Elasticsearch rejected
+GYM_CHANGE_POLL = 5 # Seconds between checks for gyms changed by other processes
+GYM_CHANGE_KEEP = 24 * 60 * 60 # Seconds gym changes are kept, a process away longer reloads on start
+
+# Used when the bot itself isn't started with shard_id/shard_count.
+SHARD_ID = int(os.environ.get("GYMS_SHARD_ID", "0"))
+SHARD_COUNT = int(os.environ.get("GYMS_SHARD_COUNT", "1"))
+
 HATCH_TIME = datetime.timedelta(minutes=60)
 DESPAWN_TIME = datetime.timedelta(minutes=45)
 
+LEASE_TTL = 10 # Seconds a lease is held without being renewed
+LEASE_RENEW = 3 # Seconds between lease renewals
+EXPIRY_POLL = 30 # Seconds between checks for raids changed by other instances
+CLEAN_UP_RETRY_FOR = 86400 # Seconds after its end a done raid's clean up is retried
+
+WRITE_BEHIND_INTERVAL = 0.5 # Seconds between writes of queued raid changes
+STORE_EVICT_AFTER = 600 # Seconds a done raid stays in memory after it was last used
+SNAPSHOT_PATH = os.environ.get("GYMS_SNAPSHOT", "gyms-snapshot-{shard}.json.gz") # Active raids, written on unload
+RECORD_PATH = os.environ.get("GYMS_RECORD") # NDJSON recording of events and commands, for tools/replay.py
+RECORD_VERSION = 1
+RECORD_EVENTS = ("MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE", "MESSAGE_DELETE")
+SNAPSHOT_MAX_AGE = 900 # Seconds after which a snapshot is ignored
+SNAPSHOT_VERSION = 1
+PREWARM_CONCURRENCY = 4 # Embed messages fetched in parallel after startup
+EPOCH = datetime.datetime(1970, 1, 1)
+
+GRID_CELL_DEGREES = 0.05 # Size of a cell in the active raid location index
+KM_PER_DEGREE = 111.32 # Along a meridian
+EARTH_RADIUS_KM = 6371.0
+RAIDS_NEAR_LIMIT = 15 # Raids listed by !raidsnear
+
+DISCORD_EPOCH_MS = 1420070400000
+BULK_DELETE_MAX_AGE = 13 * 24 * 3600 # Seconds, Discord only bulk deletes messages under 14 days old
+BULK_DELETE_MAX = 100 # Messages per bulk delete request
+
+GYMS_NEAR_DEFAULT = 5 # Gyms listed by !gymsnear
+GYMS_NEAR_MAX = 25
+REGION_PRECISION = 4 # Geohash characters in a gym's region, cells of about 39 x 20 km
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+FIND_GYM_CANDIDATES = 50 # Text matches re-ranked by distance in find_gym
+
+GYM_CACHE_SIZE = 2048 # find_gym results and gym embeds kept
+GYM_CACHE_TTL = 3600 # Seconds before a cached result is looked up again
+
+BOARD_INTERVAL = 10 # Seconds between raid board updates
+BOARD_PAGE_SIZE = 10 # Raids per raid board page
+BOARD_PREVIOUS = u"\U000025C0"
+BOARD_NEXT = u"\U000025B6"
+RE_COORDINATES = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+
+EXPORT_CHUNK = 5000 # Rows fetched and written at a time by raid exports
+EXPORT_DIR = os.environ.get("GYMS_EXPORT_DIR", ".") # Where exports too big to attach are written
+EXPORT_ATTACH_MAX = 8 * 1024 * 1024 # Discord's upload limit
+EXPORT_COLUMNS = (
+    ("raid_id", "int64"), ("server_id", "int64"), ("gym_id", "int64"), ("gym_title", "string"),
+    ("latitude", "float64"), ("longitude", "float64"), ("pokemon_id", "int64"), ("pokemon", "string"),
+    ("level", "int64"), ("start_time", "timestamp"), ("end_time", "timestamp"), ("done", "bool"),
+    ("user_id", "int64"), ("extra", "int64"),
+)
+
+JOB_CONCURRENCY = 4 # Channels processed in parallel by a background job
+JOB_BATCH_SIZE = 25 # Raids processed between checkpoints
+JOB_PROGRESS_INTERVAL = 10 # Seconds between progress message edits
+
+LOG_FLUSH_INTERVAL = 5 # Seconds between log channel flushes
+MESSAGE_LIMIT = 2000 # Discord message length limit
+LOG_FILE = os.environ.get("GYMS_LOG_FILE") # Optional local copy of the raid log
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+DISCORD_API = os.environ.get("GYMS_DISCORD_API", "https://discordapp.com/api/v6") # Base URL for webhook requests
+WEBHOOK_NAME = "Raids"
+DISCORD_UNKNOWN_WEBHOOK = 10015 # JSON error code, as opposed to an unknown message
+WEBHOOK_TIMEOUT = 10 # Seconds before a webhook request is given up on
+WEBHOOK_RETRIES = 3 # Attempts at a webhook request that was rate limited
+WEBHOOK_CREATE_RETRY = 600 # Seconds before trying again to create a webhook we weren't allowed to
+
+HTTP_HOST = os.environ.get("GYMS_HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(os.environ.get("GYMS_HTTP_PORT", "0")) # 0 disables the HTTP endpoint
+API_CACHE_SIZE = 256 # Rendered /api responses kept, by route, filters and version
+INGEST_TOKEN = os.environ.get("GYMS_INGEST_TOKEN") # Bearer token for POST /api/ingest, unset disables it
+INGEST_MAX_RECORDS = 5000 # Raids read from one ingest
+INGEST_MATCH_KM = 0.05 # How close coordinates have to be to a gym
+INGEST_CONCURRENCY = 8 # Mirror posts in flight at once while fanning out a batch
+EVENT_HISTORY = 1000 # Raid events kept for streams resuming from Last-Event-ID
+EVENT_BUFFER = 200 # Events queued per stream subscriber before the oldest are dropped
+EVENT_KEEPALIVE = 15 # Seconds between comments on an idle stream
+
+# Load shedding: pressure is the largest of these ratios, at 1 the bot is
+# busy and at 2 overloaded.
+SHED_EVENTS = 25 # Inbound events being handled at once
+SHED_REQUESTS = 50 # Outbound Discord requests in flight or waiting on rate limits
+SHED_LOG_LINES = 500 # Log lines waiting to be sent
+SHED_LOG_FACTOR = 4 # Log flush interval multiplier while busy
+SHED_EDIT_DELAY = 5 # Seconds per level that mirror edits are deferred and coalesced
+MIRROR_FLAG_KEYS = ("mirror", "mirror_nearby", "mirror_webhook") # Channel config cached by mirror_flags
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+COMMAND_RECEIVED_MAX = 1000 # Arrival times of messages kept for timing the commands they invoke
+
+
+class TaskVar:
+    """
+        Stand-in for contextvars.ContextVar before Python 3.7: a value per
+        asyncio task. Tasks don't inherit it from the task that started
+        them, so per-event query counts and traces miss work done in
+        other tasks, and reactions handled there aren't treated as the
+        reacted embed by load shedding.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self.values = weakref.WeakKeyDictionary()
+
+    def task(self):
+        try:
+            return asyncio.Task.current_task()
+        except RuntimeError: # A worker thread without an event loop
+            return None
+
+    def get(self):
+        task = self.task()
+        return self.values.get(task, self.default) if task is not None else self.default
+
+    def set(self, value):
+        task = self.task()
+        token = self.get()
+        if task is not None:
+            self.values[task] = value
+        return token
+
+    def reset(self, token):
+        self.set(token)
+
+
+ContextVar = contextvars.ContextVar if contextvars is not None else TaskVar
+
+# Per-event accounting, set by the event/command that is being handled.
+EVENT_QUERIES = ContextVar("gyms_event_queries", default=None)
+EVENT_STARTED = ContextVar("gyms_event_started", default=None)
+REACTED_EMBED = ContextVar("gyms_reacted_embed", default=None) # (channel_id, message_id)
+CURRENT_TRACE = ContextVar("gyms_trace", default=None)
+
+TRACE_KEEP = 50 # Slowest traces kept for !raidtrace
+TRACE_MAX_SPANS = 500
+PROFILE_INTERVAL = 0.005 # Seconds between profiler samples
+PROFILE_MAX_SECONDS = 300
+
 class Gym(Base):
     __tablename__ = 'gym'
     id = Column(Integer, primary_key=True)
     title = Column(String)
     latitude = Column(Float)
     longitude = Column(Float)
+    raid_seq = Column(Integer, nullable=True) # Bumped by every raid created here, see claim_gym
     
 
+class GymAlias(Base):
+    __tablename__ = 'gymalias'
+    id = Column(Integer, primary_key=True)
+    gym_id = Column(Integer, ForeignKey("gym.id"))
+    alias = Column(String)
+    __table_args__ = (UniqueConstraint('gym_id', 'alias', name='_gym_id_alias_uc'),)
+
+
 class Pokemon(Base):
     __tablename__ = 'pokemon'
     id = Column(Integer, primary_key=True)
@@ -85,6 +289,8 @@ class Raid(Base):
     start_time = Column(DateTime)
     level = Column(Integer, nullable=True)
     done = Column(Boolean, default=False)
+    cleaned = Column(Boolean, nullable=True)
+    server_id = Column(Integer, nullable=True)
 
 class Embed(Base):
     __tablename__ = 'embed'
@@ -93,6 +299,16 @@ class Embed(Base):
     message_id = Column(Integer)
     raid_id = Column(Integer, ForeignKey("raid.id"))
     raid = relationship(Raid, foreign_keys=[raid_id])
+    webhook_id = Column(Integer, nullable=True) # Posted through this webhook, which has to edit it
+
+
+class Webhook(Base):
+    # The webhook each mirror_webhook channel posts through.
+    __tablename__ = 'webhook'
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, unique=True)
+    webhook_id = Column(Integer)
+    token = Column(String)
 
 
 class Going(Base):
@@ -120,25 +336,135 @@ class ChannelConfig(Base):
     value = Column(String)
     __table_args__ = (UniqueConstraint('server_id', 'channel_id', 'key', name='_server_id_key_uc'),)
 
-connections.create_connection(hosts=['localhost'])
+class Job(Base):
+    __tablename__ = 'job'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    state = Column(String, default="running")
+    server_id = Column(Integer)
+    channel_id = Column(Integer, nullable=True) # Where progress is reported
+    message_id = Column(Integer, nullable=True)
+    since = Column(DateTime)
+    cursor = Column(Integer, default=0) # Last raid id fully processed
+    processed = Column(Integer, default=0)
+    total = Column(Integer, default=0)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+
+class GymChange(Base):
+    # Gyms added, changed or removed, so every process can update its
+    # catalog and search caches. Written with the change and again once
+    # the search index has it. Ids are never reused.
+    __tablename__ = 'gymchange'
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key=True)
+    gym_id = Column(Integer)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class SearchOutbox(Base):
+    # Gyms and pokemon changed in SQL whose search documents are out of
+    # date, written in the same transaction as the change.
+    __tablename__ = 'searchoutbox'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String) # "gym" or "pokemon"
+    ref_id = Column(Integer)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    attempts = Column(Integer, nullable=True) # Failed pushes so far
+    retry_after = Column(DateTime, nullable=True) # Not pushed again before this
+
+class Lease(Base):
+    __tablename__ = 'lease'
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires = Column(DateTime)
+
+def add_missing_columns(engine):
+    # create_all only creates missing tables, add columns that were
+    # introduced after a table was first created.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(engine.dialect))))
+
+def create_db_engine(database_url):
+    if database_url.startswith("sqlite"):
+        # Several shards may share one SQLite file.
+        engine = create_engine(database_url, connect_args={"timeout": 30})
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.close()
+        return engine
+    return create_engine(database_url)
 
 class GymDoc(DocType):
     title = Text(analyzer='snowball', fields={'raw': Keyword()})
     location = GeoPoint()
+    region = Keyword() # geohash(location)
 
     class Meta:
         index = 'marker'
 
-GymDoc.init()
-
 class PokemonDoc(DocType):
     name = Text(analyzer='snowball', fields={'raw': Keyword()})
 
     class Meta:
         index = 'pokemon'
-
-PokemonDoc.init()
                 
+class SearchUnavailable(Exception):
+    pass
+
+
+class StartingUp(commands.CheckFailure):
+    pass
+
+
+# A raid embed posted through a webhook, all start_raid and _raidmirror need.
+WebhookMessage = collections.namedtuple("WebhookMessage", "id channel webhook_id")
+
+
+class LRUCache:
+    """Least recently used cache whose entries also expire after ttl seconds."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return self.MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
 def format_list(items):
     if len(items) > 1:
         message = ", ".join([item for item in items[:-1]])+" and {0}".format(items[-1])
@@ -146,19 +472,1265 @@ def format_list(items):
         message = "{0}".format(items[0])
     return message
 
+class EventSubscription:
+    """
+        One stream's queue of (seq, kind, server_id, region, data) events,
+        bounded: when it's full the oldest event is dropped.
+    """
+
+    def __init__(self, size, server_id=None, regions=()):
+        self.events = collections.deque(maxlen=size)
+        self.ready = asyncio.Event()
+        self.server_id = server_id
+        self.regions = tuple(regions)
+        self.dropped = 0
+
+    def wants(self, event):
+        seq, kind, server_id, region, data = event
+        if self.server_id and server_id != self.server_id:
+            return False
+        return not self.regions or region.startswith(self.regions)
+
+    def push(self, event):
+        if not self.wants(event):
+            return
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
+
+    async def next(self, timeout):
+        # The next event, or None after timeout seconds without one.
+        if not self.events:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.events.popleft()
+
+
+class RaidEventBus:
+    """
+        Numbered raid changes, fanned out to subscriptions without waiting
+        on any of them. The last EVENT_HISTORY are kept so a reconnecting
+        stream can pick up after the last id it saw.
+    """
+
+    def __init__(self, history=EVENT_HISTORY, buffer=EVENT_BUFFER):
+        self.seq = 0
+        self.history = collections.deque(maxlen=history)
+        self.buffer = buffer
+        self.subscriptions = set()
+
+    def publish(self, kind, server_id, region, data):
+        self.seq += 1
+        event = (self.seq, kind, server_id, region, json.dumps(data))
+        self.history.append(event)
+        for subscription in self.subscriptions:
+            subscription.push(event)
+
+    def subscribe(self, after=None, server_id=None, regions=()):
+        # Returns (subscription, complete), complete is False when events
+        # after `after` have already fallen out of the history.
+        subscription = EventSubscription(self.buffer, server_id, regions)
+        complete = True
+        if after is not None and after < self.seq:
+            complete = bool(self.history) and self.history[0][0] <= after + 1
+            for event in self.history:
+                if event[0] > after:
+                    subscription.push(event)
+        self.subscriptions.add(subscription)
+        return subscription, complete
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+
+class EventRecorder:
+    """
+        Writes the gateway events and commands the cog handles to an NDJSON
+        file, one object per line with `t` seconds since recording started.
+    """
+
+    def __init__(self, path, bot_id):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.started = time.monotonic()
+        self.write("header", version=RECORD_VERSION, bot_id=bot_id,
+                   started=datetime.datetime.utcnow().isoformat())
+
+    def write(self, kind, **fields):
+        fields["kind"] = kind
+        fields["t"] = round(time.monotonic() - self.started, 4)
+        self.file.write(json.dumps(fields) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class LogWriter:
+    """Queues log lines per channel and sends them as batched messages."""
+
+    def __init__(self, bot, interval=LOG_FLUSH_INTERVAL):
+        self.bot = bot
+        self.interval = interval
+        self.backoff = lambda: 1 # Multiplies the interval, raised under load
+        self.pending = {}
+        self.sizes = {}
+        self.flushing = set()
+        self.task = None
+        self.file_logger = None
+        if LOG_FILE:
+            self.file_logger = logging.getLogger("gyms.raidlog")
+            self.file_logger.setLevel(logging.INFO)
+            self.file_logger.propagate = False
+            if not self.file_logger.handlers:
+                handler = logging.handlers.RotatingFileHandler(
+                    LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS)
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                self.file_logger.addHandler(handler)
+
+    def start(self):
+        if self.task is None:
+            self.task = self.bot.loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.pending:
+            self.bot.loop.create_task(self.flush())
+
+    def write(self, server_id, channel_ids, line):
+        line = line[:MESSAGE_LIMIT]
+        if self.file_logger is not None:
+            self.file_logger.info("%s %s", server_id, line)
+        for channel_id in channel_ids:
+            self.pending.setdefault(channel_id, []).append(line)
+            self.sizes[channel_id] = self.sizes.get(channel_id, 0) + len(line) + 1
+            if self.sizes[channel_id] >= MESSAGE_LIMIT:
+                self.bot.loop.create_task(self.flush_channel(channel_id))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval * self.backoff())
+            await self.flush()
+
+    def backlog(self):
+        return sum(len(lines) for lines in self.pending.values())
+
+    async def flush(self):
+        tasks = [self.flush_channel(channel_id) for channel_id in list(self.pending)]
+        if tasks:
+            await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+
+    async def flush_channel(self, channel_id):
+        if channel_id in self.flushing:
+            return
+        self.flushing.add(channel_id)
+        try:
+            while self.pending.get(channel_id):
+                lines = self.pending.pop(channel_id)
+                self.sizes.pop(channel_id, None)
+                channel = self.bot.get_channel(str(channel_id))
+                if channel is None:
+                    continue
+                for chunk in self.chunk(lines):
+                    try:
+                        await self.bot.send_message(channel, content=chunk)
+                    except discord.errors.HTTPException as e:
+                        print("Failed to write log to", channel_id, e)
+        finally:
+            self.flushing.discard(channel_id)
+
+    def chunk(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) + 1 > MESSAGE_LIMIT:
+                yield "\n".join(chunk)
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line) + 1
+        if chunk:
+            yield "\n".join(chunk)
+
+
+class Metric:
+    """A Prometheus counter, gauge or histogram, with labels."""
+
+    def __init__(self, name, help, kind, buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.buckets = buckets
+        self.samples = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def set(self, value, **labels):
+        self.samples[self.key(labels)] = value
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        sample = self.samples.get(key)
+        if sample is None:
+            sample = self.samples[key] = [[0] * len(self.buckets), 0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[0][i] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def format_labels(self, key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for key, sample in sorted(self.samples.items()):
+            if self.kind != "histogram":
+                lines.append("{}{} {}".format(self.name, self.format_labels(key), sample))
+                continue
+            counts, total, count = sample
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append("{}_bucket{} {}".format(self.name, self.format_labels(key, [("le", bound)]), bucket))
+            lines.append("{}_bucket{} {}".format(self.name, self.format_labels(key, [("le", "+Inf")]), count))
+            lines.append("{}_sum{} {}".format(self.name, self.format_labels(key), total))
+            lines.append("{}_count{} {}".format(self.name, self.format_labels(key), count))
+        return lines
+
+
+class Metrics:
+    """Registry of metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.collectors = []
+
+    def add(self, name, help, kind, buckets=None):
+        if name not in self.metrics:
+            self.metrics[name] = Metric(name, help, kind, buckets)
+        return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.add(name, help, "counter")
+
+    def gauge(self, name, help):
+        return self.add(name, help, "gauge")
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(name, help, "histogram", buckets)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Timings of the steps taken while handling one event or command."""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.wall = datetime.datetime.utcnow()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, start, duration):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((start - self.start, duration, name))
+
+    def format(self):
+        attrs = " ".join("{}={}".format(k, v) for k, v in sorted(self.attrs.items()))
+        lines = ["{} {:.1f}ms at {:%Y-%m-%d %H:%M:%S} {}".format(self.name, self.duration * 1000, self.wall, attrs)]
+        for offset, duration, name in sorted(self.spans):
+            lines.append("  {:8.1f}ms +{:8.1f}ms {}".format(offset * 1000, duration * 1000, name))
+        if self.dropped:
+            lines.append("  ... {} more spans".format(self.dropped))
+        return "\n".join(lines)
+
+
+class Tracer:
+    """Records a trace per event and keeps the slowest ones."""
+
+    def __init__(self, keep=TRACE_KEEP):
+        self.keep = keep
+        self.slowest = []
+        self.counter = itertools.count()
+
+    @contextlib.contextmanager
+    def trace(self, name, **attrs):
+        if CURRENT_TRACE.get() is not None:
+            with self.span(name):
+                yield
+            return
+        trace = Trace(name, attrs)
+        token = CURRENT_TRACE.set(trace)
+        try:
+            yield trace
+        finally:
+            CURRENT_TRACE.reset(token)
+            trace.duration = time.perf_counter() - trace.start
+            self.record(trace)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        trace = CURRENT_TRACE.get()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                trace.add(name, start, time.perf_counter() - start)
+
+    def record(self, trace):
+        item = (trace.duration, next(self.counter), trace)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif item[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def top(self, n):
+        return [trace for duration, i, trace in heapq.nlargest(n, self.slowest)]
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stack of one thread, output is in collapsed stack format."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            self.stacks[";".join("{}:{}".format(os.path.basename(f.filename), f.name) for f in stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return "\n".join("{} {}".format(stack, count) for stack, count in self.stacks.most_common())
+
+
+def naive_utc(dt):
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return dt
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def geohash(latitude, longitude, precision=REGION_PRECISION):
+    ranges = ([-180.0, 180.0], [-90.0, 90.0])
+    values = (longitude, latitude)
+    chars = []
+    value = 0
+    for bit in range(precision * 5):
+        # Bits alternate between longitude and latitude, longitude first.
+        bounds = ranges[bit % 2]
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if values[bit % 2] >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        if bit % 5 == 4:
+            chars.append(GEOHASH_ALPHABET[value])
+            value = 0
+    return "".join(chars)
+
+
+def geohash_neighbours(latitude, longitude, precision=REGION_PRECISION):
+    # Stepping a whole cell from any point in a cell lands in the next one.
+    width = 360.0 / 2 ** ((precision * 5 + 1) // 2)
+    height = 180.0 / 2 ** (precision * 5 // 2)
+    cells = []
+    for lat_step in (-1, 0, 1):
+        for lon_step in (-1, 0, 1):
+            lat = latitude + lat_step * height
+            if (lat_step, lon_step) == (0, 0) or not -90 <= lat <= 90:
+                continue
+            cell = geohash(lat, (longitude + lon_step * width + 180) % 360 - 180, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+def geohash_bounds(prefix):
+    # (min lat, max lat, min lon, max lon) of the cell a geohash names.
+    lat, lon = [-90.0, 90.0], [-180.0, 180.0]
+    bit = 0
+    for char in prefix:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            bounds = lon if bit % 2 == 0 else lat
+            middle = (bounds[0] + bounds[1]) / 2
+            if value >> shift & 1:
+                bounds[0] = middle
+            else:
+                bounds[1] = middle
+            bit += 1
+    return lat[0], lat[1], lon[0], lon[1]
+
+
+def parse_ingest_records(text):
+    # NDJSON, one raid object per line, or CSV with a header row. Lines
+    # that aren't valid JSON come back as None.
+    if text.lstrip().startswith("{"):
+        records = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(None)
+        return records
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def parse_ingest_time(value):
+    # Unix seconds or ISO 8601 in UTC, as an aware UTC datetime.
+    if value is None or value == "":
+        return None
+    try:
+        return pytz.utc.localize(datetime.datetime.utcfromtimestamp(float(value)))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    value = str(value).strip().replace("T", " ")[:19]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return pytz.utc.localize(datetime.datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
+
+
+def export_format():
+    return "parquet" if pyarrow is not None else "csv.gz"
+
+
+def export_raid_history(engine, path, since=None, until=None, near=None, km=None, server_id=None, regions=None):
+    """
+        Writes one row per raid and person going (or a single row with no
+        user for raids nobody joined) to `path`, as Parquet when pyarrow
+        is installed and gzipped CSV otherwise, see export_format().
+        server_id limits it to one server's raids, regions to gyms in any
+        of a list of geohash prefixes.
+
+        Rows are streamed from the database on their own connection and
+        written EXPORT_CHUNK at a time, so this runs in constant memory.
+        It blocks, call it from a worker thread. Returns the rows written.
+    """
+    raid, gym, pokemon, going = Raid.__table__, Gym.__table__, Pokemon.__table__, Going.__table__
+    columns = [
+        raid.c.id.label("raid_id"), raid.c.server_id, raid.c.gym_id, gym.c.title.label("gym_title"),
+        gym.c.latitude, gym.c.longitude, raid.c.pokemon_id, pokemon.c.name.label("pokemon"),
+        raid.c.level, raid.c.start_time, raid.c.end_time, raid.c.done, going.c.user_id, going.c.extra,
+    ]
+    statement = select(columns).select_from(
+        raid.join(gym, raid.c.gym_id == gym.c.id)
+        .outerjoin(pokemon, raid.c.pokemon_id == pokemon.c.id)
+        .outerjoin(going, going.c.raid_id == raid.c.id)
+    ).order_by(raid.c.id, going.c.id)
+    if since is not None:
+        statement = statement.where(raid.c.start_time >= since)
+    if until is not None:
+        statement = statement.where(raid.c.start_time < until)
+    if near is not None:
+        # A bounding box in SQL, then the exact distance per row.
+        lat_delta = km / KM_PER_DEGREE
+        lon_delta = lat_delta / max(math.cos(math.radians(near[0])), 0.01)
+        statement = statement.where(gym.c.latitude.between(near[0] - lat_delta, near[0] + lat_delta))
+        statement = statement.where(gym.c.longitude.between(near[1] - lon_delta, near[1] + lon_delta))
+    if server_id is not None:
+        statement = statement.where(raid.c.server_id == int(server_id))
+    if regions:
+        # The cells' boxes in SQL, then the geohash per gym, boxes share edges.
+        boxes = []
+        for region in regions:
+            min_lat, max_lat, min_lon, max_lon = geohash_bounds(region)
+            boxes.append(gym.c.latitude.between(min_lat, max_lat) & gym.c.longitude.between(min_lon, max_lon))
+        statement = statement.where(or_(*boxes))
+        precision = max(len(region) for region in regions)
+        in_regions = {}
+
+        def in_region(row):
+            if row[2] not in in_regions:
+                cell = geohash(row[4], row[5], precision)
+                in_regions[row[2]] = any(cell.startswith(region) for region in regions)
+            return in_regions[row[2]]
+
+    names = [name for name, kind in EXPORT_COLUMNS]
+    if pyarrow is not None:
+        types = {
+            "int64": pyarrow.int64(), "float64": pyarrow.float64(), "string": pyarrow.string(),
+            "timestamp": pyarrow.timestamp("us"), "bool": pyarrow.bool_(),
+        }
+        schema = pyarrow.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS])
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+
+        def write(rows):
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+                schema=schema))
+    else:
+        writer = gzip.open(path, "wt", newline="", encoding="utf-8")
+        out = csv.writer(writer)
+        out.writerow(names)
+
+        def write(rows):
+            out.writerows(rows)
+
+    written = 0
+    try:
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(statement)
+            while True:
+                rows = result.fetchmany(EXPORT_CHUNK)
+                if not rows:
+                    break
+                rows = [tuple(row[name] for name in names) for row in rows]
+                if near is not None:
+                    rows = [row for row in rows if haversine_km(near[0], near[1], row[4], row[5]) <= km]
+                if regions:
+                    rows = [row for row in rows if in_region(row)]
+                if rows:
+                    write(rows)
+                    written += len(rows)
+    finally:
+        writer.close()
+    return written
+
+
+class GymInfo:
+    __slots__ = ("id", "title", "latitude", "longitude")
+
+    def __init__(self, id, title, latitude, longitude):
+        self.id = id
+        self.title = title
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class PokemonInfo:
+    __slots__ = ("id", "name", "raid_level")
+
+    def __init__(self, id, name, raid_level):
+        self.id = id
+        self.name = name
+        self.raid_level = raid_level
+
+
+class ActiveRaid:
+    """
+        In-memory copy of a raid, who is going (user id -> extra) and
+        where its embeds are, as (channel_id, message_id) in the order they
+        were posted. webhooks maps the embeds posted through a webhook to
+        its id.
+    """
+    __slots__ = ("id", "server_id", "gym", "pokemon", "level", "start_time", "end_time",
+                 "done", "going", "embeds", "webhooks", "touched")
+
+    def __init__(self, raid, going=(), embeds=(), webhooks=()):
+        self.id = raid.id
+        self.server_id = raid.server_id
+        self.set_gym(raid.gym)
+        self.set_pokemon(raid.pokemon)
+        self.level = raid.level
+        self.start_time = naive_utc(raid.start_time)
+        self.end_time = naive_utc(raid.end_time)
+        self.done = bool(raid.done)
+        self.going = dict(going)
+        self.embeds = list(embeds)
+        self.webhooks = dict(webhooks)
+        self.touched = time.monotonic()
+
+    def set_gym(self, gym):
+        self.gym = GymInfo(gym.id, gym.title, gym.latitude, gym.longitude)
+
+    def set_pokemon(self, pokemon):
+        self.pokemon = None if pokemon is None else PokemonInfo(pokemon.id, pokemon.name, pokemon.raid_level)
+
+    def to_snapshot(self):
+        return {
+            "id": self.id,
+            "server_id": self.server_id,
+            "gym": [self.gym.id, self.gym.title, self.gym.latitude, self.gym.longitude],
+            "pokemon": None if self.pokemon is None else [self.pokemon.id, self.pokemon.name, self.pokemon.raid_level],
+            "level": self.level,
+            "start_time": (self.start_time - EPOCH).total_seconds(),
+            "end_time": (self.end_time - EPOCH).total_seconds(),
+            "going": list(self.going.items()),
+            "embeds": self.embeds,
+            "webhooks": [list(key) + [webhook_id] for key, webhook_id in self.webhooks.items()],
+        }
+
+    @classmethod
+    def from_snapshot(cls, data):
+        raid = cls.__new__(cls)
+        raid.id = data["id"]
+        raid.server_id = data["server_id"]
+        raid.gym = GymInfo(*data["gym"])
+        raid.pokemon = None if data["pokemon"] is None else PokemonInfo(*data["pokemon"])
+        raid.level = data["level"]
+        raid.start_time = EPOCH + datetime.timedelta(seconds=data["start_time"])
+        raid.end_time = EPOCH + datetime.timedelta(seconds=data["end_time"])
+        raid.done = False
+        raid.going = {user_id: extra for user_id, extra in data["going"]}
+        raid.embeds = [tuple(key) for key in data["embeds"]]
+        raid.webhooks = {(channel_id, message_id): webhook_id for channel_id, message_id, webhook_id in data.get("webhooks", [])}
+        raid.touched = time.monotonic()
+        return raid
+
+
+class RaidGrid:
+    """
+        Active raids bucketed by gym location into cells of
+        GRID_CELL_DEGREES, so a radius query only looks at the raids in
+        cells overlapping the circle.
+    """
+
+    def __init__(self, cell=GRID_CELL_DEGREES):
+        self.cell = cell
+        self.cells = {}
+        self.where = {}
+
+    def key(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell)), int(math.floor(longitude / self.cell)))
+
+    def add(self, raid):
+        self.remove(raid)
+        if raid.gym.latitude is None or raid.gym.longitude is None:
+            return
+        key = self.key(raid.gym.latitude, raid.gym.longitude)
+        self.cells.setdefault(key, {})[raid.id] = raid
+        self.where[raid.id] = key
+
+    def remove(self, raid):
+        key = self.where.pop(raid.id, None)
+        if key is None:
+            return
+        cell = self.cells[key]
+        cell.pop(raid.id, None)
+        if not cell:
+            del self.cells[key]
+
+    def near(self, latitude, longitude, km):
+        # Returns (distance_km, raid) for every raid within km, unsorted.
+        dlat = km / KM_PER_DEGREE
+        dlon = km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        lat0, lon0 = self.key(latitude - dlat, longitude - dlon)
+        lat1, lon1 = self.key(latitude + dlat, longitude + dlon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(self.cells):
+            keys = [key for key in self.cells if lat0 <= key[0] <= lat1 and lon0 <= key[1] <= lon1]
+        else:
+            keys = [(x, y) for x in range(lat0, lat1 + 1) for y in range(lon0, lon1 + 1)]
+        results = []
+        for key in keys:
+            for raid in self.cells.get(key, {}).values():
+                distance = haversine_km(latitude, longitude, raid.gym.latitude, raid.gym.longitude)
+                if distance <= km:
+                    results.append((distance, raid))
+        return results
+
+
+class GymCatalog:
+    """
+        Every gym's id and location in contiguous arrays, for k-nearest and
+        radius queries with a vectorised haversine. Changes are queued by
+        add() and remove() and folded into the arrays by the next query.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.version = getattr(self, "version", 0) + 1
+        self.titles = {}
+        self.regions = {}
+        self.added = {}
+        self.removed = set()
+        self.ids = self.array([], "int64")
+        self.lat = self.array([], "float64") # radians
+        self.lon = self.array([], "float64")
+        self.cos_lat = self.array([], "float64")
+        self.positions = {}
+
+    @staticmethod
+    def array(values, dtype):
+        return numpy.array(values, dtype=dtype) if numpy is not None else list(values)
+
+    def load(self, rows):
+        # rows are (id, title, latitude, longitude)
+        self.clear()
+        for row in rows:
+            self.add(*row)
+        self.build()
+
+    def add(self, gym_id, title, latitude, longitude):
+        if latitude is None or longitude is None:
+            return
+        self.version += 1
+        self.titles[gym_id] = title
+        self.regions.pop(gym_id, None)
+        self.removed.discard(gym_id)
+        self.added[gym_id] = (latitude, longitude)
+
+    def remove(self, gym_id):
+        self.version += 1
+        self.titles.pop(gym_id, None)
+        self.regions.pop(gym_id, None)
+        self.added.pop(gym_id, None)
+        self.removed.add(gym_id)
+
+    def items(self):
+        # Yields (gym_id, title, latitude, longitude, region) in degrees,
+        # the regions are worked out on first use.
+        self.build()
+        for i, gym_id in enumerate(self.ids):
+            gym_id = int(gym_id)
+            latitude, longitude = math.degrees(self.lat[i]), math.degrees(self.lon[i])
+            region = self.regions.get(gym_id)
+            if region is None:
+                region = self.regions[gym_id] = geohash(latitude, longitude)
+            yield gym_id, self.titles[gym_id], latitude, longitude, region
+
+    def __len__(self):
+        return len(self.titles)
+
+    def build(self):
+        if not self.added and not self.removed:
+            return
+        # Gyms that moved are dropped and added again at the end.
+        dropped = [gym_id for gym_id in self.removed | set(self.added) if gym_id in self.positions]
+        added = list(self.added.items())
+        new_ids = [gym_id for gym_id, location in added]
+        new_lat = [math.radians(location[0]) for gym_id, location in added]
+        new_lon = [math.radians(location[1]) for gym_id, location in added]
+        if numpy is not None:
+            if dropped:
+                keep = ~numpy.isin(self.ids, dropped)
+                self.ids, self.lat, self.lon = self.ids[keep], self.lat[keep], self.lon[keep]
+            self.ids = numpy.concatenate([self.ids, numpy.array(new_ids, dtype="int64")])
+            self.lat = numpy.concatenate([self.lat, numpy.array(new_lat, dtype="float64")])
+            self.lon = numpy.concatenate([self.lon, numpy.array(new_lon, dtype="float64")])
+            self.cos_lat = numpy.cos(self.lat)
+        else:
+            if dropped:
+                dropped = set(dropped)
+                keep = [i for i, gym_id in enumerate(self.ids) if gym_id not in dropped]
+                self.ids = [self.ids[i] for i in keep]
+                self.lat = [self.lat[i] for i in keep]
+                self.lon = [self.lon[i] for i in keep]
+            self.ids += new_ids
+            self.lat += new_lat
+            self.lon += new_lon
+            self.cos_lat = [math.cos(lat) for lat in self.lat]
+        self.positions = {int(gym_id): i for i, gym_id in enumerate(self.ids)}
+        self.added = {}
+        self.removed = set()
+
+    def distances(self, latitude, longitude, positions=None):
+        # Great circle distance in km from a point to every gym, or to the
+        # gyms at the given array positions.
+        self.build()
+        lat1, lon1 = math.radians(latitude), math.radians(longitude)
+        if numpy is not None:
+            lat, lon, cos_lat = self.lat, self.lon, self.cos_lat
+            if positions is not None:
+                positions = numpy.array(positions, dtype="int64")
+                lat, lon, cos_lat = lat[positions], lon[positions], cos_lat[positions]
+            a = numpy.sin((lat - lat1) / 2) ** 2 + math.cos(lat1) * cos_lat * numpy.sin((lon - lon1) / 2) ** 2
+            return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+        if positions is None:
+            positions = range(len(self.ids))
+        return [
+            2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1, math.sin((self.lat[i] - lat1) / 2) ** 2
+                + math.cos(lat1) * self.cos_lat[i] * math.sin((self.lon[i] - lon1) / 2) ** 2)))
+            for i in positions
+        ]
+
+    def nearest(self, latitude, longitude, k=None, km=None):
+        # Returns [(distance_km, gym_id)], closest first.
+        distances = self.distances(latitude, longitude)
+        if numpy is not None:
+            candidates = numpy.nonzero(distances <= km)[0] if km is not None else numpy.arange(len(distances))
+            if k is not None and len(candidates) > k:
+                candidates = candidates[numpy.argpartition(distances[candidates], k)[:k]]
+            candidates = candidates[numpy.argsort(distances[candidates], kind="stable")]
+            return [(float(distances[i]), int(self.ids[i])) for i in candidates]
+        results = [(distance, self.ids[i]) for i, distance in enumerate(distances) if km is None or distance <= km]
+        return heapq.nsmallest(k, results) if k is not None else sorted(results)
+
+    def distances_to(self, latitude, longitude, gym_ids):
+        # {gym_id: distance_km} for the given gyms that are in the catalog.
+        self.build()
+        known = [gym_id for gym_id in gym_ids if gym_id in self.positions]
+        distances = self.distances(latitude, longitude, [self.positions[gym_id] for gym_id in known]) if known else []
+        return {gym_id: float(distance) for gym_id, distance in zip(known, distances)}
+
+
+class RaidStore:
+    """
+        Active raids held in memory, indexed by raid id and by embed
+        (channel_id, message_id). Every change is applied here first and
+        queued as a write, the queue is written to the database in order
+        by a background task. The database is read at startup and for
+        anything that isn't an active raid.
+
+        Nothing tells the store when another process changes a raid, so a
+        raid must only ever be held by the one process whose shard owns
+        its server: fetch doesn't load raids that owns(server_id) rejects.
+    """
+
+    def __init__(self, session, owns=lambda server_id: True):
+        self.session = session
+        self.owns = owns
+        self.raids = {}
+        self.by_message = {}
+        self.writes = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.grid = RaidGrid()
+        self.version = 0 # Bumped by every change, for ETags
+
+    def load(self, raids):
+        self.raids = {}
+        self.by_message = {}
+        self.grid = RaidGrid()
+        self.add_rows(raids)
+
+    def add_rows(self, raids):
+        ids = [raid.id for raid in raids]
+        going = collections.defaultdict(list)
+        embeds = collections.defaultdict(list)
+        webhooks = collections.defaultdict(list)
+        if ids:
+            for g in self.session.query(Going).filter(Going.raid_id.in_(ids)):
+                going[g.raid_id].append((g.user_id, g.extra))
+            for embed in self.session.query(Embed).filter(Embed.raid_id.in_(ids)).order_by(Embed.id):
+                embeds[embed.raid_id].append((embed.channel_id, embed.message_id))
+                if embed.webhook_id is not None:
+                    webhooks[embed.raid_id].append(((embed.channel_id, embed.message_id), embed.webhook_id))
+        for raid in raids:
+            self.add(ActiveRaid(raid, going[raid.id], embeds[raid.id], webhooks[raid.id]))
+
+    def save_snapshot(self, path):
+        # Only meaningful once every queued write has been applied.
+        raids = [raid.to_snapshot() for raid in self.raids.values() if not raid.done]
+        with gzip.open(path + ".tmp", "wt") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "written": time.time(), "raids": raids}, f)
+        os.replace(path + ".tmp", path)
+
+    def load_snapshot(self, path, active_ids):
+        # A snapshot is good for one start only, it is removed once read so
+        # a crash later on falls back to the database. Raids that are no
+        # longer active are dropped, ones it doesn't know are read from the
+        # database. Returns how many raids came from the snapshot, or None.
+        try:
+            with gzip.open(path, "rt") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        if snapshot.get("version") != SNAPSHOT_VERSION or time.time() - snapshot.get("written", 0) > SNAPSHOT_MAX_AGE:
+            return None
+        active_ids = set(active_ids)
+        self.raids = {}
+        self.by_message = {}
+        self.grid = RaidGrid()
+        for data in snapshot["raids"]:
+            if data["id"] in active_ids:
+                self.add(ActiveRaid.from_snapshot(data))
+        restored = len(self.raids)
+        missing = active_ids - set(self.raids)
+        if missing:
+            self.add_rows(self.session.query(Raid).filter(Raid.id.in_(missing)).all())
+        return restored
+
+    def fetch(self, raid_id):
+        # Active raids come from memory, anything else is read from the
+        # database and kept until it is evicted.
+        raid = self.raids.get(raid_id)
+        if raid is None:
+            self.apply()
+            row = self.session.query(Raid).get(raid_id)
+            if row is None or not self.owns(row.server_id):
+                return None # Another shard's raid is only ever held by that shard
+            embeds = self.session.query(Embed).filter_by(raid_id=raid_id).order_by(Embed.id).all()
+            raid = ActiveRaid(
+                row,
+                [(g.user_id, g.extra) for g in self.session.query(Going).filter_by(raid_id=raid_id)],
+                [(e.channel_id, e.message_id) for e in embeds],
+                [((e.channel_id, e.message_id), e.webhook_id) for e in embeds if e.webhook_id is not None])
+            self.add(raid)
+        raid.touched = time.monotonic()
+        return raid
+
+    def fetch_by_message(self, channel_id, message_id):
+        key = (int(channel_id), int(message_id))
+        raid_id = self.by_message.get(key)
+        if raid_id is None:
+            self.apply()
+            embed = self.session.query(Embed).filter_by(channel_id=key[0], message_id=key[1]).first()
+            if embed is None:
+                return None
+            raid_id = embed.raid_id
+        return self.fetch(raid_id)
+
+    def add(self, raid):
+        self.version += 1
+        self.raids[raid.id] = raid
+        for key in raid.embeds:
+            self.by_message[key] = raid.id
+        self.index(raid)
+
+    def remove(self, raid):
+        self.version += 1
+        self.raids.pop(raid.id, None)
+        for key in raid.embeds:
+            self.by_message.pop(key, None)
+        self.grid.remove(raid)
+
+    def index(self, raid):
+        # Only raids that aren't done are in the location index.
+        self.version += 1
+        if raid.done:
+            self.grid.remove(raid)
+        else:
+            self.grid.add(raid)
+
+    def evict(self):
+        now = time.monotonic()
+        for raid in list(self.raids.values()):
+            if raid.done and now - raid.touched > STORE_EVICT_AFTER:
+                self.remove(raid)
+
+    def persist(self, write):
+        self.version += 1
+        self.writes.append(write)
+        self.wakeup.set()
+
+    def apply(self):
+        # Write everything queued so far, in order, in one transaction.
+        if not self.writes:
+            return
+        writes = list(self.writes)
+        self.writes.clear()
+        try:
+            for write in writes:
+                write(self.session)
+            self.session.commit()
+        except SQLAlchemyError:
+            self.session.rollback()
+            # Retry one at a time so one bad write doesn't lose the rest.
+            for write in writes:
+                try:
+                    write(self.session)
+                    self.session.commit()
+                except SQLAlchemyError as e:
+                    self.session.rollback()
+                    print("Failed to persist raid change:", e)
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await asyncio.sleep(WRITE_BEHIND_INTERVAL)
+            self.apply()
+            self.evict()
+
+    def add_embed(self, raid, channel_id, message_id, webhook_id=None):
+        key = (int(channel_id), int(message_id))
+        raid.embeds.append(key)
+        if webhook_id is not None:
+            raid.webhooks[key] = int(webhook_id)
+        self.by_message[key] = raid.id
+        self.persist(lambda session: session.add(Embed(
+            raid_id=raid.id, channel_id=key[0], message_id=key[1], webhook_id=raid.webhooks.get(key))))
+
+    def forget_embed(self, raid, channel_id, message_id):
+        key = (int(channel_id), int(message_id))
+        if key in raid.embeds:
+            raid.embeds.remove(key)
+        raid.webhooks.pop(key, None)
+        self.by_message.pop(key, None)
+        return key
+
+    def remove_embeds(self, raid, keys):
+        message_ids = [self.forget_embed(raid, channel_id, message_id)[1] for channel_id, message_id in keys]
+        if message_ids:
+            self.persist(lambda session: session.query(Embed).filter(
+                Embed.raid_id == raid.id, Embed.message_id.in_(message_ids)).delete(synchronize_session=False))
+
+    def set_going(self, raid, user_id, extra):
+        user_id = int(user_id)
+        raid.going[user_id] = extra
+
+        def write(session):
+            going = session.query(Going).filter_by(raid_id=raid.id, user_id=user_id).first()
+            if going is None:
+                going = Going(raid_id=raid.id, user_id=user_id)
+            going.extra = extra
+            session.add(going)
+        self.persist(write)
+
+    def remove_going(self, raid, user_id):
+        user_id = int(user_id)
+        raid.going.pop(user_id, None)
+        self.persist(lambda session: session.query(Going).filter_by(
+            raid_id=raid.id, user_id=user_id).delete(synchronize_session=False))
+
+    def update(self, raid, **fields):
+        # fields are Raid columns, mirrored onto the ActiveRaid.
+        for key, value in fields.items():
+            if key in ("start_time", "end_time"):
+                value = naive_utc(value)
+            if key not in ("gym_id", "pokemon_id"):
+                setattr(raid, key, value)
+        if "done" in fields:
+            self.index(raid)
+        self.persist(lambda session: session.query(Raid).filter_by(id=raid.id).update(
+            fields, synchronize_session=False))
+
+    def set_gym(self, raid, gym):
+        raid.set_gym(gym)
+        self.index(raid)
+        self.update(raid, gym_id=gym.id)
+
+    def delete(self, raid):
+        self.remove(raid)
+
+        def write(session):
+            session.query(Going).filter_by(raid_id=raid.id).delete(synchronize_session=False)
+            session.query(Embed).filter_by(raid_id=raid.id).delete(synchronize_session=False)
+            session.query(Raid).filter_by(id=raid.id).delete(synchronize_session=False)
+        self.persist(write)
+
+
 class Gyms:
     """Information about gyms, and raid enrollment."""
 
-    def __init__(self, bot):
+    def __init__(self, bot, database_url=DATABASE_URL, snapshot_path=SNAPSHOT_PATH):
+        # Nothing here may block, the database and search backend are set
+        # up by setup() once the cog is loaded.
         self.bot = bot
-        self.client = Elasticsearch()
-        engine = create_engine('sqlite:///gyms.db')
-        Base.metadata.create_all(engine)
-        self.session = sessionmaker(bind=engine)()
+        self.client = None
+        self.search_ready = asyncio.Event()
+        self.outbox_wakeup = asyncio.Event()
+        self.outbox_task = None
+        self.gym_change_task = None
+        self.gym_change_seen = 0 # Last GymChange id applied to the catalog
+        self.ready = asyncio.Event()
+        self.startup_times = collections.OrderedDict()
+        self.engine = create_db_engine(database_url)
+        self.session = sessionmaker(bind=self.engine)()
+        self.store = RaidStore(self.session, self.owns_server)
 
         self.member_cache = {}
+        self.shard_id = getattr(bot, "shard_id", None)
+        self.shard_count = getattr(bot, "shard_count", None)
+        if self.shard_id is None or not self.shard_count:
+            self.shard_id, self.shard_count = SHARD_ID, SHARD_COUNT
         self.raid_task = None
+        self.expiry_wakeup = asyncio.Event()
+        self.instance_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease_name = "expiry:{}".format(self.shard_id)
+        self.lease_until = 0
+        self.is_expiry_leader = False
+        self.lease_task = None
+        self.store_task = None
+        self.prewarm_task = None
+        self.board_task = None
+        self.boards = {} # channel id -> board message id
+        self.board_pages = {}
+        self.board_rendered = {}
+        self.board_dirty = set()
+        self.webhooks = {} # channel id -> (webhook id, token), or None if there is none
+        self.webhook_locks = collections.defaultdict(asyncio.Lock)
+        self.gym_locks = collections.defaultdict(asyncio.Lock) # gym id -> lock held while a raid is created there
+        self.webhook_resets = {}
+        self.webhook_failed = {}
+        self.client_session = None
+        self.catalog = GymCatalog()
+        self.gym_search_cache = LRUCache(GYM_CACHE_SIZE, GYM_CACHE_TTL)
+        self.gym_embed_cache = LRUCache(GYM_CACHE_SIZE, GYM_CACHE_TTL)
+        self.api_cache = LRUCache(API_CACHE_SIZE, GYM_CACHE_TTL)
+        self.api_epoch = uuid.uuid4().hex[:8] # Keeps ETags from before a restart from matching
+        self.events = RaidEventBus()
+        self.job_tasks = {}
+        self.log_channels = {}
+        self.mirror_flags_cache = {} # channel id -> (is a mirror, posts through a webhook)
+        self.log_writer = LogWriter(bot)
+        self.log_writer.backoff = lambda: SHED_LOG_FACTOR if self.shed_level() else 1
+        self.inflight_events = 0
+        self.inflight_requests = 0
+        self.deferred_edits = {}
+        self.deferred_task = None
+        self.log_writer.start()
+        self.snapshot_path = snapshot_path.format(shard=self.shard_id)
+        self.recorder = None
+        self.message_received = collections.OrderedDict() # message id -> perf_counter() when it arrived
+        if RECORD_PATH:
+            self.start_recording(RECORD_PATH.format(shard=self.shard_id))
+        self.tracer = Tracer()
+        self.profiler = None
+        self.setup_metrics()
+        self.http_server = None
+        if HTTP_PORT:
+            self.bot.loop.create_task(self.start_http())
+        self.setup_task = self.bot.loop.create_task(self.setup())
+        self.bot.add_check(self.check_ready)
+
+    @contextlib.contextmanager
+    def startup_phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_times[name] = time.perf_counter() - started
+            self.metric_startup.set(self.startup_times[name], phase=name)
+
+    async def setup(self):
+        try:
+            with self.startup_phase("database"):
+                await self.bot.loop.run_in_executor(None, self.setup_database)
+        except SQLAlchemyError as e:
+            print("Failed to set up the gyms database:", e)
+            raise
+        with self.startup_phase("store"):
+            self.restore_store()
+        with self.startup_phase("catalog"):
+            self.catalog.load(await self.bot.loop.run_in_executor(None, self.catalog_rows))
+        self.ready.set()
+        print("Gyms ready:", ", ".join("{} {:.0f}ms".format(name, seconds * 1000) for name, seconds in self.startup_times.items()))
+        self.store_task = self.bot.loop.create_task(self.store.run())
+        self.lease_task = self.bot.loop.create_task(self.expiry_lease_loop())
+        self.prewarm_task = self.bot.loop.create_task(self.prewarm_embeds())
+        self.load_boards()
+        self.board_task = self.bot.loop.create_task(self.board_loop())
+        self.outbox_task = self.bot.loop.create_task(self.search_outbox_loop())
+        self.gym_change_task = self.bot.loop.create_task(self.gym_change_loop())
+        self.bot.loop.create_task(self.resume_jobs())
         self.reschedule_next_end()
+        await self.connect_search()
+
+    def setup_database(self):
+        # Runs in a worker thread, on its own connection.
+        Base.metadata.create_all(self.engine)
+        add_missing_columns(self.engine)
+
+    def catalog_rows(self):
+        # Runs in a worker thread, on its own connection. Changes from
+        # before the gyms are read are already in them.
+        with self.engine.connect() as conn:
+            self.gym_change_seen = conn.execute(select([func.max(GymChange.__table__.c.id)])).scalar() or 0
+            return [(row.id, row.title, row.latitude, row.longitude) for row in conn.execute(Gym.__table__.select())]
+
+    async def gym_change_loop(self):
+        pruned = 0
+        while True:
+            await asyncio.sleep(GYM_CHANGE_POLL)
+            try:
+                self.apply_gym_changes()
+                if time.time() - pruned > GYM_CHANGE_KEEP / 24:
+                    pruned = time.time()
+                    with self.engine.begin() as conn:
+                        conn.execute(GymChange.__table__.delete().where(GymChange.__table__.c.created < (
+                            datetime.datetime.utcnow() - datetime.timedelta(seconds=GYM_CHANGE_KEEP))))
+            except SQLAlchemyError as e:
+                print("Failed to read gym changes:", e)
+
+    def apply_gym_changes(self):
+        # Brings the catalog and caches up to date with gyms changed by any
+        # process, this one included. Read on its own connection so the
+        # rows aren't stale copies from self.session.
+        changes, gym = GymChange.__table__, Gym.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(select([changes.c.id, changes.c.gym_id]).where(
+                changes.c.id > self.gym_change_seen).order_by(changes.c.id)).fetchall()
+            if not rows:
+                return
+            gym_ids = set(row.gym_id for row in rows)
+            found = dict((row.id, row) for row in conn.execute(gym.select().where(gym.c.id.in_(gym_ids))))
+        self.gym_change_seen = rows[-1].id
+        for gym_id in gym_ids:
+            if gym_id in found:
+                row = found[gym_id]
+                self.catalog.add(gym_id, row.title, row.latitude, row.longitude)
+            else:
+                self.catalog.remove(gym_id)
+        self.invalidate_gym_caches()
+
+    def setup_search(self):
+        client = Elasticsearch(SEARCH_HOSTS, timeout=SEARCH_TIMEOUT)
+        connections.add_connection("default", client)
+        GymDoc.init()
+        PokemonDoc.init()
+        self.client = client
+
+    async def connect_search(self):
+        # Everything but gym and pokemon search works without Elasticsearch,
+        # so keep trying in the background until it answers.
+        while True:
+            try:
+                with self.startup_phase("search"):
+                    await asyncio.wait_for(self.bot.loop.run_in_executor(None, self.setup_search), SEARCH_TIMEOUT * 2)
+            except (asyncio.TimeoutError, elasticsearch.exceptions.ElasticsearchException) as e:
+                print("Elasticsearch unavailable, retrying in {}s: {!r}".format(SEARCH_RETRY, e))
+                await asyncio.sleep(SEARCH_RETRY)
+                continue
+            self.search_ready.set()
+            print("Gyms search ready: search {:.0f}ms".format(self.startup_times["search"] * 1000))
+            return
+
+    def require_search(self):
+        if not self.search_ready.is_set():
+            raise SearchUnavailable()
 
     def get_server_config(self, server_id, key, default=None):
         try:
@@ -175,6 +1747,8 @@ class Gyms:
             config = ServerConfig(server_id=server_id, key=key, value=value)
         self.session.add(config)
         self.session.commit()
+        if key in MIRROR_FLAG_KEYS:
+            self.mirror_flags_cache.clear()
         
     def get_channel_config(self, server_id, channel_id, key, default=None):
         try:
@@ -191,6 +1765,10 @@ class Gyms:
             config = ChannelConfig(server_id=server_id, channel_id=channel_id, key=key, value=value)
         self.session.add(config)
         self.session.commit()
+        if key == "log":
+            self.log_channels.pop(int(server_id), None)
+        if key in MIRROR_FLAG_KEYS:
+            self.mirror_flags_cache.pop(int(channel_id), None)
 
     def get_config(self, channel, key, default=None):
         config = self.get_channel_config(channel.server.id, channel.id, key)
@@ -240,47 +1818,283 @@ class Gyms:
             name = "{} (+{})".format(name, extra)
         return name
 
-    async def raid_end_task(self, raid):
-        while raid.end_time + datetime.timedelta(minutes=5) > datetime.datetime.utcnow():
-            await asyncio.sleep(5)
-        raids = self.session.query(Raid).filter(Raid.done == False, Raid.end_time <= datetime.datetime.utcnow())
+    def owns_server(self, server_id):
+        if self.shard_count == 1:
+            return True
+        if server_id is None:
+            return self.shard_id == 0 # Raids from before server_id was recorded
+        return (int(server_id) >> 22) % self.shard_count == self.shard_id
+
+    def own_raids(self, query):
+        # Limit a Raid query to the servers this shard handles.
+        if self.shard_count == 1:
+            return query
+        server_ids = [int(server.id) for server in self.bot.servers if self.owns_server(server.id)]
+        clause = Raid.server_id.in_(server_ids)
+        if self.shard_id == 0:
+            clause = or_(clause, Raid.server_id == None)
+        return query.filter(clause)
+
+    def next_end(self):
+        self.store.apply()
+        return self.own_raids(self.session.query(Raid)).filter(Raid.done == False).order_by('end_time').first()
+
+    async def raid_end_task(self):
+        # Sleeps until the next known end, but also wakes every EXPIRY_POLL
+        # seconds to pick up raids created or changed by other instances,
+        # and whenever reschedule_next_end says the next end may have moved.
+        while self.holds_lease():
+            self.expiry_wakeup.clear()
+            raid = self.next_end()
+            polled = time.time()
+            while time.time() - polled < EXPIRY_POLL:
+                if raid is not None and raid.end_time + datetime.timedelta(minutes=5) <= datetime.datetime.utcnow():
+                    break
+                try:
+                    await asyncio.wait_for(self.expiry_wakeup.wait(), 5)
+                except asyncio.TimeoutError:
+                    continue
+                self.expiry_wakeup.clear()
+                raid = self.next_end()
+            try:
+                await self.expire_raids()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Failed to expire raids:", e)
+                traceback.print_exc()
+        self.raid_task = None
+
+    async def expire_raids(self):
+        self.store.apply()
+        now = datetime.datetime.utcnow()
+        raids = self.own_raids(self.session.query(Raid)).filter(Raid.done == False, Raid.end_time <= now).all()
         for raid in raids:
-            await self.mark_done(raid)
-        self.reschedule_next_end(False)
+            if not self.holds_lease():
+                return
+            await self.mark_done(self.store.fetch(raid.id))
+        # Raids claimed done whose clean up never finished, because it failed
+        # or its process stopped part way. Only recent ones, so a raid whose
+        # clean up keeps failing is eventually given up on.
+        unclean = self.own_raids(self.session.query(Raid)).filter(
+            Raid.done == True, Raid.cleaned == False, Raid.end_time <= now,
+            Raid.end_time > now - datetime.timedelta(seconds=CLEAN_UP_RETRY_FOR)).all()
+        for raid in unclean:
+            if not self.holds_lease():
+                return
+            raid = self.store.fetch(raid.id)
+            if raid is not None and raid.done:
+                await self.clean_up_done(raid)
+
+    def reschedule_next_end(self):
+        # A running expiry task is woken rather than cancelled, so it's never
+        # interrupted part way through marking raids done.
+        if self.raid_task is not None and not self.raid_task.done():
+            self.expiry_wakeup.set()
+            return
+        if not self.holds_lease():
+            self.raid_task = None
+            return
+        self.raid_task = self.bot.loop.create_task(self.raid_end_task())
+
+    def acquire_lease(self, name, ttl=LEASE_TTL):
+        # Runs in its own transaction so it never commits or rolls back
+        # anything pending on self.session.
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=ttl)
+        table = Lease.__table__
+        with self.engine.begin() as conn:
+            updated = conn.execute(table.update().where(table.c.name == name).where(
+                or_(table.c.holder == self.instance_id, table.c.expires < now)
+            ).values(holder=self.instance_id, expires=expires)).rowcount
+        if updated:
+            return True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(table.insert().values(name=name, holder=self.instance_id, expires=expires))
+            return True
+        except IntegrityError:
+            return False
 
-    def reschedule_next_end(self, cancel=True):
-        if self.raid_task is not None and cancel:
-            if self.raid_task.done():
-                self.raid_task.result()
-            self.raid_task.cancel()
-        raid = self.session.query(Raid).filter(Raid.done == False).order_by('end_time').first()
-        if raid:
-            self.raid_task = self.bot.loop.create_task(self.raid_end_task(raid))
+    def release_lease(self, name):
+        table = Lease.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.name == name).where(
+                table.c.holder == self.instance_id).values(expires=datetime.datetime.utcnow()))
+
+    def holds_lease(self):
+        # Stop acting as leader a little before the lease actually lapses.
+        return self.is_expiry_leader and time.monotonic() < self.lease_until - LEASE_RENEW
+
+    async def expiry_lease_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            started = time.monotonic()
+            try:
+                leader = self.acquire_lease(self.lease_name)
+            except SQLAlchemyError as e:
+                print("Failed to renew lease", self.lease_name, e)
+                leader = False
+            if leader:
+                self.lease_until = started + LEASE_TTL
+                if not self.is_expiry_leader:
+                    print("Took over raid expiry for shard", self.shard_id)
+                    self.is_expiry_leader = True
+                    self.reschedule_next_end()
+            elif self.is_expiry_leader:
+                print("Lost raid expiry lease for shard", self.shard_id)
+                self.is_expiry_leader = False
+                if self.raid_task is not None:
+                    self.raid_task.cancel()
+                    self.raid_task = None
+            await asyncio.sleep(LEASE_RENEW)
+
+    async def on_ready(self):
+        # The server list isn't known until the bot is ready.
+        await self.ready.wait()
+        if self.backfill_raid_servers() and self.shard_count > 1:
+            self.load_store()
+        self.reschedule_next_end()
+
+    def active_raid_ids(self):
+        # Filtered in Python, the server list may not be known yet.
+        rows = self.session.query(Raid.id, Raid.server_id).filter(Raid.done == False)
+        return [raid_id for raid_id, server_id in rows if self.owns_server(server_id)]
+
+    def load_store(self, ids=None):
+        self.store.apply()
+        if ids is None:
+            ids = self.active_raid_ids()
+        self.store.load(self.session.query(Raid).filter(Raid.id.in_(ids)).all() if ids else [])
+
+    def restore_store(self):
+        ids = self.active_raid_ids()
+        if self.store.load_snapshot(self.snapshot_path, ids) is None:
+            self.load_store(ids)
+
+    async def prewarm_embeds(self):
+        # Fetch the embeds of active raids into the message cache, so the
+        # first reaction on each after a restart doesn't wait on Discord.
+        await self.bot.wait_until_ready()
+        semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+        async def fetch(channel_id, message_id):
+            async with semaphore:
+                channel = self.get_channel(channel_id)
+                if channel is None:
+                    return
+                try:
+                    await self.get_message(channel, message_id)
+                except discord.errors.HTTPException:
+                    pass
+
+        tasks = [fetch(*key) for raid in list(self.store.raids.values()) if not raid.done for key in raid.embeds]
+        if tasks:
+            await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+
+    def backfill_raid_servers(self):
+        raids = self.session.query(Raid).filter(Raid.done == False, Raid.server_id == None).all()
+        for raid in raids:
+            for embed in self.session.query(Embed).filter_by(raid=raid):
+                channel = self.get_channel(embed.channel_id)
+                if channel is not None:
+                    raid.server_id = channel.server.id
+                    self.session.add(raid)
+                    if raid.id in self.store.raids:
+                        self.store.raids[raid.id].server_id = raid.server_id
+                    break
+        self.session.commit()
+        return len(raids)
 
     async def find_gym(self, gym, channel=None):
-        location = self.get_config(channel, "location", [])
+        self.require_search()
+        key = (" ".join(gym.lower().split()),)
+        if channel is not None:
+            key += (
+                self.get_config(channel, "location", "").replace(" ", ""),
+                self.get_config(channel, "scale", "2"),
+                self.get_config(channel, "region", ""))
+        result = self.gym_search_cache.get(key)
+        self.metric_cache.inc(cache="gym_search", result="miss" if result is LRUCache.MISSING else "hit")
+        if result is not LRUCache.MISSING:
+            return result
+        with self.metric_search.time(kind="gym"), self.tracer.span("search gym"):
+            result = await self._find_gym(gym, channel)
+        self.gym_search_cache.put(key, result)
+        return result
+
+    def invalidate_gym_caches(self):
+        # Called by every command that adds, removes or renames gyms.
+        self.gym_search_cache.clear()
+        self.gym_embed_cache.clear()
+
+    async def _find_gym(self, gym, channel=None):
+        location = self.get_config(channel, "location", []) if channel is not None else []
         if location != []:
             location = location.replace(" ", "")
             location = location.split(",")
-        if channel is not None and len(location) == 2:
-            scale = self.get_config(channel, "scale", "2")
-            s = Search(using=self.client, index="marker")
-            q = query.Q(
-                "function_score",
-                query=query.Q("match", title={'query': gym, 'fuzziness': 1}),
-                functions=[
-                    query.SF("gauss", location={"origin": {"lat": location[0], "lon": location[1]}, "scale": scale+"km"})
-                ]
-            )
-            s = s.query(q)
+        origin = None
+        if len(location) == 2:
+            origin = float(location[0]), float(location[1])
+        for tier, regions in self.search_regions(channel, origin):
+            hits = self.search_gyms(gym, regions, origin)
+            if hits:
+                self.metric_search_tier.inc(tier=tier)
+                break
         else:
-            s = Search(using=self.client, index="marker").query("match", title={'query': gym, 'fuzziness': 2})
-        response = s.execute()
-        if response.hits.total == 0:
             return None
-        return response[0]
+        if origin is None:
+            return hits[0]
+        # The best text matches are re-ranked by distance here, with the
+        # same gauss decay Elasticsearch used: the score halves at scale km.
+        latitude, longitude = origin
+        scale = float(self.get_config(channel, "scale", "2"))
+        distances = self.catalog.distances_to(latitude, longitude, [int(hit.meta.id) for hit in hits])
+
+        def score(hit):
+            distance = distances.get(int(hit.meta.id))
+            if distance is None:
+                distance = haversine_km(latitude, longitude, hit.location["lat"], hit.location["lon"])
+            return hit.meta.score * 0.5 ** ((distance / scale) ** 2)
+        return max(hits, key=score)
+
+    def search_regions(self, channel, origin):
+        # Yields (tier, geohash prefixes) to search in turn, None is every
+        # gym. A channel or server "region" setting replaces the cells
+        # around the channel's location.
+        configured = self.get_config(channel, "region", None) if channel is not None else None
+        if configured:
+            yield "local", [region.strip() for region in configured.split(",") if region.strip()]
+        elif origin is not None:
+            yield "local", [geohash(*origin)]
+            yield "neighbours", geohash_neighbours(*origin)
+        yield "global", None
+
+    def search_gyms(self, gym, regions, origin):
+        # Within regions every word has to match, anything less falls
+        # through to the next tier. The global search keeps the old
+        # looser matching.
+        fuzziness = 1 if origin is not None else 2
+        s = Search(using=self.client, index="marker")
+        if regions is None:
+            s = s.query("match", title={'query': gym, 'fuzziness': fuzziness})
+        else:
+            s = s.query("bool", must=[
+                Q("match", title={'query': gym, 'fuzziness': fuzziness, 'operator': 'and'})
+            ], filter=[
+                Q("bool", should=[Q("prefix", region=region) for region in regions])
+            ])
+        response = s[:FIND_GYM_CANDIDATES if origin is not None else 1].execute()
+        if response.hits.total == 0:
+            return []
+        return list(response)
 
     async def find_pokemon(self, gym):
+        self.require_search()
+        with self.metric_search.time(kind="pokemon"), self.tracer.span("search pokemon"):
+            return await self._find_pokemon(gym)
+
+    async def _find_pokemon(self, gym):
         s = Search(using=self.client, index="pokemon").query("match", name={'query': gym, 'fuzziness': 2})
         response = s.execute()
         if response.hits.total == 0:
@@ -298,20 +2112,21 @@ class Gyms:
         return loc_dt.strftime("%H:%M")
 
     async def prepare_raid_embed(self, channel, raid, include_role=False):
+        with self.tracer.span("render"):
+            return await self._prepare_raid_embed(channel, raid, include_role)
+
+    async def _prepare_raid_embed(self, channel, raid, include_role=False):
         server = channel.server
         title = raid.gym.title if isinstance(raid.gym.title, str) else raid.gym.title[0]
         title = "{} (#{})".format(title, raid.id)
-        going = self.session.query(Going).filter_by(raid=raid)
-
         users = []
         num_extra = 0
-        if going.count():
-            for g in going:
-                num_extra += g.extra
-                member = server.get_member(str(g.user_id))
-                display_name = self.get_display_name(channel, member, g.extra)
-                users.append(display_name)
-            users.sort()
+        for user_id, extra in raid.going.items():
+            num_extra += extra
+            member = server.get_member(str(user_id))
+            display_name = self.get_display_name(channel, member, extra)
+            users.append(display_name)
+        users.sort()
 
         if raid.pokemon is None:
             description = "**Level**: {}\n".format(raid.level)
@@ -326,7 +2141,7 @@ class Gyms:
         if datetime.datetime.utcnow() < raid.end_time - DESPAWN_TIME:
             description += "**Hatches at**: {}\n".format(self.format_time(channel, raid.end_time - DESPAWN_TIME))
         description += "**Despawns at**: {}\n".format(self.format_time(channel, raid.end_time))
-        description += "**Going ({})**\n".format(going.count()+num_extra)
+        description += "**Going ({})**\n".format(len(raid.going)+num_extra)
 
         description += " | ".join(users)
         description += "\nPress the {} below if you want to do this raid\n[Click here](https://github.com/Azelphur/EkPoGo-Discord-Bot/wiki/Using-the-bot) more info about this bot".format(self.get_emoji(self.get_config(channel, "emoji_going", u"\U0001F44D")))
@@ -351,6 +2166,14 @@ class Gyms:
         return embed, content
 
     def prepare_gym_embed(self, gym):
+        embed = self.gym_embed_cache.get(gym.meta["id"])
+        self.metric_cache.inc(cache="gym_embed", result="miss" if embed is LRUCache.MISSING else "hit")
+        if embed is LRUCache.MISSING:
+            embed = self._prepare_gym_embed(gym)
+            self.gym_embed_cache.put(gym.meta["id"], embed)
+        return embed
+
+    def _prepare_gym_embed(self, gym):
         title = gym.title if isinstance(gym.title, str) else gym.title[0]
         description = "[Get Directions](https://www.google.com/maps/dir/Current+Location/{},{})".format(gym.location['lat'], gym.location['lon'])
         embed=discord.Embed(title=title, url="https://www.google.com/maps/dir/Current+Location/{},{}".format(gym.location['lat'], gym.location['lon']))
@@ -376,15 +2199,144 @@ class Gyms:
             longitude=longitude,
         )
         self.session.add(gym)
+        self.session.flush()
+        self.queue_search_update("gym", gym.id)
         self.session.commit()
+        self.catalog.add(gym.id, title, latitude, longitude)
+        return gym, self.gym_document(gym, [])
 
-        gymdoc = GymDoc(
+    def gym_document(self, gym, aliases):
+        return GymDoc(
             meta={'id': gym.id},
-            title=title,
-            location={"lat": latitude, "lon": longitude}
+            title=[gym.title] + aliases if aliases else gym.title,
+            location={"lat": gym.latitude, "lon": gym.longitude},
+            region=geohash(gym.latitude, gym.longitude)
         )
-        gymdoc.save()
-        return gym, gymdoc
+
+    def queue_search_update(self, kind, ref_id):
+        # Part of the caller's transaction, the search document is
+        # rewritten from SQL by search_outbox_loop once it commits, and
+        # other processes pick gym changes up from GymChange.
+        self.session.add(SearchOutbox(kind=kind, ref_id=ref_id))
+        if kind == "gym":
+            self.session.add(GymChange(gym_id=ref_id))
+        self.outbox_wakeup.set()
+
+    async def search_outbox_loop(self):
+        await self.search_ready.wait()
+        while True:
+            try:
+                pushed = await self.push_search_outbox()
+            except (SQLAlchemyError, elasticsearch.exceptions.ElasticsearchException) as e:
+                print("Failed to update the search index, retrying in {}s: {!r}".format(OUTBOX_RETRY, e))
+                await asyncio.sleep(OUTBOX_RETRY)
+                continue
+            if pushed < OUTBOX_BATCH:
+                self.outbox_wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.outbox_wakeup.wait(), OUTBOX_POLL)
+
+    async def push_search_outbox(self):
+        # Uses its own session, self.session may hold a command's pending
+        # changes which this must neither commit nor roll back while it
+        # waits on Elasticsearch. Closing it rolls back on failure.
+        session = sessionmaker(bind=self.engine)()
+        try:
+            now = datetime.datetime.utcnow()
+            entries = session.query(SearchOutbox).filter(
+                or_(SearchOutbox.retry_after == None, SearchOutbox.retry_after <= now)
+            ).order_by(SearchOutbox.id).limit(OUTBOX_BATCH).all()
+            if not entries or not self.acquire_lease("search-outbox"):
+                return 0
+            gym_ids = set(entry.ref_id for entry in entries if entry.kind == "gym")
+            pokemon_ids = set(entry.ref_id for entry in entries if entry.kind == "pokemon")
+            actions = self.search_actions(session, gym_ids, pokemon_ids)
+            count, failed = await self.bot.loop.run_in_executor(None, self.bulk_index, actions)
+            # Rejected documents stay queued and are retried with a growing
+            # delay, so one bad document doesn't hold up the others.
+            done = [entry.id for entry in entries if str(entry.ref_id) not in failed]
+            if done:
+                session.query(SearchOutbox).filter(SearchOutbox.id.in_(done)).delete(synchronize_session=False)
+            # Searches cached before the index had these gyms are stale
+            # now, in every process.
+            session.add_all([GymChange(gym_id=gym_id) for gym_id in gym_ids if str(gym_id) not in failed])
+            for entry in entries:
+                if str(entry.ref_id) in failed:
+                    entry.attempts = (entry.attempts or 0) + 1
+                    entry.retry_after = now + datetime.timedelta(
+                        seconds=min(OUTBOX_RETRY * 2 ** entry.attempts, OUTBOX_BACKOFF_MAX))
+            session.commit()
+        finally:
+            session.close()
+        self.metric_outbox_pushed.inc(len([i for i in gym_ids if str(i) not in failed]), kind="gym")
+        self.metric_outbox_pushed.inc(len([i for i in pokemon_ids if str(i) not in failed]), kind="pokemon")
+        if gym_ids:
+            self.invalidate_gym_caches()
+        return len(entries)
+
+    def search_actions(self, session, gym_ids, pokemon_ids):
+        # Documents are rebuilt from the current rows, so repeated or out
+        # of order entries are harmless. Missing rows delete the document.
+        actions = []
+        if gym_ids:
+            gyms = dict((gym.id, gym) for gym in session.query(Gym).filter(Gym.id.in_(gym_ids)))
+            aliases = collections.defaultdict(list)
+            for alias in session.query(GymAlias).filter(GymAlias.gym_id.in_(gym_ids)).order_by(GymAlias.id):
+                aliases[alias.gym_id].append(alias.alias)
+            for gym_id in gym_ids:
+                if gym_id in gyms:
+                    actions.append(self.gym_document(gyms[gym_id], aliases[gym_id]).to_dict(include_meta=True))
+                else:
+                    actions.append(dict(GymDoc(meta={'id': gym_id}).to_dict(include_meta=True), _op_type="delete"))
+        if pokemon_ids:
+            pokemon = dict((p.id, p) for p in session.query(Pokemon).filter(Pokemon.id.in_(pokemon_ids)))
+            for pokemon_id in pokemon_ids:
+                if pokemon_id in pokemon:
+                    actions.append(PokemonDoc(meta={'id': pokemon_id}, name=pokemon[pokemon_id].name).to_dict(include_meta=True))
+                else:
+                    actions.append(dict(PokemonDoc(meta={'id': pokemon_id}).to_dict(include_meta=True), _op_type="delete"))
+        return actions
+
+    def bulk_index(self, actions):
+        # Runs in a worker thread. Returns (documents written, ids of those
+        # that failed). Deleting a document that's already gone is fine,
+        # anything else is reported and counted as failed.
+        count, errors = elasticsearch.helpers.bulk(self.client, actions, chunk_size=OUTBOX_BATCH, raise_on_error=False)
+        failed = set()
+        for error in errors:
+            item = next(iter(error.values()))
+            if item.get("status") != 404:
+                print("Search index update failed:", item)
+                failed.add(str(item.get("_id")))
+        return count, failed
+
+    def reindex_search(self):
+        # Runs in a worker thread, streaming rows on its own connection.
+        # Returns (documents indexed, stale documents removed).
+        GymDoc.init()
+        PokemonDoc.init()
+        gym_ids = set()
+        pokemon_ids = set()
+        with self.engine.connect() as conn:
+            aliases = collections.defaultdict(list)
+            for row in conn.execute(GymAlias.__table__.select().order_by(GymAlias.__table__.c.id)):
+                aliases[row.gym_id].append(row.alias)
+            streaming = conn.execution_options(stream_results=True)
+
+            def actions():
+                for row in streaming.execute(Gym.__table__.select()):
+                    gym_ids.add(str(row.id))
+                    yield self.gym_document(row, aliases[row.id]).to_dict(include_meta=True)
+                for row in streaming.execute(Pokemon.__table__.select()):
+                    pokemon_ids.add(str(row.id))
+                    yield PokemonDoc(meta={'id': row.id}, name=row.name).to_dict(include_meta=True)
+            indexed = self.bulk_index(actions())[0]
+        stale = []
+        for doc, ids in ((GymDoc, gym_ids), (PokemonDoc, pokemon_ids)):
+            for hit in elasticsearch.helpers.scan(self.client, index=doc._doc_type.index, query={"_source": False}):
+                if hit["_id"] not in ids:
+                    stale.append(dict(doc(meta={'id': hit["_id"]}).to_dict(include_meta=True), _op_type="delete"))
+        return indexed, self.bulk_index(stale)[0]
 
     @commands.command(pass_context=True)
     @checks.is_owner()
@@ -435,8 +2387,9 @@ class Gyms:
                         except NoResultFound:
                             p = Pokemon(name=entry["data"]["name"], id=entry["data"]["id"], raid_level=entry["data"].get("raid_level", None))
                             self.session.add(p)
-                            PokemonDoc(meta={'id': entry["data"]["id"]}, name=entry["data"]["name"]).save()
+                        self.queue_search_update("pokemon", entry["data"]["id"])
                 self.session.commit()
+                self.invalidate_gym_caches()
                 await self.bot.say("Imported {} gyms and {} pokemon".format(count_gyms, count_pokemon))
         except FileNotFoundError:
             await self.bot.say("File not found")
@@ -447,15 +2400,14 @@ class Gyms:
         """
             Add an alias for a gym
         """
-        try:
-            gym = GymDoc.get(id=gym_id)
-        except elasticsearch.exceptions.NotFoundError:
+        if self.session.query(Gym).get(gym_id) is None:
             await self.bot.say("Gym not found")
-        if isinstance(gym.title, str):
-            gym.title = [gym.title, alias]
-        else:
-            gym.title.append(alias)
-        gym.save()
+            return
+        if self.session.query(GymAlias).filter_by(gym_id=gym_id, alias=alias).first() is None:
+            self.session.add(GymAlias(gym_id=gym_id, alias=alias))
+            self.queue_search_update("gym", gym_id)
+            self.session.commit()
+        self.invalidate_gym_caches()
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
 
     @commands.command(pass_context=True)
@@ -464,13 +2416,13 @@ class Gyms:
         """
             Remove an alias for a gym
         """
-        try:
-            gym = GymDoc.get(id=gym_id)
-        except elasticsearch.exceptions.NotFoundError:
+        if self.session.query(Gym).get(gym_id) is None:
             await self.bot.say("Gym not found")
-        if not isinstance(gym.title, str):
-            gym.title.remove(alias)
-            gym.save()
+            return
+        if self.session.query(GymAlias).filter_by(gym_id=gym_id, alias=alias).delete():
+            self.queue_search_update("gym", gym_id)
+            self.session.commit()
+            self.invalidate_gym_caches()
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
 
     @commands.command(pass_context=True)
@@ -479,12 +2431,12 @@ class Gyms:
         """
             Delete a gym from the database.
         """
-        try:
-            gym = GymDoc.get(id=gym_id)
-            gym.delete()
-        except elasticsearch.exceptions.NotFoundError:
-            pass
+        self.session.query(GymAlias).filter_by(gym_id=gym_id).delete()
         self.session.query(Gym).filter_by(id=gym_id).delete()
+        self.queue_search_update("gym", gym_id)
+        self.session.commit()
+        self.catalog.remove(gym_id)
+        self.invalidate_gym_caches()
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
 
     @commands.command(pass_context=True)
@@ -494,8 +2446,43 @@ class Gyms:
             Add a gym to the database
         """
         gym, gymdoc = self.add_gym(title, latitude, longitude)
+        self.invalidate_gym_caches()
         await self.bot.say(embed=self.prepare_gym_embed(gymdoc))
 
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def reindex(self, ctx, aliases: str = None):
+        """
+            Rebuild the gym and pokemon search indexes from the database.
+            `!reindex aliases` first copies gym aliases that are only
+            in the search index into the database.
+        """
+        self.require_search()
+        message = await self.bot.say("Reindexing...")
+        if aliases == "aliases":
+            hits = await self.bot.loop.run_in_executor(
+                None, lambda: list(elasticsearch.helpers.scan(self.client, index=GymDoc._doc_type.index)))
+            imported = 0
+            for hit in hits:
+                titles = hit["_source"].get("title")
+                gym = self.session.query(Gym).get(int(hit["_id"]))
+                if gym is None or not isinstance(titles, list):
+                    continue
+                for alias in titles[1:]:
+                    if self.session.query(GymAlias).filter_by(gym_id=gym.id, alias=alias).first() is None:
+                        self.session.add(GymAlias(gym_id=gym.id, alias=alias))
+                        imported += 1
+            self.session.commit()
+            await self.bot.edit_message(message, "Imported {} aliases, reindexing...".format(imported))
+        # Whatever is queued now is covered by the rebuild.
+        pending = [entry_id for entry_id, in self.session.query(SearchOutbox.id)]
+        indexed, removed = await self.bot.loop.run_in_executor(None, self.reindex_search)
+        if pending:
+            self.session.query(SearchOutbox).filter(SearchOutbox.id.in_(pending)).delete(synchronize_session=False)
+            self.session.commit()
+        self.invalidate_gym_caches()
+        await self.bot.edit_message(message, "Reindexed {} documents, removed {} stale ones".format(indexed, removed))
+
     @commands.command(pass_context=True)
     @checks.serverowner_or_permissions(administrator=True)
     async def raidserverconfig(self, ctx, key: str = None, value: str = None, channel: discord.Channel = None):
@@ -537,6 +2524,8 @@ class Gyms:
             await self.bot.say("{} = {}".format(key, self.get_channel_config(channel.server.id, channel.id, key)))
         else:
             self.set_channel_config(channel.server.id, channel.id, key, value)
+            if key in ("board", "mirror_nearby", "location", "scale"):
+                self.touch_boards(channel.server.id)
             await self.bot.say("Ok, {} = {}".format(key, value))
 
     @commands.command(pass_context=True)
@@ -545,7 +2534,7 @@ class Gyms:
             Alter the start time on a raid. Start time must be
             HH:MM, HHMM, HH.MM or \"YYYY-MM-DD HH:MM\"
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
@@ -555,9 +2544,8 @@ class Gyms:
             await self.bot.say(TIME_STRING)
             return
         await self.log(ctx.message.channel.server, "{} changed start on raid {} from {} to {}", ctx.message.author, raid_id, raid.start_time, start_dt)
-        raid.start_time = start_dt
-        self.session.add(raid)
-        self.session.commit()
+        self.store.update(raid, start_time=start_dt)
+        self.publish_raid("time", raid)
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
         await self.update_embeds(raid)
 
@@ -567,7 +2555,7 @@ class Gyms:
             Alter the end time on a raid. End time must be
             HH:MM, HHMM, HH.MM or \"YYYY-MM-DD HH:MM\"
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
@@ -577,9 +2565,8 @@ class Gyms:
             await self.bot.say(TIME_STRING)
             return
         await self.log(ctx.message.channel.server, "{} changed end on raid {} from {} to {}", ctx.message.author, raid_id, raid.end_time, end_dt)
-        raid.end_time = end_dt
-        self.session.add(raid)
-        self.session.commit()
+        self.store.update(raid, end_time=end_dt)
+        self.publish_raid("time", raid)
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
         await self.update_embeds(raid)
         self.reschedule_next_end()
@@ -589,14 +2576,14 @@ class Gyms:
         """
             Set the pokemon that a raid is on.
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
 
         if pokemon_name.isnumeric():
-            raid.pokemon = None
-            raid.level = int(pokemon_name)
+            self.store.update(raid, pokemon_id=None, level=int(pokemon_name))
+            raid.set_pokemon(None)
         else:
             pokemon = await self.find_pokemon(pokemon_name)
             if not pokemon:
@@ -607,10 +2594,10 @@ class Gyms:
                 await self.log(ctx.message.channel.server, "{} changed pokemon on raid {} from {} to {}", ctx.message.author, raid_id, raid.pokemon.name, pokemon.name)
             else:
                 await self.log(ctx.message.channel.server, "{} set pokemon on raid {} to {}", ctx.message.author, raid_id, pokemon.name)
-            raid.pokemon = pokemon
+            self.store.update(raid, pokemon_id=pokemon.id)
+            raid.set_pokemon(pokemon)
+        self.publish_raid("raid", raid)
 
-        self.session.add(raid)
-        self.session.commit()
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
         await self.update_embeds(raid)
 
@@ -620,19 +2607,98 @@ class Gyms:
             Mentions everyone who is marked as going
             to a raid, and tells them to go in.
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
 
-        going = self.session.query(Going).filter_by(raid=raid)
-
         users = []
-        for g in going:
-            member = ctx.message.channel.server.get_member(str(g.user_id))
+        for user_id in raid.going:
+            member = ctx.message.channel.server.get_member(str(user_id))
             users.append(member.mention)
         msg = "Go in! {}".format(", ".join(users))
         await self.bot.say(msg)
+
+    def split_trailing_number(self, words):
+        # "some place 5" -> ("some place", 5.0), coordinates are left alone.
+        words = list(words)
+        number = None
+        if words and RE_COORDINATES.match(" ".join(words)) is None:
+            try:
+                number = float(words[-1])
+                words.pop()
+            except ValueError:
+                pass
+        return " ".join(words), number
+
+    async def parse_location(self, channel, location):
+        # "lat,lon", a gym name, or the channel's location when empty.
+        match = RE_COORDINATES.match(location or self.get_config(channel, "location", ""))
+        if match is not None:
+            return float(match.group(1)), float(match.group(2))
+        if location:
+            gym = await self.find_gym(location, channel)
+            if not gym:
+                await self.bot.say("Gym not found.")
+                return None
+            return gym.location["lat"], gym.location["lon"]
+        await self.bot.say("Give a location, or set one for this channel with !raidchannelconfig location lat,lon")
+        return None
+
+    @commands.command(pass_context=True)
+    async def gymsnear(self, ctx, *args):
+        """
+            List the gyms closest to a location.
+            Location is "lat,lon" or a gym name and defaults to
+            the channel location.
+            e.g. !gymsnear 51.28,1.08 10
+        """
+        location, count = self.split_trailing_number(args)
+        count = max(1, min(int(count), GYMS_NEAR_MAX)) if count else GYMS_NEAR_DEFAULT
+        point = await self.parse_location(ctx.message.channel, location)
+        if point is None:
+            return
+        gyms = self.catalog.nearest(point[0], point[1], k=count)
+        if not gyms:
+            await self.bot.say("No gyms found.")
+            return
+        lines = ["**{}** (ID {}) - {:.1f}km".format(self.catalog.titles[gym_id], gym_id, distance) for distance, gym_id in gyms]
+        await self.bot.say("\n".join(lines))
+
+    @commands.command(pass_context=True)
+    async def raidsnear(self, ctx, *args):
+        """
+            List active raids near a location, closest first.
+            Location is "lat,lon" or a gym name and defaults to
+            the channel location, km defaults to the channel scale.
+            e.g. !raidsnear 51.28,1.08 5
+        """
+        channel = ctx.message.channel
+        location, km = self.split_trailing_number(args)
+        point = await self.parse_location(channel, location)
+        if point is None:
+            return
+        latitude, longitude = point
+        if km is None:
+            km = float(self.get_config(channel, "scale", "2"))
+
+        now = datetime.datetime.utcnow()
+        raids = [
+            (distance, raid) for distance, raid in self.store.grid.near(latitude, longitude, km)
+            if raid.end_time > now and raid.server_id is not None and int(raid.server_id) == int(channel.server.id)
+        ]
+        if not raids:
+            await self.bot.say("No active raids within {}km.".format(km))
+            return
+        raids.sort(key=lambda item: (item[0], item[1].end_time))
+        lines = []
+        for distance, raid in raids[:RAIDS_NEAR_LIMIT]:
+            boss = raid.pokemon.name if raid.pokemon is not None else "Level {}".format(raid.level)
+            lines.append("**#{}** {} - {}, {:.1f}km, despawns at {}".format(
+                raid.id, raid.gym.title, boss, distance, self.format_time(channel, raid.end_time)))
+        if len(raids) > RAIDS_NEAR_LIMIT:
+            lines.append("...and {} more".format(len(raids) - RAIDS_NEAR_LIMIT))
+        await self.bot.say("\n".join(lines))
         
 
     @commands.command(pass_context=True)
@@ -640,7 +2706,7 @@ class Gyms:
         """
             Change the gym associated with a raid.
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
@@ -652,9 +2718,8 @@ class Gyms:
 
         gym = self.session.query(Gym).get(gym.meta['id'])
         await self.log(ctx.message.channel.server, "{} changed gym on raid {} from {} to {}", ctx.message.author, raid_id, raid.gym.title, gym.title)
-        raid.gym = gym
-        self.session.add(raid)
-        self.session.commit()
+        self.store.set_gym(raid, gym)
+        self.publish_raid("raid", raid)
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
         await self.update_embeds(raid)
 
@@ -678,6 +2743,7 @@ class Gyms:
             await self.bot.say("Gym not found.")
             return
 
+        self.store.apply()
         gym = self.session.query(Gym).get(gym.meta['id'])
         raids = self.session.query(Raid).filter(Raid.gym==gym, Raid.start_time >= start_dt)
         num_raids = raids.count()
@@ -694,6 +2760,64 @@ class Gyms:
         msg = "Since {}, there have been {} raids, {} visits and {} - {} unique visits on {}".format(start_dt, num_raids, total_hits, len(individuals), len(individuals)+extras, gym.title)
         await self.bot.say(msg)
 
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def raidexport(self, ctx, *args):
+        """
+            Export raid attendance history for analysis.
+            Takes an optional since and until date (YYYY-MM-DD), "lat,lon"
+            and km to only export raids near somewhere, region:<geohash>
+            (comma separated) for raids in those regions and server:all
+            for every server's raids instead of just this one's.
+        """
+        usage = "```!raidexport [since] [until] [lat,lon km] [region:geohash,...] [server:all|id]\n\nExport raid attendance history```"
+        dates = []
+        near = None
+        km = None
+        server_id = ctx.message.server.id if ctx.message.server is not None else None
+        regions = None
+        for arg in args:
+            match = RE_COORDINATES.match(arg)
+            try:
+                if arg.startswith("server:"):
+                    server_id = None if arg[7:] == "all" else int(arg[7:])
+                elif arg.startswith("region:"):
+                    regions = [region for region in arg[7:].lower().split(",") if region]
+                    if not regions or any(char not in GEOHASH_ALPHABET for region in regions for char in region):
+                        raise ValueError(arg)
+                elif match is not None:
+                    near = float(match.group(1)), float(match.group(2))
+                elif near is not None and km is None:
+                    km = float(arg)
+                else:
+                    dates.append(datetime.datetime.strptime(arg, "%Y-%m-%d"))
+            except ValueError:
+                await self.bot.say(usage)
+                return
+        if len(dates) > 2 or (near is not None and km is None):
+            await self.bot.say(usage)
+            return
+        since = dates[0] if dates else None
+        until = dates[1] if len(dates) > 1 else None
+
+        self.store.apply()
+        filename = "raids-{}.{}".format(datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S"), export_format())
+        path = os.path.join(EXPORT_DIR, filename)
+        message = await self.bot.say("Exporting raids...")
+        try:
+            rows = await self.bot.loop.run_in_executor(
+                None, export_raid_history, self.engine, path, since, until, near, km, server_id, regions)
+        except (OSError, SQLAlchemyError) as e:
+            await self.bot.edit_message(message, "Export failed: {}".format(e))
+            return
+        if os.path.getsize(path) > EXPORT_ATTACH_MAX:
+            await self.bot.edit_message(message, "Exported {} rows to {} on the bot's host".format(rows, os.path.abspath(path)))
+            return
+        with open(path, "rb") as f:
+            await self.bot.send_file(ctx.message.channel, f, filename=filename, content="Exported {} rows".format(rows))
+        os.remove(path)
+        await self.bot.delete_message(message)
+
     @commands.command(pass_context=True)
     async def raidgoing(self, ctx, *args):
         """
@@ -703,7 +2827,7 @@ class Gyms:
             await self.bot.say("```!raidgoing <raid_id> <member> [extra=0] [<member> [extra=0]...]\n\nAdd users as going to a raid```")
             return
 
-        raid = self.session.query(Raid).get(args[0])
+        raid = self.store.fetch(int(args[0]))
         if raid is None:
             await self.bot.say("Raid not found")
             return
@@ -735,15 +2859,17 @@ class Gyms:
         """
             Mark users as not going to a raid.
         """
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
 
         for member in members:
-            self.session.query(Going).filter_by(raid=raid, user_id=member.id).delete()
+            self.store.remove_going(raid, member.id)
+        self.publish_raid("going", raid)
 
         await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
+        await self.update_embeds(raid)
 
     def hours_minutes_to_dt(self, ctx, start_time, fmt):
         try:
@@ -798,12 +2924,17 @@ class Gyms:
 
 
     async def start_raid(self, ctx, end_time, pokemon_name, gym_title):
+        with self.tracer.trace("start_raid", server=ctx.message.channel.server.id, channel=ctx.message.channel.id):
+            await self._start_raid(ctx, end_time, pokemon_name, gym_title)
+
+    async def _start_raid(self, ctx, end_time, pokemon_name, gym_title):
         gym = await self.find_gym(gym_title, ctx.message.channel)
         if not gym:
             await self.bot.say("Gym not found.")
             return
 
-        end_dt = await self.parse_time(ctx, end_time)
+        with self.tracer.span("parse"):
+            end_dt = await self.parse_time(ctx, end_time)
 
         if not end_dt:
             await self.bot.say(TIME_STRING)
@@ -827,46 +2958,287 @@ class Gyms:
             level = pokemon.raid_level
 
         gym = self.session.query(Gym).get(gym.meta['id'])
-        spawn_time = end_dt - HATCH_TIME - DESPAWN_TIME
-        existing_raid = self.session.query(Raid).filter(
-            Raid.done == False,
-            Raid.gym == gym,
-            Raid.end_time >= spawn_time,
-            Raid.end_time <= end_dt + HATCH_TIME + DESPAWN_TIME
-        ).first()
-        if existing_raid:
-            await self.bot.say("A raid on that gym is already ongoing.")
-            await self._raidhide(ctx, existing_raid.id, ctx.message.channel)
-            await self._raidmirror(ctx, existing_raid.id)
-            return
         raid = Raid(
             pokemon=pokemon,
             gym=gym,
             end_time=end_dt,
             start_time=start_dt,
-            level=level
+            level=level,
+            server_id=ctx.message.channel.server.id
         )
-        self.session.add(raid)
-        self.session.commit() # Required as we need raids ID in the embed
+        # Searches are done, from here on reports of the same gym are
+        # handled one at a time, until the embeds are posted so a second
+        # report can be pointed at them.
+        await self.create_raids([raid], lambda created, duplicates: self.post_raid(ctx, created, duplicates))
+
+    async def create_raids(self, raids, post):
+        # The only way raids are created. Takes the locks of the gyms of
+        # raids (new Raid rows), claims each gym's row and commits those
+        # raids that don't overlap one this shard already has there. Then
+        # awaits post(created, duplicates) with the gyms still locked, and
+        # returns what it returns. created are the new ActiveRaids,
+        # duplicates (raid row, existing raid id) pairs.
+        gym_ids = sorted(set(raid.gym.id for raid in raids))
+        locks = [self.gym_locks[gym_id] for gym_id in gym_ids] # In id order, so batches can't deadlock
+        for lock in locks:
+            await lock.acquire()
+        try:
+            rows = []
+            duplicates = []
+            for gym_id in gym_ids:
+                # No awaits between the claim and the commit, the session is shared.
+                try:
+                    self.claim_gym(gym_id)
+                    for raid in raids:
+                        if raid.gym.id != gym_id:
+                            continue
+                        existing = self.overlapping_raid(gym_id, raid.end_time)
+                        if existing is not None:
+                            duplicates.append((raid, existing.id))
+                            continue
+                        self.session.add(raid)
+                        rows.append(raid)
+                    self.session.commit() # Releases the gym row
+                except SQLAlchemyError:
+                    self.session.rollback()
+                    raise
+            if duplicates:
+                self.metric_raid_duplicates.inc(len(duplicates))
+            created = [ActiveRaid(raid) for raid in rows]
+            for raid in created:
+                self.store.add(raid)
+                self.publish_raid("raid", raid)
+            return await post(created, duplicates)
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def overlapping_raid(self, gym_id, end_dt):
+        # The raid a new one at gym_id ending at end_dt would duplicate.
+        # Only this shard's raids count, another shard's can't be shown or
+        # changed from here (see RaidStore) so its servers get their own.
+        rows = self.session.query(Raid).filter(
+            Raid.done == False,
+            Raid.gym_id == gym_id,
+            Raid.end_time >= end_dt - HATCH_TIME - DESPAWN_TIME,
+            Raid.end_time <= end_dt + HATCH_TIME + DESPAWN_TIME
+        ).order_by(Raid.id)
+        return next((row for row in rows if self.owns_server(row.server_id)), None)
+
+    async def post_raid(self, ctx, created, duplicates):
+        this_board = self.get_config(ctx.message.channel, "board", "no") == "yes"
+        if duplicates:
+            existing_id = duplicates[0][1]
+            await self.bot.say("A raid on that gym is already ongoing.")
+            if not this_board:
+                await self._raidhide(ctx, existing_id, ctx.message.channel)
+                await self._raidmirror(ctx, existing_id)
+            return
+        raid = created[0]
+        gym = raid.gym
 
-        embed, content = await self.prepare_raid_embed(ctx.message.channel, raid, include_role=True)
         tasks = []
-        tasks.append(self.bot.say(embed=embed, content=content))
-        this_channel = ctx.message.channel.id
+        if not this_board:
+            embed, content = await self.prepare_raid_embed(ctx.message.channel, raid, include_role=True)
+            tasks.append(self.bot.say(embed=embed, content=content))
+        channels_to_add_embed = self.mirror_channels(ctx.message.channel.server.id, gym, ctx.message.channel.id)
+        for channel in channels_to_add_embed:
+            embed, content = await self.prepare_raid_embed(channel, raid)
+            tasks.append(self.send_mirror(channel, embed, content))
+            
+        self.touch_boards(raid.server_id)
+        if this_board:
+            tasks.append(self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D")))
+        with self.tracer.span("post embeds"):
+            done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+        tasks = []
+        for task in done:
+            msg = task.result()
+            if msg is None:
+                continue
+            self.store.add_embed(raid, msg.channel.id, msg.id, getattr(msg, "webhook_id", None))
+            tasks.append(self.add_reactions(msg))
+
+        if tasks:
+            with self.tracer.span("add reactions"):
+                done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+            for task in done:
+                task.result() # This will cause errors to be raised correctly.
+        self.reschedule_next_end()
+        await self.log(ctx.message.channel.server, "{} created raid {}", ctx.message.author, raid.id)
+
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def raidingest(self, ctx):
+        """
+            Create raids from an attached NDJSON or CSV file. Each raid has
+            gym_id or latitude and longitude, end (UTC), optionally start,
+            and pokemon, pokemon_id or level.
+        """
+        if not ctx.message.attachments:
+            await self.bot.say("Attach an NDJSON or CSV file of raids.")
+            return
+        try:
+            response = await asyncio.wait_for(self.http_client().get(ctx.message.attachments[0]["url"]), WEBHOOK_TIMEOUT)
+            try:
+                response.raise_for_status()
+                text = await response.text()
+            finally:
+                response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await self.bot.say("Couldn't download the attachment: {}".format(e))
+            return
+        summary = await self.ingest_raids(ctx.message.server, parse_ingest_records(text))
+        await self.log(ctx.message.server, "{} ingested raids: {}", ctx.message.author, self.format_ingest(summary))
+        await self.bot.say(self.format_ingest(summary))
+
+    def format_ingest(self, summary):
+        return "{} created, {} updated, {} duplicates, {} unknown gyms, {} invalid, {} posts".format(
+            summary["created"], summary["updated"], summary["duplicates"],
+            summary["unresolved"], summary["invalid"], summary["posted"])
+
+    async def ingest_raids(self, server, records):
+        # Resolves and dedupes a batch of raids, creates them through
+        # create_raids and fans their mirror posts out together, without
+        # holding the gyms' locks. Returns a summary Counter.
+        summary = collections.Counter()
+        now = pytz.utc.localize(datetime.datetime.utcnow())
+        window = HATCH_TIME + DESPAWN_TIME
+        batch = collections.defaultdict(list) # gym id -> [new Raid rows]
+        pokemon_names = None
+        new = []
+        for record in records[:INGEST_MAX_RECORDS]:
+            if not isinstance(record, dict):
+                summary["invalid"] += 1
+                continue
+            gym = self.resolve_ingest_gym(record)
+            if gym is None:
+                summary["unresolved"] += 1
+                continue
+            try:
+                pokemon_id = int(record["pokemon_id"]) if record.get("pokemon_id") not in (None, "") else None
+                level = int(record["level"]) if record.get("level") not in (None, "") else None
+            except (TypeError, ValueError):
+                summary["invalid"] += 1
+                continue
+            pokemon = None
+            if pokemon_id is not None:
+                pokemon = self.session.query(Pokemon).get(pokemon_id)
+            elif record.get("pokemon"):
+                if pokemon_names is None:
+                    pokemon_names = {p.name.lower(): p for p in self.session.query(Pokemon)}
+                pokemon = pokemon_names.get(str(record["pokemon"]).lower())
+            end_dt = parse_ingest_time(record.get("end"))
+            if level is None and pokemon is not None:
+                level = pokemon.raid_level
+            if end_dt is None or (pokemon is None and level is None):
+                summary["invalid"] += 1
+                continue
+            start_dt = parse_ingest_time(record.get("start"))
+            if start_dt is None and pokemon is None:
+                start_dt = end_dt - DESPAWN_TIME # Hatch time
+            elif start_dt is None:
+                start_dt = min(max(now + datetime.timedelta(minutes=10), end_dt - DESPAWN_TIME), end_dt - datetime.timedelta(minutes=2))
+
+            # Repeats within the batch, raids already in the database are
+            # left to create_raids.
+            existing = next((raid for raid in batch[gym.id] if abs(raid.end_time - end_dt) <= window), None)
+            if existing is not None:
+                if existing.pokemon is None and pokemon is not None:
+                    existing.pokemon = pokemon
+                summary["duplicates"] += 1
+                continue
+            raid = Raid(pokemon=pokemon, gym=gym, end_time=end_dt, start_time=start_dt, level=level, server_id=server.id)
+            new.append(raid)
+            batch[gym.id].append(raid)
+
+        async def post(created, duplicates):
+            # Only applies hatches while the gyms are locked, the posts are
+            # fanned out once create_raids has released them.
+            updated = []
+            for raid, existing_id in duplicates:
+                existing = self.store.fetch(existing_id)
+                if existing is not None and existing.pokemon is None and raid.pokemon is not None:
+                    # The egg hatched since it was reported.
+                    self.store.update(existing, pokemon_id=raid.pokemon.id)
+                    existing.set_pokemon(raid.pokemon)
+                    self.publish_raid("raid", existing)
+                    updated.append(existing)
+                else:
+                    summary["duplicates"] += 1
+            summary["created"] = len(created)
+            summary["updated"] = len(updated)
+            return created, updated
+
+        created = []
+        if new:
+            created, updated = await self.create_raids(new, post)
+            summary["posted"] = await self.fan_out_raids(server, created, updated)
+        self.touch_boards(int(server.id))
+        if created:
+            self.reschedule_next_end()
+        return summary
+
+    def resolve_ingest_gym(self, record):
+        try:
+            if record.get("gym_id") not in (None, ""):
+                return self.session.query(Gym).get(int(record["gym_id"]))
+            if record.get("latitude") in (None, "") or record.get("longitude") in (None, ""):
+                return None
+            nearest = self.catalog.nearest(float(record["latitude"]), float(record["longitude"]), k=1, km=INGEST_MATCH_KM)
+        except (TypeError, ValueError):
+            return None
+        return self.session.query(Gym).get(nearest[0][1]) if nearest else None
+
+    async def fan_out_raids(self, server, raids, updated=()):
+        # Every mirror post of every new raid, and the edits of updated
+        # ones, scheduled together through one bounded pool.
+        pool = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+        async def post(raid, channel):
+            async with pool:
+                embed, content = await self.prepare_raid_embed(channel, raid)
+                msg = await self.send_mirror(channel, embed, content)
+                self.store.add_embed(raid, msg.channel.id, msg.id, getattr(msg, "webhook_id", None))
+                await self.add_reactions(msg)
+
+        async def edit(raid):
+            async with pool:
+                await self.update_embeds(raid)
+
+        tasks = [post(raid, channel) for raid in raids for channel in self.mirror_channels(server.id, raid.gym)]
+        tasks += [edit(raid) for raid in updated]
+        if not tasks:
+            return 0
+        done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+        posted = 0
+        for task in done:
+            if task.exception() is not None:
+                print("Failed to post an ingested raid:", repr(task.exception()))
+            else:
+                posted += 1
+        return posted
 
-        configs = self.session.query(ChannelConfig).filter_by(server_id=ctx.message.channel.server.id, key="mirror", value="yes")
-        channels_to_add_embed = set()
+    def mirror_channels(self, server_id, gym, exclude_channel_id=None):
+        # The channels of a server that get a copy of a raid at gym.
+        configs = self.session.query(ChannelConfig).filter_by(server_id=server_id, key="mirror", value="yes")
+        channels = set()
         for config in configs:
-            if str(config.channel_id) == this_channel:
+            if str(config.channel_id) == exclude_channel_id:
                 continue
             channel = self.get_channel(config.channel_id)
-            channels_to_add_embed.add(channel)
+            if channel is None or self.get_config(channel, "board", "no") == "yes":
+                continue
+            channels.add(channel)
 
-        configs = self.session.query(ChannelConfig).filter_by(server_id=ctx.message.channel.server.id, key="mirror_nearby", value="yes")
+        configs = self.session.query(ChannelConfig).filter_by(server_id=server_id, key="mirror_nearby", value="yes")
         for config in configs:
-            if str(config.channel_id) == this_channel:
+            if str(config.channel_id) == exclude_channel_id:
                 continue
             channel = self.get_channel(config.channel_id)
+            if channel is None or self.get_config(channel, "board", "no") == "yes":
+                continue
             location = self.get_config(channel, "location", None)
             if location is None:
                 continue
@@ -874,30 +3246,8 @@ class Gyms:
 
             if geopy.distance.vincenty((gym.latitude, gym.longitude), location).km > int(scale):
                 continue
-            channels_to_add_embed.add(channel)
-
-        for channel in channels_to_add_embed:
-            embed, content = await self.prepare_raid_embed(channel, raid)
-            tasks.append(self.bot.send_message(
-                channel,
-                embed=embed,
-                content=content))
-            
-        done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
-        tasks = []
-        for task in done:
-            msg = task.result()
-            embed = Embed(channel_id=msg.channel.id, message_id=msg.id, raid=raid)
-            self.session.add(embed)
-            tasks.append(self.add_reactions(msg))
-
-        done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
-        for task in done:
-            task.result() # This will cause errors to be raised correctly.
-        self.session.commit()
-        self.reschedule_next_end()
-        await self.log(ctx.message.channel.server, "{} created raid {}", ctx.message.author, raid.id)
-
+            channels.add(channel)
+        return channels
 
     @commands.command(pass_context=True)
     async def raidmirror(self, ctx, raid_id: int):
@@ -907,16 +3257,14 @@ class Gyms:
         await self._raidmirror(ctx, raid_id)
 
     async def _raidmirror(self, ctx, raid_id: int):
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
 
         embed, content = await self.prepare_raid_embed(ctx.message.channel, raid)
-        msg = await self.bot.say(embed=embed, content=content)
-        embed = Embed(channel_id=msg.channel.id, message_id=msg.id, raid=raid)
-        self.session.add(embed)
-        self.session.commit()
+        msg = await self.send_mirror(ctx.message.channel, embed, content)
+        self.store.add_embed(raid, msg.channel.id, msg.id, getattr(msg, "webhook_id", None))
         await self.add_reactions(msg)
 
     @commands.command(pass_context=True)
@@ -927,7 +3275,7 @@ class Gyms:
         await self._raidhide(ctx, raid_id, channel)
 
     async def _raidhide(self, ctx, raid_id: int, channel: discord.Channel = None):
-        raid = self.session.query(Raid).get(raid_id)
+        raid = self.store.fetch(raid_id)
         if raid is None:
             await self.bot.say("Raid not found")
             return
@@ -935,16 +3283,9 @@ class Gyms:
         if channel is None:
             channel = ctx.message.channel
 
-        embeds = self.session.query(Embed).filter_by(raid=raid, channel_id=channel.id)
-        tasks = []
-        for embed in embeds:
-            self.session.query(Embed).filter_by(id=embed.id).delete()
-            tasks.append(self.delete_message(embed))
-        if tasks:
-            self.session.commit()
-            done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
-            for task in done:
-                task.result() # This will cause errors to be raised correctly.
+        keys = [key for key in raid.embeds if key[0] == int(channel.id)]
+        self.store.remove_embeds(raid, keys)
+        await self.delete_messages(keys)
 
     @commands.command(pass_context=True)
     async def raid(self, ctx, time_remaining: str, pokemon_name: str, *, gym_title: str):
@@ -966,9 +3307,10 @@ class Gyms:
 
     async def find_role(self, server, role_name):
         role = None
-        for _role in server.roles:
-            if _role.name == role_name:
-                role = _role
+        with self.tracer.span("role scan"):
+            for _role in server.roles:
+                if _role.name == role_name:
+                    role = _role
         return role
 
     async def get_or_create_role(self, server, role_name):
@@ -1055,32 +3397,258 @@ class Gyms:
     @commands.command(pass_context=True)
     @checks.serverowner_or_permissions(administrator=True)
     async def redo_reactions(self, ctx):
-        from_time = datetime.datetime.utcnow() - datetime.timedelta(days=14)
-        raids = self.session.query(Raid).filter(Raid.start_time >= from_time)
-        count = raids.count()
-        progress_msg = await self.bot.say("Processing... 0 / {}".format(count))
+        """
+            Re-add the reactions to every raid embed of this server from the
+            last 14 days. Runs in the background, use `!raidjobs` to check on
+            it.
+        """
+        server_id = int(ctx.message.channel.server.id)
+        job = self.session.query(Job).filter_by(kind="redo_reactions", state="running", server_id=server_id).first()
+        if job is not None:
+            await self.bot.say("Already running, {}".format(self.format_job(job)))
+            return
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=14)
+        total = self.session.query(Raid).filter(Raid.server_id == server_id, Raid.start_time >= since).count()
+        progress_msg = await self.bot.say("Processing... 0 / {}".format(total))
+        job = Job(
+            kind="redo_reactions",
+            server_id=server_id,
+            channel_id=progress_msg.channel.id,
+            message_id=progress_msg.id,
+            since=since,
+            total=total
+        )
+        self.session.add(job)
+        self.session.commit()
+        self.start_job(job)
+
+    @commands.command(pass_context=True)
+    @checks.serverowner_or_permissions(administrator=True)
+    async def raidjobs(self, ctx):
+        """
+            Show the status of this server's background jobs
+        """
+        jobs = self.session.query(Job).filter_by(server_id=int(ctx.message.channel.server.id)).order_by(Job.id.desc()).limit(5)
+        lines = [self.format_job(job) for job in jobs]
+        if not lines:
+            await self.bot.say("No jobs.")
+            return
+        await self.bot.say("\n".join(lines))
+
+    @commands.command(pass_context=True)
+    @checks.serverowner_or_permissions(administrator=True)
+    async def raidjobcancel(self, ctx, job_id: int):
+        """
+            Cancel a running background job
+        """
+        job = self.session.query(Job).get(job_id)
+        if job is None or job.state != "running" or job.server_id != int(ctx.message.channel.server.id):
+            await self.bot.say("Job not found")
+            return
+        task = self.job_tasks.pop(job.id, None)
+        if task is not None:
+            task.cancel()
+        job.state = "cancelled"
+        self.session.add(job)
+        self.session.commit()
+        await self.add_reaction(ctx.message, self.get_config(ctx.message.channel, "emoji_command", u"\U0001F44D"))
+
+    def format_job(self, job):
+        return "job {} ({}) {}: {} / {}".format(job.id, job.kind, job.state, job.processed, job.total)
+
+    def start_job(self, job):
+        task = self.bot.loop.create_task(self.run_redo_reactions(job))
+        self.job_tasks[job.id] = task
+        task.add_done_callback(lambda t: self.job_tasks.pop(job.id, None))
+
+    async def resume_jobs(self):
+        await self.bot.wait_until_ready()
+        for job in self.session.query(Job).filter_by(state="running"):
+            if job.id not in self.job_tasks and self.owns_server(job.server_id):
+                self.start_job(job)
+
+    async def report_job(self, job, content):
+        channel = self.get_channel(job.channel_id)
+        if channel is None:
+            return
+        try:
+            message = await self.get_message(channel, job.message_id)
+            await self.bot.edit_message(message, content)
+        except discord.errors.HTTPException:
+            pass
+
+    async def redo_channel_reactions(self, channel, embeds, semaphore, dead):
+        async with semaphore:
+            for embed in embeds:
+                try:
+                    message = await self.get_message(channel, embed.message_id)
+                except discord.errors.NotFound:
+                    message = None
+                if message is None:
+                    dead.append(embed)
+                    continue
+                try:
+                    await self.bot.clear_reactions(message)
+                    await self.add_reactions(message)
+                except discord.errors.NotFound:
+                    dead.append(embed)
+                except discord.errors.Forbidden:
+                    continue
+
+    async def run_redo_reactions(self, job):
+        # Raids are processed in id order in batches, each batch fans out
+        # across channels and is checkpointed so a restart resumes here.
+        semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
         last_time = time.time()
-        i = 0
-        for raid in raids:
-            embeds = self.session.query(Embed).filter_by(raid=raid)
+        while True:
+            self.store.apply()
+            raids = self.session.query(Raid).filter(
+                Raid.server_id == job.server_id,
+                Raid.start_time >= job.since,
+                Raid.id > job.cursor
+            ).order_by(Raid.id).limit(JOB_BATCH_SIZE).all()
+            if not raids:
+                break
+            by_channel = {}
+            dead = []
+            embeds = self.session.query(Embed).filter(Embed.raid_id.in_([raid.id for raid in raids]))
             for embed in embeds:
-                if time.time() - last_time > 10:
-                    await self.bot.edit_message(progress_msg, "Processing... {} / {}".format(i, count))
-                    last_time = time.time()
-                channel = self.get_channel(embed.channel_id)
+                by_channel.setdefault(embed.channel_id, []).append(embed)
+            tasks = []
+            for channel_id, channel_embeds in by_channel.items():
+                channel = self.get_channel(channel_id)
                 if channel is None:
-                    self.session.query(Embed).filter_by(id=embed.id).delete()
+                    dead.extend(channel_embeds)
                     continue
-                message = await self.get_message(channel, embed.message_id)
-                if message is None:
-                    self.session.query(Embed).filter_by(id=embed.id).delete()
-                    continue
-                await self.bot.clear_reactions(message)
-                await self.add_reactions(message)
-            i = i + 1
+                tasks.append(self.redo_channel_reactions(channel, channel_embeds, semaphore, dead))
+            if tasks:
+                done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+                for task in done:
+                    task.result() # This will cause errors to be raised correctly.
+            if dead:
+                self.session.query(Embed).filter(Embed.id.in_([embed.id for embed in dead])).delete(synchronize_session=False)
+                for embed in dead:
+                    if embed.raid_id in self.store.raids:
+                        self.store.forget_embed(self.store.raids[embed.raid_id], embed.channel_id, embed.message_id)
+            job.cursor = raids[-1].id
+            job.processed += len(raids)
+            self.session.add(job)
+            self.session.commit()
+            if time.time() - last_time > JOB_PROGRESS_INTERVAL:
+                await self.report_job(job, "Processing... {} / {}".format(job.processed, job.total))
+                last_time = time.time()
+        job.state = "done"
+        self.session.add(job)
         self.session.commit()
-        await self.bot.edit_message(message, "Processing... {} / {}".format(count, count))
-        await self.bot.say("Done")
+        await self.report_job(job, "Processing... {} / {}".format(job.processed, job.total))
+        channel = self.get_channel(job.channel_id)
+        if channel is not None:
+            await self.bot.send_message(channel, "Done")
+
+    def load_boards(self):
+        for config in self.session.query(ChannelConfig).filter_by(key="board_message"):
+            self.boards[int(config.channel_id)] = int(config.value)
+
+    def touch_boards(self, server_id):
+        if server_id is not None:
+            self.board_dirty.add(int(server_id))
+
+    async def board_loop(self):
+        # Boards are redrawn at most once per BOARD_INTERVAL, however many
+        # raids changed in between.
+        while True:
+            await asyncio.sleep(BOARD_INTERVAL)
+            dirty, self.board_dirty = self.board_dirty, set()
+            for server_id in dirty:
+                # Any error only skips this server until the next tick, the
+                # loop is the only thing redrawing boards.
+                try:
+                    configs = self.session.query(ChannelConfig).filter_by(server_id=server_id, key="board", value="yes").all()
+                except SQLAlchemyError as e:
+                    self.session.rollback()
+                    print("Failed to find raid boards of server", server_id, repr(e))
+                    self.board_dirty.add(server_id)
+                    continue
+                for config in configs:
+                    channel = self.get_channel(config.channel_id)
+                    if channel is None:
+                        continue
+                    try:
+                        await self.update_board(channel)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        print("Failed to update raid board", channel.id, repr(e))
+                        traceback.print_exc()
+                        self.board_dirty.add(server_id)
+
+    def board_raids(self, channel):
+        # The raids a board shows are the ones its channel would mirror.
+        raids = self.store.raids.values()
+        location = self.get_config(channel, "location", "")
+        if self.get_config(channel, "mirror_nearby", "no") == "yes" and RE_COORDINATES.match(location):
+            latitude, longitude = [float(x) for x in RE_COORDINATES.match(location).groups()]
+            raids = [raid for distance, raid in self.store.grid.near(latitude, longitude, float(self.get_config(channel, "scale", "2")))]
+        now = datetime.datetime.utcnow()
+        server_id = int(channel.server.id)
+        raids = [
+            raid for raid in raids
+            if not raid.done and raid.end_time > now and raid.server_id is not None and int(raid.server_id) == server_id
+        ]
+        raids.sort(key=lambda raid: raid.end_time)
+        return raids
+
+    def prepare_board_embed(self, channel, raids, page):
+        pages = max(1, (len(raids) + BOARD_PAGE_SIZE - 1) // BOARD_PAGE_SIZE)
+        page = max(0, min(page, pages - 1))
+        lines = []
+        for raid in raids[page * BOARD_PAGE_SIZE:(page + 1) * BOARD_PAGE_SIZE]:
+            boss = raid.pokemon.name if raid.pokemon is not None else "Level {}".format(raid.level)
+            lines.append("**#{}** [{}](https://www.google.com/maps/dir/Current+Location/{},{}) - {}\nStart {} | Despawns {} | {} going".format(
+                raid.id, raid.gym.title, raid.gym.latitude, raid.gym.longitude, boss,
+                self.format_time(channel, raid.start_time), self.format_time(channel, raid.end_time),
+                len(raid.going) + sum(raid.going.values())))
+        description = "\n".join(lines) or "No active raids"
+        footer = "Page {}/{}. Use !raidgoing <raid id> to join a raid.".format(page + 1, pages)
+        embed = discord.Embed(title="Active raids ({})".format(len(raids)), description=description)
+        embed.set_footer(text=footer)
+        return embed, page, (len(raids), description, footer)
+
+    async def update_board(self, channel):
+        channel_id = int(channel.id)
+        embed, page, rendered = self.prepare_board_embed(channel, self.board_raids(channel), self.board_pages.get(channel_id, 0))
+        self.board_pages[channel_id] = page
+        if self.board_rendered.get(channel_id) == rendered:
+            self.metric_board_renders.inc(result="unchanged")
+            return
+        message_id = self.boards.get(channel_id)
+        if message_id is not None:
+            try:
+                message = await self.get_message(channel, message_id)
+                await self.bot.edit_message(message, embed=embed)
+                self.board_rendered[channel_id] = rendered
+                self.metric_board_renders.inc(result="edited")
+                return
+            except discord.errors.NotFound:
+                pass
+        message = await self.bot.send_message(channel, embed=embed)
+        self.boards[channel_id] = int(message.id)
+        self.board_rendered[channel_id] = rendered
+        self.set_channel_config(channel.server.id, channel.id, "board_message", message.id)
+        self.metric_board_renders.inc(result="posted")
+        await self.bot.add_reaction(message, BOARD_PREVIOUS)
+        await self.bot.add_reaction(message, BOARD_NEXT)
+
+    async def flip_board(self, channel_id, emoji):
+        # Adding or removing either arrow turns the page.
+        if emoji not in (BOARD_PREVIOUS, BOARD_NEXT):
+            return
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            return
+        page = self.board_pages.get(int(channel_id), 0)
+        self.board_pages[int(channel_id)] = page + 1 if emoji == BOARD_NEXT else page - 1
+        await self.update_board(channel)
 
     async def add_reaction(self, msg, emoji):
         emoji = self.get_emoji(emoji)
@@ -1095,43 +3663,276 @@ class Gyms:
         await self.add_reaction(msg, self.get_config(msg.channel, "emoji_done", u"\U00002705"))
 
     async def get_message(self, channel, message_id):
-        # Load message from cache, otherwise fetch it.
-        message = discord.utils.get(self.bot.messages, id=id)
-        return message if message else await self.bot.get_message(channel, message_id)
-
-    async def update_embed(self, embed, raid):
-        channel = self.get_channel(embed.channel_id)
-        message = await self.get_message(channel, embed.message_id)
+        # Load message from cache, otherwise fetch it and add it to the
+        # cache, where the client keeps its reactions up to date.
+        message = discord.utils.get(self.bot.messages, id=str(message_id))
+        if message is None:
+            message = await self.bot.get_message(channel, message_id)
+            self.bot.messages.append(message)
+        return message
+
+    async def update_embed(self, channel_id, message_id, raid):
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            return
+        webhook_id = raid.webhooks.get((int(channel_id), int(message_id)))
+        if webhook_id is not None:
+            # Only the webhook can edit what it posted, by id.
+            discord_embed, content = await self.prepare_raid_embed(channel, raid)
+            webhook = self.webhooks.get(int(channel_id)) or await self.get_webhook(channel)
+            if webhook is None or webhook[0] != webhook_id:
+                return
+            try:
+                await self.webhook_request(webhook, "PATCH", "/messages/{}".format(message_id), {"embeds": [discord_embed.to_dict()]})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("Failed to edit webhook message", channel_id, message_id, repr(e))
+            return
+        message = await self.get_message(channel, message_id)
         discord_embed, content = await self.prepare_raid_embed(channel, raid)
         await self.bot.edit_message(message, embed=discord_embed)
 
-    async def delete_message(self, embed):
-        channel = self.get_channel(embed.channel_id)
-        message = await self.get_message(channel, embed.message_id)
-        await self.bot.delete_message(message)
+    async def send_mirror(self, channel, embed, content=None):
+        # mirror_webhook channels post through their own webhook, which
+        # Discord rate limits separately from the bot, falling back to the
+        # bot when there is no webhook.
+        if self.mirror_flags(channel)[1]:
+            webhook = await self.get_webhook(channel)
+            if webhook is not None:
+                payload = {
+                    "content": content,
+                    "embeds": [embed.to_dict()],
+                    "username": self.bot.user.name,
+                    "avatar_url": getattr(self.bot.user, "avatar_url", None) or None,
+                }
+                try:
+                    data = await self.webhook_request(webhook, "POST", "?wait=true", payload)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print("Failed to post through webhook in", channel.id, repr(e))
+                    data = None
+                if data:
+                    return WebhookMessage(data["id"], channel, webhook[0])
+        return await self.bot.send_message(channel, embed=embed, content=content)
+
+    def http_client(self):
+        if self.client_session is None:
+            self.client_session = aiohttp.ClientSession(loop=self.bot.loop)
+        return self.client_session
+
+    async def get_webhook(self, channel):
+        channel_id = int(channel.id)
+        if channel_id not in self.webhooks:
+            row = self.session.query(Webhook).filter_by(channel_id=channel_id).first()
+            self.webhooks[channel_id] = (row.webhook_id, row.token) if row is not None else None
+        if self.webhooks[channel_id] is not None:
+            return self.webhooks[channel_id]
+        if time.monotonic() - self.webhook_failed.get(channel_id, -WEBHOOK_CREATE_RETRY) < WEBHOOK_CREATE_RETRY:
+            return None
+        async with self.webhook_locks[("create", channel_id)]:
+            if self.webhooks.get(channel_id) is None:
+                self.webhooks[channel_id] = await self.create_webhook(channel)
+        return self.webhooks[channel_id]
+
+    async def create_webhook(self, channel):
+        url = "{}/channels/{}/webhooks".format(DISCORD_API, channel.id)
+        headers = {"Authorization": "Bot {}".format(self.bot.http.token)}
+        try:
+            with self.metric_discord.time(kind="POST /channels/{channel_id}/webhooks"):
+                response = await asyncio.wait_for(
+                    self.http_client().post(url, json={"name": WEBHOOK_NAME}, headers=headers), WEBHOOK_TIMEOUT)
+            try:
+                response.raise_for_status()
+                data = await response.json()
+            finally:
+                response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print("Failed to create a webhook in", channel.id, repr(e))
+            self.webhook_failed[int(channel.id)] = time.monotonic()
+            return None
+        webhook = (int(data["id"]), data["token"])
+        try:
+            self.session.add(Webhook(channel_id=int(channel.id), webhook_id=webhook[0], token=webhook[1]))
+            self.session.commit()
+        except IntegrityError:
+            # Another shard made one first, use theirs.
+            self.session.rollback()
+            row = self.session.query(Webhook).filter_by(channel_id=int(channel.id)).one()
+            webhook = (row.webhook_id, row.token)
+        return webhook
+
+    def forget_webhook(self, webhook_id):
+        for channel_id, webhook in list(self.webhooks.items()):
+            if webhook is not None and webhook[0] == webhook_id:
+                self.webhooks[channel_id] = None
+        self.session.query(Webhook).filter_by(webhook_id=webhook_id).delete()
+        self.session.commit()
+
+    async def webhook_request(self, webhook, method, path, payload):
+        # Requests through one webhook go one at a time and wait out its
+        # rate limit bucket. Returns the decoded response, or None when
+        # the webhook has been deleted (the next post makes a new one) or
+        # stayed rate limited.
+        webhook_id, token = webhook
+        url = "{}/webhooks/{}/{}{}".format(DISCORD_API, webhook_id, token, path)
+        self.inflight_requests += 1
+        try:
+            return await self._webhook_request(webhook_id, url, method, payload)
+        finally:
+            self.inflight_requests -= 1
+
+    async def _webhook_request(self, webhook_id, url, method, payload):
+        async with self.webhook_locks[webhook_id]:
+            for attempt in range(WEBHOOK_RETRIES):
+                delay = self.webhook_resets.get(webhook_id, 0) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                with self.metric_discord.time(kind="{} /webhooks/{{webhook_id}}".format(method)):
+                    response = await asyncio.wait_for(
+                        self.http_client().request(method, url, json=payload), WEBHOOK_TIMEOUT)
+                try:
+                    if response.headers.get("X-RateLimit-Remaining") == "0":
+                        self.webhook_resets[webhook_id] = time.monotonic() + float(response.headers.get("X-RateLimit-Reset-After", 1))
+                    if response.status == 429:
+                        self.webhook_resets[webhook_id] = time.monotonic() + float(response.headers.get("Retry-After", 1))
+                        continue
+                    if response.status == 404:
+                        data = await response.json()
+                        if data.get("code") == DISCORD_UNKNOWN_WEBHOOK:
+                            self.forget_webhook(webhook_id)
+                        return None
+                    response.raise_for_status()
+                    if response.status == 204:
+                        return {}
+                    return await response.json()
+                finally:
+                    response.release()
+        return None
+
+    async def delete_messages(self, keys):
+        # keys are (channel_id, message_id), deleted by id without fetching
+        # the messages, with the channels done concurrently.
+        by_channel = collections.OrderedDict()
+        for channel_id, message_id in keys:
+            by_channel.setdefault(int(channel_id), []).append(int(message_id))
+        tasks = [self.delete_channel_messages(channel_id, message_ids) for channel_id, message_ids in by_channel.items()]
+        if tasks:
+            done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+            for task in done:
+                task.result() # This will cause errors to be raised correctly.
+
+    async def delete_channel_messages(self, channel_id, message_ids):
+        # Several recent messages go in one bulk delete when we're allowed
+        # to, anything else is deleted one at a time.
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            return
+        guild_id = channel.server.id
+        single = message_ids
+        if len(message_ids) > 1 and channel.permissions_for(channel.server.me).manage_messages:
+            oldest = (time.time() - BULK_DELETE_MAX_AGE) * 1000 - DISCORD_EPOCH_MS
+            recent = [message_id for message_id in message_ids if (message_id >> 22) > oldest]
+            single = [message_id for message_id in message_ids if (message_id >> 22) <= oldest]
+            for i in range(0, len(recent), BULK_DELETE_MAX):
+                chunk = [str(message_id) for message_id in recent[i:i + BULK_DELETE_MAX]]
+                try:
+                    if len(chunk) == 1:
+                        await self.bot.http.delete_message(channel.id, chunk[0], guild_id)
+                    else:
+                        await self.bot.http.delete_messages(channel.id, chunk, guild_id)
+                except discord.errors.NotFound:
+                    pass
+                except discord.errors.HTTPException:
+                    single.extend(int(message_id) for message_id in chunk)
+        for message_id in single:
+            try:
+                await self.bot.http.delete_message(channel.id, str(message_id), guild_id)
+            except discord.errors.NotFound:
+                print("Message not found!", channel.id, message_id)
 
     async def update_embeds(self, raid):
-        embeds = self.session.query(Embed).filter_by(raid=raid)
+        self.touch_boards(raid.server_id)
+        keys = list(raid.embeds)
+        level = self.shed_level()
+        if level and len(keys) > 1:
+            # Under load only the embed that was reacted to and the ones
+            # outside mirror channels are edited now, mirrors catch up later.
+            reacted = REACTED_EMBED.get()
+            now = [key for key in keys if key == reacted or not self.is_mirror(key[0])]
+            if len(now) < len(keys):
+                self.defer_mirror_edits(raid, level)
+                keys = now
         tasks = []
-        for embed in embeds:
-            tasks.append(self.update_embed(embed, raid))
+        for channel_id, message_id in keys:
+            tasks.append(self.update_embed(channel_id, message_id, raid))
+        self.metric_embeds_per_update.observe(len(tasks))
         if tasks:
             await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+        started = EVENT_STARTED.get()
+        if started is not None:
+            self.metric_reaction_edit.observe(time.perf_counter() - started)
+
+    def is_mirror(self, channel_id):
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            return False
+        return self.mirror_flags(channel)[0]
+
+    def mirror_flags(self, channel):
+        # Checked for every embed edited under load, so cached until the
+        # channel's or server's config changes.
+        channel_id = int(channel.id)
+        flags = self.mirror_flags_cache.get(channel_id)
+        if flags is None:
+            flags = (
+                self.get_config(channel, "mirror", "no") == "yes" or self.get_config(channel, "mirror_nearby", "no") == "yes",
+                self.get_config(channel, "mirror_webhook", "no") == "yes",
+            )
+            self.mirror_flags_cache[channel_id] = flags
+        return flags
+
+    def defer_mirror_edits(self, raid, level):
+        self.metric_shed.inc(action="defer_mirror_edits")
+        self.deferred_edits[raid.id] = raid
+        if self.deferred_task is None or self.deferred_task.done():
+            self.deferred_task = self.bot.loop.create_task(self.flush_deferred_edits(SHED_EDIT_DELAY * level))
+
+    async def flush_deferred_edits(self, delay):
+        # However many changes a raid had in the meantime, its mirrors are
+        # edited once.
+        await asyncio.sleep(delay)
+        raids = list(self.deferred_edits.values())
+        self.deferred_edits.clear()
+        tasks = [
+            self.update_embed(channel_id, message_id, raid)
+            for raid in raids for channel_id, message_id in list(raid.embeds) if self.is_mirror(channel_id)
+        ]
+        if tasks:
+            done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    print("Failed to update a mirror embed:", repr(task.exception()))
+
+    def shed_level(self):
+        # 0 normal, 1 busy, 2 overloaded.
+        pressure = max(
+            self.inflight_events / SHED_EVENTS,
+            self.inflight_requests / SHED_REQUESTS,
+            self.log_writer.backlog() / SHED_LOG_LINES,
+        )
+        level = 2 if pressure >= 2 else 1 if pressure >= 1 else 0
+        self.metric_shed_level.set(level)
+        return level
 
     async def mark_going(self, channel, member_setting, members, raid, extra=0):
         if not isinstance(members, list):
             members = [[members, extra]]
 
         for member, extra in members:
-            try:
-                going = self.session.query(Going).filter_by(raid=raid, user_id=member.id).one()
+            if int(member.id) in raid.going:
                 return
-            except NoResultFound:
-                pass
 
             await self.subscribe(channel, member, "Raid #{}".format(raid.id), True)
-            going = Going(raid=raid, user_id=member.id, extra=extra)
-            self.session.add(going)
+            self.store.set_going(raid, member.id, extra)
+        self.publish_raid("going", raid)
 
         await self.log(
             channel.server,
@@ -1141,7 +3942,6 @@ class Gyms:
             raid.id
         )
 
-        self.session.commit()        
         await self.update_embeds(raid)
 
     async def mark_not_going(self, channel, member_setting, members, raid):
@@ -1150,11 +3950,9 @@ class Gyms:
 
         for member in members:
             await self.unsubscribe(channel, member, "Raid #{}".format(raid.id), True)
-            try:
-                going = self.session.query(Going).filter_by(raid=raid, user_id=member.id).one()
-                self.session.query(Going).filter_by(raid=raid, user_id=member.id).delete()
-            except NoResultFound:
-                continue
+            if int(member.id) in raid.going:
+                self.store.remove_going(raid, member.id)
+        self.publish_raid("going", raid)
         await self.log(
             channel.server,
             "{} removed {} from raid {}",
@@ -1165,108 +3963,103 @@ class Gyms:
         await self.update_embeds(raid)
 
     async def toggle_going(self, channel, member_setting, member, raid):
-        try:
-            going = self.session.query(Going).filter_by(raid=raid, user_id=member.id).one()
+        if int(member.id) in raid.going:
             await self.mark_not_going(channel, member_setting, member, raid)
-        except NoResultFound:
+        else:
             await self.mark_going(channel, member_setting, member, raid)
 
     async def on_raw_reaction(self, emoji, message_id, channel_id, user_id):
+        if user_id == self.bot.user.id:
+            return
+        if self.boards.get(int(channel_id)) == int(message_id):
+            await self.flip_board(channel_id, emoji)
+            return
+        raid = self.store.fetch_by_message(channel_id, message_id)
+        if raid is None:
+            return
         channel = self.get_channel(channel_id)
+        if channel is None:
+            return
         message = await self.get_message(channel, message_id)
         member = channel.server.get_member(user_id)
         emoji = self.get_emoji_by_name(emoji)
 
-        if message.author == self.bot.user and user_id != self.bot.user.id:
+        emoji_going = self.get_emoji(self.get_config(channel, "emoji_going", u"\U0001F44D"))
+        emoji_plus1 = self.get_emoji(self.get_config(channel, "emoji_plus1", u"\U00002B06"))
+        emoji_minus1 = self.get_emoji(self.get_config(channel, "emoji_minus1", u"\U00002B07"))
+        emoji_add_time = self.get_emoji(self.get_config(channel, "emoji_add_time", u"\U000023E9"))
+        emoji_remove_time = self.get_emoji(self.get_config(channel, "emoji_remove_time", u"\U000023EA"))
+        emoji_done = self.get_emoji(self.get_config(channel, "emoji_done", u"\U00002705"))
+        emojis = [emoji_going, emoji_plus1, emoji_minus1, emoji_add_time, emoji_remove_time, emoji_done]
+        for reaction in message.reactions:
             try:
-                embed = self.session.query(Embed).filter_by(channel_id=channel_id, message_id=message_id).one()
-            except NoResultFound:
+                emojis.remove(reaction.emoji)
+            except ValueError:
+                pass
+        if emojis and self.shed_level():
+            self.metric_shed.inc(action="skip_reaction_repair")
+        elif emojis:
+            await self.bot.clear_reactions(message)
+            await self.add_reactions(message)
+
+        if emoji == emoji_going:
+            await self.toggle_going(channel, member, member, raid)
+        elif emoji in [emoji_plus1, emoji_minus1]:
+            extra = raid.going.get(int(user_id))
+            if extra is None:
                 return
-            
-            if embed is None:
+            if emoji == emoji_plus1:
+                extra += 1
+                await self.log(channel.server, "{} added a +1 (now {}) on raid {}", member, extra, raid.id)
+            elif extra == 0:
                 return
-
-            emoji_going = self.get_emoji(self.get_config(channel, "emoji_going", u"\U0001F44D"))
-            emoji_plus1 = self.get_emoji(self.get_config(channel, "emoji_plus1", u"\U00002B06"))
-            emoji_minus1 = self.get_emoji(self.get_config(channel, "emoji_minus1", u"\U00002B07"))
-            emoji_add_time = self.get_emoji(self.get_config(channel, "emoji_add_time", u"\U000023E9"))
-            emoji_remove_time = self.get_emoji(self.get_config(channel, "emoji_remove_time", u"\U000023EA"))
-            emoji_done = self.get_emoji(self.get_config(channel, "emoji_done", u"\U00002705"))
-            emojis = [emoji_going, emoji_plus1, emoji_minus1, emoji_add_time, emoji_remove_time, emoji_done]
-            for reaction in message.reactions:
-                try:
-                    emojis.remove(reaction.emoji)
-                except ValueError:
-                    pass
-            if len(emojis) > 0:
-                await self.bot.clear_reactions(message)
-                await self.add_reactions(message)
-
-            if emoji == emoji_going:
-                await self.toggle_going(channel, member, member, embed.raid)
-            elif emoji in [emoji_plus1, emoji_minus1]:
-                try:
-                    going = self.session.query(Going).filter_by(raid=embed.raid, user_id=user_id).one()
-                except NoResultFound:
-                    return
-                if emoji == emoji_plus1:
-                    going.extra = going.extra + 1
-                    await self.log(channel.server, "{} added a +1 (now {}) on raid {}", member, going.extra, embed.raid.id)
-                elif going.extra == 0:
-                    return
-                else:
-                    going.extra = going.extra - 1
-                    await self.log(channel.server, "{} removed a +1 (now {}) on raid {}", member, going.extra, embed.raid.id)
-                self.session.add(going)
-                self.session.commit()
-                await self.update_embeds(embed.raid)
-
-            elif emoji in [emoji_add_time, emoji_remove_time]:
-                raid = embed.raid
-                old_start_time = raid.start_time
-                if emoji == emoji_add_time:
-                    raid.start_time += datetime.timedelta(minutes=int(self.get_config(channel, "edit_time", 5)))
-                else:
-                    raid.start_time -= datetime.timedelta(minutes=int(self.get_config(channel, "edit_time", 5)))
-                self.session.add(raid)
-                self.session.commit()
-                await self.update_embeds(embed.raid)
-                await self.log(channel.server, "{} changed start on raid {} from {} to {}", member, raid.id, old_start_time, raid.start_time)
-            elif emoji == emoji_done and self.check_permissions(channel, member, {"manage_messages": True}):
-                raid = embed.raid
-                self.session.add(raid)
-                self.session.commit()
-                if not raid.done:
-                    await self.mark_done(raid, member)
-                else:
-                    raid.done = False
-                    embeds = self.session.query(Embed).filter_by(raid=raid)
-                    await self.update_embeds(raid)
+            else:
+                extra -= 1
+                await self.log(channel.server, "{} removed a +1 (now {}) on raid {}", member, extra, raid.id)
+            self.store.set_going(raid, user_id, extra)
+            self.publish_raid("going", raid)
+            await self.update_embeds(raid)
+
+        elif emoji in [emoji_add_time, emoji_remove_time]:
+            old_start_time = raid.start_time
+            if emoji == emoji_add_time:
+                start_time = raid.start_time + datetime.timedelta(minutes=int(self.get_config(channel, "edit_time", 5)))
+            else:
+                start_time = raid.start_time - datetime.timedelta(minutes=int(self.get_config(channel, "edit_time", 5)))
+            self.store.update(raid, start_time=start_time)
+            self.publish_raid("time", raid)
+            await self.update_embeds(raid)
+            await self.log(channel.server, "{} changed start on raid {} from {} to {}", member, raid.id, old_start_time, raid.start_time)
+        elif emoji == emoji_done and self.check_permissions(channel, member, {"manage_messages": True}):
+            if not raid.done:
+                await self.mark_done(raid, member)
+            else:
+                self.store.update(raid, done=False)
+                self.publish_raid("raid", raid)
+                await self.update_embeds(raid)
+                tasks = []
+                configs = self.session.query(ChannelConfig).filter_by(server_id=channel.server.id, key="delete_on_done")
+                for config in configs:
+                    ch = config.channel_id
+                    ch_obj = self.get_channel(ch)
+                    embed, content = await self.prepare_raid_embed(ch_obj, raid)
+                    tasks.append(self.bot.send_message(
+                        ch_obj,
+                        embed=embed,
+                        content=content))
+
+                if tasks:
+                    done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
                     tasks = []
-                    configs = self.session.query(ChannelConfig).filter_by(server_id=channel.server.id, key="delete_on_done")
-                    for config in configs:
-                        ch = config.channel_id
-                        ch_obj = self.get_channel(ch)
-                        embed, content = await self.prepare_raid_embed(ch_obj, raid)
-                        tasks.append(self.bot.send_message(
-                            ch_obj,
-                            embed=embed,
-                            content=content))
-
-                    if tasks:
-                        done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
-                        tasks = []
-                        for task in done:
-                            msg = task.result()
-                            embed = Embed(channel_id=msg.channel.id, message_id=msg.id, raid=raid)
-                            self.session.add(embed)
-                            tasks.append(self.add_reactions(msg))
-                        
-                        done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
-                        for task in done:
-                            task.result() # This will cause errors to be raised correctly.
-                    self.session.commit()
-                    await self.log(channel.server, "{} marked raid {} not as done", member, raid.id)
+                    for task in done:
+                        msg = task.result()
+                        self.store.add_embed(raid, msg.channel.id, msg.id)
+                        tasks.append(self.add_reactions(msg))
+
+                    done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+                    for task in done:
+                        task.result() # This will cause errors to be raised correctly.
+                await self.log(channel.server, "{} marked raid {} not as done", member, raid.id)
 
     def check_permissions(self, channel, author, perms):
         if not perms:
@@ -1275,87 +4068,548 @@ class Gyms:
         resolved = channel.permissions_for(author)
         return all(getattr(resolved, name, None) == value for name, value in perms.items())
 
-    async def mark_done(self, raid, member=None):
+    def claim_done(self, raid):
+        # Atomically flip done, so when several processes race to expire a
+        # raid only one of them goes on to clean it up. Queued writes go
+        # first so an older done=False can't land on top of this.
+        self.store.apply()
+        claimed = self.session.query(Raid).filter(Raid.id == raid.id, Raid.done == False).update(
+            {"done": True, "cleaned": False}, synchronize_session=False)
+        self.session.commit()
         raid.done = True
-        embeds = self.session.query(Embed).filter_by(raid=raid)
+        self.store.index(raid)
+        return claimed == 1
+
+    def claim_gym(self, gym_id):
+        # Bumping raid_seq takes the gym's row lock (the database write lock
+        # on SQLite) until the session commits, so other processes creating
+        # a raid on this gym wait here and then see this one's raid in their
+        # overlap check. Queued writes go first so done flags are current.
+        self.store.apply()
+        self.session.query(Gym).filter(Gym.id == gym_id).update(
+            {"raid_seq": func.coalesce(Gym.raid_seq, 0) + 1}, synchronize_session=False)
+
+    async def mark_done(self, raid, member=None):
+        if not self.claim_done(raid):
+            return False
+        self.publish_raid("done", raid)
+        await self.clean_up_done(raid)
+        if member:
+            await self.log(member.server, "{} marked raid {} as done", member, raid.id)
+        return True
+
+    async def clean_up_done(self, raid):
+        # Deletes the raid's role and, where configured, its embeds. Until
+        # it has finished, cleaned stays False and expire_raids retries it.
         tasks = []
         servers = []
-        for embed in embeds:
-            embed_channel = self.get_channel(embed.channel_id)
-            if embed_channel is None:
-                #self.session.query(Embed).filter_by(id=embed.id).delete()
+        keys = []
+        for channel_id, message_id in list(raid.embeds):
+            channel = self.get_channel(channel_id)
+            if channel is None:
                 continue
-            channel = self.get_channel(embed.channel_id)
             if channel.server not in servers:
                 servers.append(channel.server)
                 role = await self.find_role(channel.server, "Raid #{}".format(raid.id))
                 if role is not None:
                     tasks.append(self.bot.delete_role(channel.server, role))
-            if self.get_config(embed_channel, "delete_on_done", "no") == "no":
+            if self.get_config(channel, "delete_on_done", "no") == "no":
                 continue
-            self.session.query(Embed).filter_by(id=embed.id).delete()
-            tasks.append(self.delete_message(embed))
+            keys.append((channel_id, message_id))
+        if keys:
+            self.store.remove_embeds(raid, keys)
+            tasks.append(self.delete_messages(keys))
         if tasks:
-            self.session.commit()
             done, not_done = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
             for task in done:
                 task.result() # This will cause errors to be raised correctly.
-        self.session.add(raid)
-        self.session.commit()
         await self.update_embeds(raid)
-        if member:
-            await self.log(member.server, "{} marked raid {} as done", member, raid.id)
+        self.store.persist(lambda session: session.query(Raid).filter(Raid.id == raid.id).update(
+            {"cleaned": True}, synchronize_session=False))
 
 
     async def on_raw_message_delete(self, channel_id, message_id):
-        try:
-            deleted_embed = self.session.query(Embed).filter_by(channel_id=channel_id, message_id=message_id).one()
-        except NoResultFound:
+        raid = self.store.fetch_by_message(channel_id, message_id)
+        if raid is None:
             return
 
-
-        embeds = self.session.query(Embed).filter_by(raid=deleted_embed.raid)
-        for embed in embeds:
-            if embed.channel_id == int(channel_id) and embed.message_id == int(message_id):
-                continue
-            try:
-                channel = self.get_channel(embed.channel_id)
-                message = await self.get_message(channel, embed.message_id)
-                await self.bot.delete_message(message)
-            except discord.errors.NotFound:
-                print("Message not found!", embed.channel_id, embed.message_id)
-
-        
-        self.session.query(Going).filter_by(raid=deleted_embed.raid).delete()
-        self.session.query(Embed).filter_by(raid=deleted_embed.raid).delete()
-        self.session.query(Raid).filter_by(id=deleted_embed.raid_id).delete()
+        # The raid is gone from the store before the mirrors are deleted, so
+        # their own delete events find nothing. Its rows are removed in one
+        # transaction by the store's writer.
+        keys = [key for key in raid.embeds if key != (int(channel_id), int(message_id))]
+        self.store.delete(raid)
+        self.publish_raid("deleted", raid)
+        self.touch_boards(raid.server_id)
+        await self.delete_messages(keys)
 
     async def on_socket_raw_receive(self, msg):
+        received = time.perf_counter()
         if not isinstance(msg, str):
             return
+        if not self.ready.is_set():
+            await self.ready.wait()
         try:
             response = json.loads(msg)
         except json.decoder.JSONDecodeError:
             return
-        if response['t'] in ['MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE'] and response['d']['user_id'] != self.bot.user.id:
-            await self.on_raw_reaction(
-                response['d']['emoji']['name'],
-                response['d']['message_id'],
-                response['d']['channel_id'],
-                response['d']['user_id']
-            )
+        guild_id = response['d'].get('guild_id') if isinstance(response.get('d'), dict) else None
+        if guild_id is not None and not self.owns_server(guild_id):
+            return
+        if self.recorder is not None:
+            self.record_event(msg, response)
+        if response['t'] == 'MESSAGE_CREATE':
+            # This listener is scheduled before the message is parsed and
+            # dispatched, so commands are timed from here.
+            self.message_received[response['d']['id']] = received
+            while len(self.message_received) > COMMAND_RECEIVED_MAX:
+                self.message_received.popitem(last=False)
+        elif response['t'] in ['MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE'] and response['d']['user_id'] != self.bot.user.id:
+            with self.measure_event("on_raw_reaction"):
+                EVENT_STARTED.set(time.perf_counter())
+                REACTED_EMBED.set((int(response['d']['channel_id']), int(response['d']['message_id'])))
+                await self.on_raw_reaction(
+                    response['d']['emoji']['name'],
+                    response['d']['message_id'],
+                    response['d']['channel_id'],
+                    response['d']['user_id']
+                )
         elif response["t"] == "MESSAGE_DELETE":
-            await self.on_raw_message_delete(
-                response['d']['channel_id'],
-                response['d']['id']
-            )
+            with self.measure_event("on_raw_message_delete"):
+                await self.on_raw_message_delete(
+                    response['d']['channel_id'],
+                    response['d']['id']
+                )
+
+    def start_recording(self, path):
+        self.stop_recording()
+        self.recorder = EventRecorder(path, self.bot.user.id if self.bot.user is not None else None)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def record_event(self, msg, response):
+        # Our own messages are only recorded by id, so a replay can give
+        # the messages it sends the ids the recorded events refer to.
+        if response['t'] in RECORD_EVENTS:
+            self.recorder.write("gateway", msg=msg)
+        elif response['t'] == "MESSAGE_CREATE" and self.bot.user is not None and \
+                response['d'].get('author', {}).get('id') == self.bot.user.id:
+            self.recorder.write("sent", channel_id=response['d']['channel_id'], message_id=response['d']['id'])
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def raidrecord(self, ctx, path: str = None):
+        """
+            Record gateway events and commands to an NDJSON file, for
+            replaying with tools/replay.py. `!raidrecord stop` stops.
+        """
+        if path is None or path == "stop":
+            recording = self.recorder.path if self.recorder is not None else None
+            self.stop_recording()
+            await self.bot.say("Stopped recording to {}".format(recording) if recording else "Not recording")
+            return
+        try:
+            self.start_recording(path)
+        except OSError as e:
+            await self.bot.say("Can't record to {}: {}".format(path, e))
+            return
+        await self.bot.say("Recording to {}".format(path))
+
+    def setup_metrics(self):
+        self.metrics = Metrics()
+        self.metric_commands = self.metrics.histogram("gyms_command_seconds", "Time spent handling a command")
+        self.metric_events = self.metrics.histogram("gyms_event_seconds", "Time spent handling a raw gateway event")
+        self.metric_event_queries = self.metrics.histogram(
+            "gyms_queries_per_event", "SQL queries made while handling an event or command", COUNT_BUCKETS)
+        self.metric_sql = self.metrics.histogram("gyms_sql_query_seconds", "SQL query latency")
+        self.metric_search = self.metrics.histogram("gyms_search_seconds", "find_gym/find_pokemon latency")
+        self.metric_discord = self.metrics.histogram("gyms_discord_request_seconds", "Discord API request latency by route")
+        self.metric_discord_errors = self.metrics.counter("gyms_discord_request_errors_total", "Failed Discord API requests by route")
+        self.metric_reaction_edit = self.metrics.histogram(
+            "gyms_reaction_edit_seconds", "Time from receiving a reaction to the raid embeds being edited")
+        self.metric_embeds_per_update = self.metrics.histogram(
+            "gyms_embeds_per_update", "Embeds edited per raid update", COUNT_BUCKETS)
+        self.metric_active_raids = self.metrics.gauge("gyms_active_raids", "Raids not marked as done")
+        self.metric_active_embeds = self.metrics.gauge("gyms_active_embeds", "Embeds of raids not marked as done")
+        self.metric_max_embeds = self.metrics.gauge("gyms_max_embeds_per_raid", "Most embeds on a single active raid")
+        self.metric_pending_tasks = self.metrics.gauge("gyms_pending_tasks", "Scheduled background tasks")
+        self.metric_shed_level = self.metrics.gauge("gyms_shed_level", "Load shedding level, 0 normal, 1 busy, 2 overloaded")
+        self.metric_shed = self.metrics.counter("gyms_shed_total", "Work skipped or deferred by load shedding, by action")
+        self.metric_inflight = self.metrics.gauge("gyms_inflight", "Inbound events and outbound requests in progress")
+        self.metric_log_backlog = self.metrics.gauge("gyms_log_backlog_lines", "Log lines waiting to be sent")
+        self.metric_streams = self.metrics.gauge("gyms_event_streams", "Connected /api/events streams")
+        self.metric_stream_dropped = self.metrics.counter("gyms_event_stream_dropped_total", "Events dropped from full stream buffers")
+        self.metric_api = self.metrics.counter("gyms_api_requests_total", "Read-only API requests by route and status")
+        self.metric_search_tier = self.metrics.counter("gyms_search_tier_total", "Gym searches by the region tier that matched")
+        self.metric_raid_duplicates = self.metrics.counter("gyms_raid_duplicates_total", "Raid reports that matched a raid already on the gym")
+        self.metric_outbox_pushed = self.metrics.counter("gyms_search_outbox_pushed_total", "Gym and pokemon documents written to the search index")
+        self.metric_catalog_gyms = self.metrics.gauge("gyms_catalog_gyms", "Gyms in the in-memory location catalog")
+        self.metric_cache = self.metrics.counter("gyms_cache_requests_total", "Gym cache lookups by cache and result")
+        self.metric_cache_hit_ratio = self.metrics.gauge("gyms_cache_hit_ratio", "Share of gym cache lookups that hit, since start")
+        self.metric_board_renders = self.metrics.counter("gyms_board_renders_total", "Raid board updates by result")
+        self.metric_startup = self.metrics.gauge("gyms_startup_seconds", "Time taken by each startup phase")
+        self.metric_store_writes = self.metrics.gauge("gyms_store_pending_writes", "Raid changes waiting to be written to the database")
+        self.metrics.collectors.append(self.collect_metrics)
+        event.listen(self.engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", self.after_cursor_execute)
+        self.instrument_http()
+
+    def collect_metrics(self):
+        counts = [len(raid.embeds) for raid in self.store.raids.values() if not raid.done]
+        self.metric_active_raids.set(len(counts))
+        self.metric_active_embeds.set(sum(counts))
+        self.metric_max_embeds.set(max(counts or [0]))
+        self.metric_store_writes.set(len(self.store.writes))
+        self.metric_inflight.set(self.inflight_events, kind="events")
+        self.metric_inflight.set(self.inflight_requests, kind="requests")
+        self.metric_log_backlog.set(self.log_writer.backlog())
+        self.shed_level()
+        self.metric_catalog_gyms.set(len(self.catalog))
+        self.metric_cache_hit_ratio.set(self.gym_search_cache.hit_ratio(), cache="gym_search")
+        self.metric_cache_hit_ratio.set(self.gym_embed_cache.hit_ratio(), cache="gym_embed")
+        raid_task = 1 if self.raid_task is not None and not self.raid_task.done() else 0
+        self.metric_pending_tasks.set(raid_task, kind="raid_end")
+        self.metric_pending_tasks.set(len(self.job_tasks), kind="job")
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("gyms_query_start", []).append(time.perf_counter())
+        queries = EVENT_QUERIES.get()
+        if queries is not None:
+            queries[0] += 1
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["gyms_query_start"].pop()
+        duration = time.perf_counter() - start
+        self.metric_sql.observe(duration)
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add("sql " + statement.split(None, 1)[0], start, duration)
+
+    @contextlib.contextmanager
+    def measure_event(self, handler, histogram=None):
+        histogram = histogram or self.metric_events
+        queries = [0]
+        token = EVENT_QUERIES.set(queries)
+        self.inflight_events += 1
+        try:
+            with histogram.time(handler=handler), self.tracer.trace(handler):
+                yield
+        finally:
+            self.inflight_events -= 1
+            EVENT_QUERIES.reset(token)
+            self.metric_event_queries.observe(queries[0], handler=handler)
+
+    def instrument_http(self):
+        http = getattr(self.bot, "http", None)
+        if http is None or "request" in vars(http):
+            return
+        original = http.request
+
+        async def request(route, *args, **kwargs):
+            kind = "{} {}".format(getattr(route, "method", ""), getattr(route, "path", route))
+            self.inflight_requests += 1
+            try:
+                with self.metric_discord.time(kind=kind), self.tracer.span("api " + kind):
+                    return await original(route, *args, **kwargs)
+            except Exception:
+                self.metric_discord_errors.inc(kind=kind)
+                raise
+            finally:
+                self.inflight_requests -= 1
+
+        http.request = request
+
+    def is_own_command(self, command):
+        return getattr(type(self), command.name, None) is command
+
+    def check_ready(self, ctx):
+        # The commands are registered as soon as the cog is loaded, but the
+        # tables may not exist until setup() has run.
+        if self.ready.is_set() or not self.is_own_command(ctx.command):
+            return True
+        raise StartingUp()
+
+    async def on_command(self, command, ctx):
+        # Dispatched as a task that may only run once the command has
+        # started, so the clock starts when its message arrived, or now if
+        # it didn't come through the gateway.
+        if self.is_own_command(command):
+            ctx.gyms_started = self.message_received.pop(ctx.message.id, None) or time.perf_counter()
+            if self.recorder is not None and command.name != "raidrecord":
+                message = ctx.message
+                self.recorder.write(
+                    "command", content=message.content, channel_id=message.channel.id,
+                    server_id=message.server.id if message.server is not None else None,
+                    author_id=message.author.id, author_name=message.author.name)
+
+    async def on_command_completion(self, command, ctx, status="ok"):
+        started = getattr(ctx, "gyms_started", None)
+        if started is not None:
+            ctx.gyms_started = None
+            self.metric_commands.observe(time.perf_counter() - started, handler=command.name, status=status)
+
+    async def on_command_error(self, error, ctx):
+        if ctx.command is not None:
+            await self.on_command_completion(ctx.command, ctx, "error")
+        if ctx.command is not None and self.is_own_command(ctx.command) and isinstance(getattr(error, "original", None), SearchUnavailable):
+            await self.bot.send_message(ctx.message.channel, "Gym search is still starting up, please try again in a minute.")
+        elif isinstance(error, StartingUp):
+            await self.bot.send_message(ctx.message.channel, "Still starting up, please try again in a moment.")
+
+    async def start_http(self):
+        app = web.Application(loop=self.bot.loop)
+        app.router.add_route("GET", "/metrics", self.http_metrics)
+        app.router.add_route("GET", "/api/raids", self.http_raids)
+        app.router.add_route("GET", "/api/gyms", self.http_gyms)
+        app.router.add_route("GET", "/api/events", self.http_events)
+        app.router.add_route("POST", "/api/ingest", self.http_ingest)
+        self.http_app = app
+        self.http_handler = app.make_handler()
+        self.http_server = await self.bot.loop.create_server(self.http_handler, HTTP_HOST, HTTP_PORT)
+
+    def stop_http(self):
+        if self.http_server is not None:
+            self.http_server.close()
+            self.http_server = None
+
+    async def http_metrics(self, request):
+        return web.Response(text=self.metrics.render(), content_type="text/plain")
+
+    async def http_raids(self, request):
+        # Active raids with their gym and how many are going, straight
+        # from the raid store. ?region= takes geohash prefixes, comma
+        # separated, ?server= a server id.
+        return self.api_response(request, "raids", self.store.version, self.render_api_raids)
+
+    async def http_gyms(self, request):
+        return self.api_response(request, "gyms", self.catalog.version, self.render_api_gyms)
+
+    def api_response(self, request, route, version, render):
+        if not self.ready.is_set():
+            return web.json_response({"error": "starting"}, status=503)
+        regions = tuple(region for region in request.query.get("region", "").split(",") if region)
+        server_id = request.query.get("server", "")
+        etag = '"{}-{}"'.format(self.api_epoch, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        match = request.headers.get("If-None-Match", "")
+        if match == "*" or etag in [tag.strip() for tag in match.split(",")]:
+            self.metric_api.inc(route=route, status="304")
+            return web.Response(status=304, headers=headers)
+        key = (route, regions, server_id, version)
+        body = self.api_cache.get(key)
+        if body is LRUCache.MISSING:
+            body = json.dumps(render(regions, server_id))
+            self.api_cache.put(key, body)
+        self.metric_api.inc(route=route, status="200")
+        return web.Response(text=body, content_type="application/json", headers=headers)
+
+    def render_api_raids(self, regions, server_id):
+        raids = []
+        for raid in self.store.raids.values():
+            if raid.done or (server_id and str(raid.server_id) != server_id):
+                continue
+            data = self.api_raid(raid)
+            if regions and not data["gym"]["region"].startswith(regions):
+                continue
+            raids.append(data)
+        raids.sort(key=lambda raid: raid["end_time"])
+        return {"raids": raids}
+
+    def api_raid(self, raid):
+        region = geohash(raid.gym.latitude, raid.gym.longitude) if raid.gym.latitude is not None else ""
+        return {
+            "id": raid.id,
+            "server_id": str(raid.server_id),
+            "gym": {"id": raid.gym.id, "title": raid.gym.title, "latitude": raid.gym.latitude,
+                    "longitude": raid.gym.longitude, "region": region},
+            "pokemon": None if raid.pokemon is None else {"id": raid.pokemon.id, "name": raid.pokemon.name},
+            "level": raid.level,
+            "start_time": raid.start_time.isoformat() + "Z",
+            "end_time": raid.end_time.isoformat() + "Z",
+            "going": len(raid.going),
+            "going_with_extras": len(raid.going) + sum(raid.going.values()),
+        }
+
+    def publish_raid(self, kind, raid):
+        # Events carry only what changed: "raid" the whole raid (created
+        # or edited), "going" the counts, "time" the times, "done" and
+        # "deleted" just the id.
+        data = self.api_raid(raid)
+        if kind == "going":
+            data = {key: data[key] for key in ("id", "going", "going_with_extras")}
+        elif kind == "time":
+            data = {key: data[key] for key in ("id", "start_time", "end_time")}
+        elif kind != "raid":
+            data = {"id": raid.id}
+        self.events.publish(kind, str(raid.server_id), geohash(raid.gym.latitude, raid.gym.longitude)
+                            if raid.gym.latitude is not None else "", data)
+
+    async def http_events(self, request):
+        # A Server-Sent Events stream of raid changes, with the same
+        # ?region= and ?server= filters as /api/raids. Event ids are
+        # "<epoch>-<seq>"; a client reconnecting with Last-Event-ID gets
+        # what it missed, or a "reset" event telling it to refetch
+        # /api/raids when that's no longer possible.
+        regions = tuple(region for region in request.query.get("region", "").split(",") if region)
+        after = None
+        restarted = False
+        epoch, _, seq = request.headers.get("Last-Event-ID", "").partition("-")
+        if seq.isdigit():
+            if epoch == self.api_epoch:
+                after = int(seq)
+            else:
+                restarted = True
+        subscription, complete = self.events.subscribe(after, request.query.get("server") or None, regions)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        self.metric_streams.inc(1)
+        try:
+            if restarted or not complete:
+                await self.write_stream(response, "id: {}-{}\nevent: reset\ndata: {{}}\n\n".format(self.api_epoch, self.events.seq))
+            while True:
+                event = await subscription.next(EVENT_KEEPALIVE)
+                if event is None:
+                    await self.write_stream(response, ": keepalive\n\n")
+                    continue
+                seq, kind, server_id, region, data = event
+                await self.write_stream(response, "id: {}-{}\nevent: {}\ndata: {}\n\n".format(self.api_epoch, seq, kind, data))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.events.unsubscribe(subscription)
+            self.metric_streams.inc(-1)
+            self.metric_stream_dropped.inc(subscription.dropped)
+        return response
+
+    async def http_ingest(self, request):
+        # The same as !raidingest for a local scanner: POST NDJSON or CSV
+        # to /api/ingest?server=<id> with "Authorization: Bearer <token>".
+        if not INGEST_TOKEN:
+            return web.json_response({"error": "ingest is disabled"}, status=404)
+        expected = "Bearer {}".format(INGEST_TOKEN).encode("utf-8")
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), expected):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        if not self.ready.is_set():
+            return web.json_response({"error": "starting"}, status=503)
+        server_id = request.query.get("server", "")
+        server = discord.utils.get(self.bot.servers, id=server_id)
+        if server is None or not self.owns_server(server_id):
+            return web.json_response({"error": "unknown server"}, status=404)
+        summary = await self.ingest_raids(server, parse_ingest_records(await request.text()))
+        await self.log(server, "Scanner ingested raids: {}", self.format_ingest(summary))
+        return web.json_response(summary)
+
+    async def write_stream(self, response, text):
+        # StreamResponse.write is a coroutine on newer aiohttp only.
+        written = response.write(text.encode("utf-8"))
+        if asyncio.iscoroutine(written) or asyncio.isfuture(written):
+            await written
+
+    def render_api_gyms(self, regions, server_id):
+        return {"gyms": [
+            {"id": gym_id, "title": title, "latitude": latitude, "longitude": longitude, "region": region}
+            for gym_id, title, latitude, longitude, region in self.catalog.items()
+            if not regions or region.startswith(regions)
+        ]}
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def raidtrace(self, ctx, count: int = 5):
+        """
+            Show the slowest recent events and commands, step by step
+        """
+        traces = self.tracer.top(count)
+        if not traces:
+            await self.bot.say("No traces recorded yet.")
+            return
+        text = "\n\n".join(trace.format() for trace in traces)
+        if len(text) + 8 > MESSAGE_LIMIT:
+            await self.bot.send_file(ctx.message.channel, io.BytesIO(text.encode("utf-8")), filename="traces.txt")
+            return
+        await self.bot.say("```\n{}\n```".format(text))
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def raidprofile(self, ctx, action: str = "start", seconds: int = 30):
+        """
+            Run the sampling profiler for a number of seconds (default 30)
+            and upload the collapsed stacks, `!raidprofile stop` ends early.
+        """
+        if action == "stop":
+            if self.profiler is None:
+                await self.bot.say("The profiler isn't running.")
+                return
+            self.profiler.stopped.set()
+            return
+        if action != "start":
+            await self.bot.say("```!raidprofile [start|stop] [seconds=30]```")
+            return
+        if self.profiler is not None:
+            await self.bot.say("The profiler is already running.")
+            return
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+        profiler = self.profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+        await self.bot.say("Profiling for {} seconds...".format(seconds))
+        try:
+            started = time.time()
+            while not profiler.stopped.is_set() and time.time() - started < seconds:
+                await asyncio.sleep(0.5)
+        finally:
+            profiler.stop()
+            self.profiler = None
+        data = io.BytesIO(profiler.collapsed().encode("utf-8"))
+        await self.bot.send_file(
+            ctx.message.channel, data, filename="profile.txt",
+            content="{} samples over {:.0f} seconds".format(profiler.samples, time.time() - started))
+
+    def get_log_channels(self, server_id):
+        server_id = int(server_id)
+        channel_ids = self.log_channels.get(server_id)
+        if channel_ids is None:
+            configs = self.session.query(ChannelConfig).filter_by(server_id=server_id, key="log", value="yes")
+            channel_ids = [config.channel_id for config in configs]
+            self.log_channels[server_id] = channel_ids
+        return channel_ids
 
     async def log(self, server, message, *args):
-        configs = self.session.query(ChannelConfig).filter_by(server_id=server.id, key="log", value="yes")
-        for config in configs:
-            channel = self.get_channel(config.channel_id)
-            await self.bot.send_message(channel, content=message.format(*args))
-        
+        # Only queues the line, LogWriter sends it in the background.
+        self.log_writer.write(server.id, self.get_log_channels(server.id), message.format(*args))
+
+    def __unload(self):
+        self.bot.remove_check(self.check_ready)
+        self.log_writer.stop()
+        self.setup_task.cancel()
+        for task in (self.store_task, self.prewarm_task, self.lease_task, self.board_task, self.outbox_task,
+                     self.gym_change_task, self.deferred_task):
+            if task is not None:
+                task.cancel()
+        if self.ready.is_set():
+            self.store.apply()
+            try:
+                self.store.save_snapshot(self.snapshot_path)
+            except OSError as e:
+                print("Failed to write raid snapshot:", e)
+        if self.raid_task is not None:
+            self.raid_task.cancel()
+        if self.is_expiry_leader:
+            self.is_expiry_leader = False
+            self.release_lease(self.lease_name)
+        if self.profiler is not None:
+            self.profiler.stopped.set()
+        self.stop_recording()
+        self.stop_http()
+        if self.client_session is not None:
+            closing = self.client_session.close()
+            if closing is not None:
+                asyncio.ensure_future(closing, loop=self.bot.loop)
+        http = getattr(self.bot, "http", None)
+        if http is not None:
+            vars(http).pop("request", None)
+        event.remove(self.engine, "before_cursor_execute", self.before_cursor_execute)
+        event.remove(self.engine, "after_cursor_execute", self.after_cursor_execute)
 
 def setup(bot):
     bot.add_cog(Gyms(bot))
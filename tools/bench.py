@@ -0,0 +1,375 @@
+"""
+    Benchmarks for the Gyms cog against in-process stand-ins.
+
+        python -m tools.bench --output bench.json
+        python -m tools.bench --compare bench.json
+
+    Results are written as JSON, `--compare` exits non-zero when a
+    benchmark's p50 regressed by more than `--tolerance` against an
+    earlier run.
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from . import standins
+
+EMOJI_GOING = u"\U0001F44D"
+
+
+def stats(timings, **extra):
+    timings = sorted(timings)
+    n = len(timings)
+    result = {
+        "n": n,
+        "mean_ms": round(sum(timings) / n * 1000, 3) if n else None,
+        "p50_ms": round(timings[n // 2] * 1000, 3) if n else None,
+        "p95_ms": round(timings[min(n - 1, int(n * 0.95))] * 1000, 3) if n else None,
+        "max_ms": round(timings[-1] * 1000, 3) if n else None,
+    }
+    result.update(extra)
+    return result
+
+
+def command(cog, name):
+    return functools.partial(getattr(type(cog), name).callback, cog)
+
+
+class World:
+    """A server with a raid channel, mirror channels, members and gyms."""
+
+    def __init__(self, gyms, loop, latency=0.0, mirrors=0, members=50, num_gyms=500, webhooks=False):
+        self.gyms = gyms
+        self.directory = tempfile.mkdtemp(prefix="gymsbench")
+        self.bot = standins.Bot(latency=latency, loop=loop)
+        self.webhook_server = None
+        self.discord_api = gyms.DISCORD_API
+        if webhooks:
+            self.webhook_server = loop.run_until_complete(standins.WebhookServer(self.bot).start())
+            gyms.DISCORD_API = self.webhook_server.url
+        self.cog = self.load_cog()
+        loop.run_until_complete(self.cog.ready.wait())
+        self.search = standins.MemorySearch(self.cog).install()
+        self.server = self.bot.add_server()
+        self.channel = self.bot.add_channel(self.server, "raids")
+        self.cog.set_channel_config(self.server.id, self.channel.id, "location", "51.28,1.08")
+        self.mirrors = []
+        for i in range(mirrors):
+            channel = self.bot.add_channel(self.server, "mirror-{}".format(i))
+            self.cog.set_channel_config(self.server.id, channel.id, "mirror", "yes")
+            if webhooks:
+                self.cog.set_channel_config(self.server.id, channel.id, "mirror_webhook", "yes")
+            self.mirrors.append(channel)
+        self.members = [self.server.add_member("trainer{}".format(i)) for i in range(members)]
+        self.gym_titles = []
+        rows = []
+        rng = random.Random(1)
+        for i in range(num_gyms):
+            rows.append(gyms.Gym(
+                title="Gym {} Memorial".format(i),
+                latitude=51.0 + rng.random(),
+                longitude=1.0 + rng.random()))
+        self.cog.session.add_all(rows)
+        self.cog.session.add(gyms.Pokemon(id=150, name="Mewtwo", raid_level=5))
+        self.cog.session.commit()
+        for gym in rows:
+            self.search.add_gym(gym.id, gym.title, gym.latitude, gym.longitude)
+            self.gym_titles.append(gym.title)
+        self.search.add_pokemon(150, "Mewtwo")
+
+    def load_cog(self):
+        return self.gyms.Gyms(
+            self.bot,
+            database_url="sqlite:///" + os.path.join(self.directory, "gyms.db"),
+            snapshot_path=os.path.join(self.directory, "snapshot.json.gz"))
+
+    def restart(self):
+        # A new cog over the same database, with an empty message cache.
+        self.cog._Gyms__unload()
+        self.cog.session.close()
+        self.bot.messages.clear()
+        self.cog = self.load_cog()
+        self.search.cog = self.cog
+        self.search.install()
+
+    def context(self, member=None, channel=None):
+        return self.bot.context(channel or self.channel, member or self.members[0])
+
+    async def start_raid(self, gym_title, member=None):
+        await standins.invoke(self.cog.start_raid, self.context(member), "30", "5", gym_title)
+        return self.cog.session.query(self.gyms.Raid).order_by(self.gyms.Raid.id.desc()).first()
+
+    def close(self):
+        unload = getattr(self.cog, "_Gyms__unload", None)
+        if unload is not None:
+            unload()
+        if self.cog.raid_task is not None:
+            self.cog.raid_task.cancel()
+        self.cog.session.close()
+        if self.webhook_server is not None:
+            self.bot.loop.run_until_complete(self.webhook_server.stop())
+            self.gyms.DISCORD_API = self.discord_api
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+async def bench_start_raid(world, n):
+    timings = []
+    calls = sum(world.bot.calls.values())
+    for i in range(n):
+        start = time.perf_counter()
+        await world.start_raid(world.gym_titles[i])
+        timings.append(time.perf_counter() - start)
+    calls = sum(world.bot.calls.values()) - calls
+    return stats(timings, mirrors=len(world.mirrors), api_calls_per_op=round(calls / n, 2))
+
+
+async def bench_reaction(world, n):
+    raid = await world.start_raid(world.gym_titles[0])
+    world.cog.store.apply()
+    embed = world.cog.session.query(world.gyms.Embed).filter_by(raid_id=raid.id, channel_id=int(world.channel.id)).one()
+    timings = []
+    calls = sum(world.bot.calls.values())
+    for i in range(n):
+        member = world.members[i % len(world.members)]
+        start = time.perf_counter()
+        await world.cog.on_raw_reaction(EMOJI_GOING, str(embed.message_id), world.channel.id, member.id)
+        timings.append(time.perf_counter() - start)
+    calls = sum(world.bot.calls.values()) - calls
+    return stats(timings, mirrors=len(world.mirrors), api_calls_per_op=round(calls / n, 2))
+
+
+async def bench_restart(world, n):
+    raids = [await world.start_raid(title) for title in world.gym_titles[:n]]
+    world.restart()
+    await world.cog.ready.wait()
+    start = time.perf_counter()
+    await world.cog.prewarm_task
+    prewarm = time.perf_counter() - start
+    timings = []
+    calls = sum(world.bot.calls.values())
+    for i, raid in enumerate(raids):
+        member = world.members[i % len(world.members)]
+        channel_id, message_id = world.cog.store.fetch(raid.id).embeds[0]
+        start = time.perf_counter()
+        await world.cog.on_raw_reaction(EMOJI_GOING, str(message_id), str(channel_id), member.id)
+        timings.append(time.perf_counter() - start)
+    calls = sum(world.bot.calls.values()) - calls
+    return stats(timings, prewarm_ms=round(prewarm * 1000, 3), api_calls_per_op=round(calls / n, 2))
+
+
+async def bench_prepare_embed(world, n, going):
+    raid = await world.start_raid(world.gym_titles[0])
+    raid = world.cog.store.fetch(raid.id)
+    for i, member in enumerate(world.members[:going]):
+        world.cog.store.set_going(raid, member.id, i % 3)
+    world.cog.store.apply()
+    timings = []
+    for i in range(n):
+        start = time.perf_counter()
+        await world.cog.prepare_raid_embed(world.channel, raid)
+        timings.append(time.perf_counter() - start)
+    return stats(timings, going=going)
+
+
+async def bench_find_gym(world, n, popular=None):
+    rng = random.Random(2)
+    titles = world.gym_titles[:popular] if popular else world.gym_titles
+    timings = []
+    for i in range(n):
+        title = rng.choice(titles)
+        start = time.perf_counter()
+        await world.cog.find_gym(title, world.channel)
+        timings.append(time.perf_counter() - start)
+    return stats(timings, gyms=len(titles), cache_hit_ratio=round(world.cog.gym_search_cache.hit_ratio(), 3))
+
+
+async def bench_raidstats(world, n, raids):
+    gyms = world.gyms
+    rng = random.Random(3)
+    gym_ids = [gym.id for gym in world.cog.session.query(gyms.Gym.id)]
+    now = datetime.datetime.utcnow()
+    raid_rows = []
+    for i in range(raids):
+        end = now - datetime.timedelta(minutes=30 * i)
+        raid_rows.append({
+            "id": i + 1,
+            "gym_id": rng.choice(gym_ids),
+            "start_time": end - gyms.DESPAWN_TIME,
+            "end_time": end,
+            "level": 5,
+            "done": True,
+        })
+    world.cog.session.bulk_insert_mappings(gyms.Raid, raid_rows)
+    world.cog.session.bulk_insert_mappings(gyms.Going, [
+        {"raid_id": row["id"], "user_id": int(world.members[j].id), "extra": j % 2}
+        for row in raid_rows for j in range(rng.randint(0, 5))
+    ])
+    world.cog.session.commit()
+    raidstats = command(world.cog, "raidstats")
+    since = (now - datetime.timedelta(days=3650)).strftime("%Y-%m-%d")
+    timings = []
+    for i in range(n):
+        title = world.gym_titles[i % len(world.gym_titles)]
+        start = time.perf_counter()
+        await standins.invoke(raidstats, world.context(), since, gym_title=title)
+        timings.append(time.perf_counter() - start)
+    return stats(timings, raids=raids)
+
+
+async def bench_raidsnear(world, n, raids):
+    gyms = world.gyms
+    now = datetime.datetime.utcnow()
+    gym_ids = [gym.id for gym in world.cog.session.query(gyms.Gym.id)]
+    world.cog.session.bulk_insert_mappings(gyms.Raid, [
+        {
+            "gym_id": gym_ids[i % len(gym_ids)],
+            "start_time": now,
+            "end_time": now + gyms.DESPAWN_TIME,
+            "level": 5,
+            "done": False,
+            "server_id": int(world.server.id),
+        }
+        for i in range(raids)
+    ])
+    world.cog.session.commit()
+    world.cog.load_store()
+    raidsnear = command(world.cog, "raidsnear")
+    rng = random.Random(4)
+    timings = []
+    for i in range(n):
+        location = "{:.4f},{:.4f}".format(51.0 + rng.random(), 1.0 + rng.random())
+        start = time.perf_counter()
+        await standins.invoke(raidsnear, world.context(), location, "5")
+        timings.append(time.perf_counter() - start)
+    return stats(timings, raids=raids)
+
+
+async def bench_delete_cascade(world, n):
+    timings = []
+    for i in range(n):
+        raid = await world.start_raid(world.gym_titles[i])
+        channel_id, message_id = world.cog.store.fetch(raid.id).embeds[0]
+        message = world.channel.messages[str(message_id)]
+        await world.bot.delete_message(message)
+        start = time.perf_counter()
+        await world.cog.on_raw_message_delete(str(channel_id), str(message_id))
+        timings.append(time.perf_counter() - start)
+    return stats(timings, mirrors=len(world.mirrors))
+
+
+async def bench_catalog(world, n, num_gyms):
+    # A country's worth of gyms, straight into the catalog.
+    rng = random.Random(5)
+    catalog = world.gyms.GymCatalog()
+    start = time.perf_counter()
+    catalog.load((i + 1, "Gym {}".format(i), 50.0 + rng.random() * 8, -5.0 + rng.random() * 7) for i in range(num_gyms))
+    build = time.perf_counter() - start
+    timings = []
+    for i in range(n):
+        latitude, longitude = 50.0 + rng.random() * 8, -5.0 + rng.random() * 7
+        start = time.perf_counter()
+        catalog.nearest(latitude, longitude, k=10)
+        catalog.nearest(latitude, longitude, km=5)
+        timings.append(time.perf_counter() - start)
+    return stats(timings, gyms=num_gyms, build_ms=round(build * 1000, 3), numpy=world.gyms.numpy is not None)
+
+
+def benchmarks(quick):
+    scale = 10 if quick else 1
+    return [
+        ("start_raid", {}, lambda w: bench_start_raid(w, 50 // scale or 1)),
+        ("start_raid_mirrors_10", {"mirrors": 10}, lambda w: bench_start_raid(w, 50 // scale or 1)),
+        ("reaction_update_mirrors_10", {"mirrors": 10}, lambda w: bench_reaction(w, 200 // scale)),
+        ("start_raid_webhook_mirrors_10", {"mirrors": 10, "webhooks": True}, lambda w: bench_start_raid(w, 50 // scale or 1)),
+        ("reaction_update_webhook_mirrors_10", {"mirrors": 10, "webhooks": True}, lambda w: bench_reaction(w, 200 // scale)),
+        ("first_reaction_after_restart", {"mirrors": 3}, lambda w: bench_restart(w, 50 // scale or 1)),
+        ("delete_cascade_mirrors_10", {"mirrors": 10}, lambda w: bench_delete_cascade(w, 20 // scale or 1)),
+        ("prepare_raid_embed_going_50", {"members": 50}, lambda w: bench_prepare_embed(w, 200 // scale, 50)),
+        ("prepare_raid_embed_going_1000", {"members": 1000}, lambda w: bench_prepare_embed(w, 50 // scale, 1000)),
+        ("find_gym", {"num_gyms": 5000}, lambda w: bench_find_gym(w, 1000 // scale)),
+        ("find_gym_popular_50", {"num_gyms": 5000}, lambda w: bench_find_gym(w, 1000 // scale, 50)),
+        ("gym_catalog_100k", {"num_gyms": 10}, lambda w: bench_catalog(w, 200 // scale, 100000 // scale)),
+        ("raidsnear_10k", {"num_gyms": 5000}, lambda w: bench_raidsnear(w, 200 // scale, 10000 // scale)),
+        ("raidstats_10k", {}, lambda w: bench_raidstats(w, 20 // scale or 1, 10000)),
+        ("raidstats_100k", {}, lambda w: bench_raidstats(w, 10 // scale or 1, 100000 // scale)),
+    ]
+
+
+def run(args):
+    gyms = standins.load_offline()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = {}
+    for name, options, bench in benchmarks(args.quick):
+        if args.only and name not in args.only:
+            continue
+        world = World(gyms, loop, latency=args.latency_ms / 1000, **options)
+        try:
+            results[name] = loop.run_until_complete(bench(world))
+        finally:
+            world.close()
+        print(name, json.dumps(results[name]), file=sys.stderr)
+    return {
+        "meta": {
+            "time": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "latency_ms": args.latency_ms,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, result in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("p50_ms") or result["p50_ms"] is None:
+            continue
+        ratio = result["p50_ms"] / old["p50_ms"]
+        result["baseline_p50_ms"] = old["p50_ms"]
+        result["ratio"] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p50 slowdown, 0.2 = 20%%")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated Discord API round-trip")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, for a smoke test")
+    parser.add_argument("--only", nargs="*", help="Only run these benchmarks")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if regressions:
+        print("Regressed:", ", ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+    Check the cog's gym search against a stand-in Elasticsearch.
+
+        python -m tools.check_search
+
+    standins.MemorySearch replaces _find_gym altogether, so the benchmarks
+    never run its region tiers or its re-ranking by distance. Here the
+    real _find_gym and search_gyms run, and only the client underneath is
+    replaced: it answers the queries search_gyms builds from a fixed set
+    of gyms the way the marker index would. Exits non-zero when a search
+    finds the wrong gym or searches the wrong regions.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+from . import standins
+
+# Where the channels are, moved to the centre of its region cell, and a
+# place in another region well away from them.
+ORIGIN = (51.28, 1.08)
+FAR = (48.85, 2.35)
+
+
+class Elasticsearch:
+    """
+        Answers search_gyms' queries from a list of gyms. Scores are the
+        number of query words in the title plus a per-gym boost, and the
+        regions of every search are kept in `searches`.
+    """
+
+    def __init__(self, gyms):
+        self.gyms_module = gyms
+        self.gyms = []
+        self.searches = []
+
+    def add(self, id, title, latitude, longitude, boost=0.0):
+        self.gyms.append({
+            "id": id, "title": title, "boost": boost,
+            "location": {"lat": latitude, "lon": longitude},
+            "region": self.gyms_module.geohash(latitude, longitude),
+        })
+
+    def search(self, index=None, body=None, **params):
+        query = body["query"]
+        if "match" in query:
+            match = query["match"]["title"]
+            regions = None
+        else:
+            match = query["bool"]["must"][0]["match"]["title"]
+            regions = [q["prefix"]["region"] for q in query["bool"]["filter"][0]["bool"]["should"]]
+        self.searches.append(regions)
+        words = set(match["query"].lower().split())
+        hits = []
+        for gym in self.gyms:
+            if regions is not None and not gym["region"].startswith(tuple(regions)):
+                continue
+            matched = len(words & set(gym["title"].lower().split()))
+            if not matched or (match.get("operator") == "and" and matched < len(words)):
+                continue
+            hits.append({
+                "_index": "marker", "_type": "doc", "_id": str(gym["id"]),
+                "_score": matched + gym["boost"],
+                "_source": {"title": gym["title"], "location": gym["location"], "region": gym["region"]},
+            })
+        hits.sort(key=lambda hit: -hit["_score"])
+        return {
+            "took": 1, "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "failed": 0},
+            "hits": {
+                "total": len(hits),
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits[:body.get("size", 10)],
+            },
+        }
+
+
+def prepare(gyms, cog, client):
+    # (id, title, latitude, longitude as the index has it, boost,
+    # latitude and longitude as the catalog has it if it moved since)
+    min_lat, max_lat, min_lon, max_lon = gyms.geohash_bounds(gyms.geohash(*ORIGIN))
+    origin = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    north = (origin[0] + max_lat - min_lat, origin[1]) # The centre of the next cell up
+    rows = [
+        (1, "Clock Tower", origin[0] + 0.001, origin[1], 0.0, None),
+        (2, "Clock Tower", FAR[0], FAR[1], 1.0, None),
+        (3, "Old Mill", north[0], north[1], 0.0, None),
+        (4, "Old Mill", FAR[0], FAR[1], 1.0, None),
+        (5, "Market Cross", FAR[0], FAR[1], 0.0, None),
+        (6, "Cathedral Gate", origin[0] + 0.002, origin[1], 0.0, (origin[0] + 0.045, origin[1])),
+        (7, "Cathedral Gate", origin[0] + 0.01, origin[1], 0.0, None),
+    ]
+    for gym_id, title, latitude, longitude, boost, moved in rows:
+        client.add(gym_id, title, latitude, longitude, boost)
+        cog.catalog.add(gym_id, title, *(moved or (latitude, longitude)))
+    cog.client = client
+    cog.search_ready.set()
+    return origin
+
+
+def check(loop, cog, client, channel, query, expected, regions=None):
+    # A failure message, or None.
+    client.searches = []
+    hit = loop.run_until_complete(cog._find_gym(query, channel))
+    found = int(hit.meta.id) if hit is not None else None
+    if found != expected:
+        return "{!r} in {}: found gym {}, expected {}".format(query, channel.name, found, expected)
+    if regions is not None and client.searches != regions:
+        return "{!r} in {}: searched {}, expected {}".format(query, channel.name, client.searches, regions)
+    return None
+
+
+def run(gyms, loop, directory):
+    bot = standins.Bot(loop=loop)
+    cog = gyms.Gyms(
+        bot,
+        database_url="sqlite:///" + os.path.join(directory, "gyms.db"),
+        snapshot_path=os.path.join(directory, "snapshot-{shard}.json.gz"))
+    cog.setup_search = lambda: None # Leaves cog.client to prepare()
+    loop.run_until_complete(cog.ready.wait())
+    client = Elasticsearch(gyms)
+    try:
+        origin = prepare(gyms, cog, client)
+        local = gyms.geohash(*origin)
+        neighbours = gyms.geohash_neighbours(*origin)
+
+        server = bot.add_server("server")
+        anywhere = bot.add_channel(server, "anywhere")
+        nearby = bot.add_channel(server, "nearby")
+        cog.set_channel_config(server.id, nearby.id, "location", "{},{}".format(*origin))
+        region = bot.add_channel(server, "region")
+        cog.set_channel_config(server.id, region.id, "region", local)
+
+        failures = [
+            # Without a location the best text match anywhere wins.
+            check(loop, cog, client, anywhere, "clock tower", 2, [None]),
+            # The channel's own cell is searched first.
+            check(loop, cog, client, nearby, "clock tower", 1, [[local]]),
+            # Then the cells around it.
+            check(loop, cog, client, nearby, "old mill", 3, [[local], neighbours]),
+            # Then everywhere.
+            check(loop, cog, client, nearby, "market cross", 5, [[local], neighbours, None]),
+            # A region setting replaces the cells around the location.
+            check(loop, cog, client, region, "clock tower", 1, [[local]]),
+            check(loop, cog, client, region, "market cross", 5, [[local], None]),
+            # Equal text matches are ranked by where the catalog has the
+            # gyms, 6 has moved further away since it was indexed.
+            check(loop, cog, client, nearby, "cathedral gate", 7),
+        ]
+    finally:
+        cog._Gyms__unload()
+        cog.session.close()
+    return [failure for failure in failures if failure is not None]
+
+
+def main(argv=None):
+    gyms = standins.load_offline()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    directory = tempfile.mkdtemp(prefix="gymssearch")
+    try:
+        failures = run(gyms, loop, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print("{} failed".format(len(failures)) if failures else "ok")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
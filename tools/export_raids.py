@@ -0,0 +1,56 @@
+"""
+    Export raid attendance history, the same as `!raidexport`.
+
+        python -m tools.export_raids raids.parquet --since 2018-01-01 --near 51.28,1.08 --km 10
+        python -m tools.export_raids raids.parquet --server 1234 --region u10h,u10j
+
+    Writes Parquet when pyarrow is installed and gzipped CSV otherwise,
+    streaming rows so memory use doesn't grow with the history.
+"""
+import argparse
+import datetime
+import sys
+
+from .loader import load_gyms
+
+
+def date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+def main(argv=None):
+    gyms = load_gyms()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="File to write, .{} is added if missing".format(gyms.export_format()))
+    parser.add_argument("--database", default=gyms.DATABASE_URL, help="SQLAlchemy database URL")
+    parser.add_argument("--since", type=date, help="Only raids starting on or after this date, YYYY-MM-DD")
+    parser.add_argument("--until", type=date, help="Only raids starting before this date, YYYY-MM-DD")
+    parser.add_argument("--near", help="Only raids at gyms near this lat,lon")
+    parser.add_argument("--km", type=float, default=10.0, help="Distance from --near")
+    parser.add_argument("--server", type=int, help="Only this server's raids")
+    parser.add_argument("--region", help="Only raids at gyms in these geohash regions, comma separated")
+    args = parser.parse_args(argv)
+
+    near = None
+    if args.near:
+        match = gyms.RE_COORDINATES.match(args.near)
+        if match is None:
+            parser.error("--near must be lat,lon")
+        near = float(match.group(1)), float(match.group(2))
+    regions = None
+    if args.region:
+        regions = [region for region in args.region.lower().split(",") if region]
+        if not regions or any(char not in gyms.GEOHASH_ALPHABET for region in regions for char in region):
+            parser.error("--region must be geohash prefixes")
+    output = args.output
+    if not output.endswith("." + gyms.export_format()):
+        output += "." + gyms.export_format()
+    engine = gyms.create_db_engine(args.database)
+    rows = gyms.export_raid_history(
+        engine, output, args.since, args.until, near, args.km if near else None, args.server, regions)
+    print("Exported {} rows to {}".format(rows, output), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
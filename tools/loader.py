@@ -0,0 +1,46 @@
+"""
+    Import gyms.py outside of Red.
+
+    gyms.py is a Red cog, it lives in Red's cogs/ package and imports
+    `checks` from cogs/utils. When that isn't available (or can't be
+    imported outside of a running Red) a permissive stand-in is used.
+"""
+import importlib
+import os
+import sys
+import types
+
+from discord.ext import commands
+
+PACKAGE = "gymscog"
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gyms.py")
+
+
+def _allow(ctx):
+    return True
+
+
+def _install_checks():
+    utils = types.ModuleType(PACKAGE + ".utils")
+    utils.__path__ = []
+    checks = types.ModuleType(PACKAGE + ".utils.checks")
+    checks.is_owner = lambda: commands.check(_allow)
+    checks.serverowner_or_permissions = lambda **perms: commands.check(_allow)
+    checks.admin_or_permissions = lambda **perms: commands.check(_allow)
+    checks.mod_or_permissions = lambda **perms: commands.check(_allow)
+    utils.checks = checks
+    sys.modules[utils.__name__] = utils
+    sys.modules[checks.__name__] = checks
+
+
+def load_gyms(path=DEFAULT_PATH):
+    if PACKAGE + ".gyms" in sys.modules:
+        return sys.modules[PACKAGE + ".gyms"]
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [os.path.dirname(os.path.abspath(path))]
+    sys.modules[PACKAGE] = package
+    try:
+        importlib.import_module(PACKAGE + ".utils.checks")
+    except Exception:
+        _install_checks()
+    return importlib.import_module(PACKAGE + ".gyms")
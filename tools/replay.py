@@ -0,0 +1,253 @@
+"""
+    Replay a recording made with GYMS_RECORD or `!raidrecord` against the
+    cog and the in-process Discord stand-in.
+
+        python -m tools.replay raids.ndjson --database gyms-copy.db --speed 4
+
+    The database should be a copy of gyms.db from when recording started;
+    it is copied again before replaying so the original isn't changed.
+    Events and commands are dispatched concurrently at their recorded
+    times divided by `--speed` (0 replays without waiting). Reports
+    p50/p99 handling latency, database queries and Discord API calls per
+    event, by event kind.
+"""
+import argparse
+import asyncio
+import collections
+import contextvars
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import standins
+from .bench import stats
+
+# The counters of the event being replayed, inherited by the tasks it starts.
+CURRENT = contextvars.ContextVar("replay_current", default=None)
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+class ReplayBot(standins.Bot):
+    """Gives the messages the cog sends the ids they had when recorded."""
+
+    def __init__(self, sent, **options):
+        super().__init__(**options)
+        self.sent = sent
+
+    async def api(self, kind):
+        counters = CURRENT.get()
+        if counters is not None:
+            counters["api_calls"] += 1
+        await super().api(kind)
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        await self.api("send_message")
+        ids = self.sent.get(destination.id)
+        message = standins.Message(destination, self.user, content, embed, id=ids.popleft() if ids else None)
+        destination.messages[message.id] = message
+        return message
+
+
+def read_recording(path):
+    header = None
+    entries = []
+    sent = collections.defaultdict(collections.deque)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry["kind"] == "header":
+                header = entry
+            elif entry["kind"] == "sent":
+                sent[str(entry["channel_id"])].append(str(entry["message_id"]))
+            else:
+                entries.append(entry)
+    if header is None:
+        raise ValueError("{} has no header, is it a recording?".format(path))
+    entries.sort(key=lambda entry: entry["t"])
+    return header, entries, sent
+
+
+class Replay:
+    def __init__(self, gyms, loop, header, entries, sent, database):
+        self.gyms = gyms
+        self.loop = loop
+        self.entries = entries
+        self.directory = tempfile.mkdtemp(prefix="gymsreplay")
+        path = os.path.join(self.directory, "gyms.db")
+        shutil.copyfile(database, path)
+        self.bot = ReplayBot(sent, loop=loop)
+        if header.get("bot_id"):
+            self.bot._user = standins.User(str(header["bot_id"]), "bot")
+        self.cog = gyms.Gyms(
+            self.bot,
+            database_url="sqlite:///" + path,
+            snapshot_path=os.path.join(self.directory, "snapshot.json.gz"))
+        self.bot.add_cog(self.cog)
+        loop.run_until_complete(self.cog.ready.wait())
+        search = standins.MemorySearch(self.cog).install()
+        for gym in self.cog.session.query(gyms.Gym):
+            search.add_gym(gym.id, gym.title, gym.latitude, gym.longitude)
+        for pokemon in self.cog.session.query(gyms.Pokemon):
+            search.add_pokemon(pokemon.id, pokemon.name)
+        gyms.event.listen(self.cog.engine, "before_cursor_execute", self.count_query)
+        self.background = collections.Counter()
+        self.results = collections.defaultdict(lambda: {"timings": [], "queries": 0, "api_calls": 0})
+        self.build_world()
+
+    def count_query(self, *args):
+        counters = CURRENT.get()
+        (counters if counters is not None else self.background)["queries"] += 1
+
+    def server(self, server_id):
+        server_id = str(server_id)
+        for server in self.bot.servers:
+            if server.id == server_id:
+                return server
+        return self.bot.add_server("server-" + server_id, id=server_id)
+
+    def channel(self, server, channel_id):
+        channel_id = str(channel_id)
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            channel = standins.Channel(server, "channel-" + channel_id, id=channel_id)
+            self.bot.channels[channel_id] = channel
+        return channel
+
+    def member(self, server, user_id, name=None):
+        return server.get_member(user_id) or server.add_member(name or "user-{}".format(user_id), id=str(user_id))
+
+    def build_world(self):
+        # Every server, channel and member the recording mentions, with
+        # their recorded ids.
+        for entry in self.entries:
+            if entry["kind"] == "command":
+                if entry.get("server_id") is None:
+                    continue
+                server = self.server(entry["server_id"])
+                self.channel(server, entry["channel_id"])
+                self.member(server, entry["author_id"], entry.get("author_name"))
+            else:
+                data = json.loads(entry["msg"]).get("d") or {}
+                if data.get("guild_id") is None:
+                    continue
+                server = self.server(data["guild_id"])
+                self.channel(server, data["channel_id"])
+                if "user_id" in data:
+                    self.member(server, data["user_id"])
+
+    def event_kind(self, entry):
+        if entry["kind"] == "command":
+            return "command " + entry["content"][len(self.bot.command_prefix):].split(" ", 1)[0]
+        return json.loads(entry["msg"])["t"]
+
+    async def dispatch(self, entry):
+        counters = collections.Counter()
+        CURRENT.set(counters)
+        start = time.perf_counter()
+        try:
+            if entry["kind"] == "command":
+                channel = self.bot.get_channel(entry["channel_id"])
+                if channel is None:
+                    return
+                author = self.member(channel.server, entry["author_id"], entry.get("author_name"))
+                await self.bot.process_commands(standins.Message(channel, author, entry["content"]))
+            else:
+                await self.cog.on_socket_raw_receive(entry["msg"])
+        finally:
+            result = self.results[self.event_kind(entry)]
+            result["timings"].append(time.perf_counter() - start)
+            result["queries"] += counters["queries"]
+            result["api_calls"] += counters["api_calls"]
+
+    async def run(self, speed):
+        tasks = []
+        start = time.perf_counter()
+        for entry in self.entries:
+            if speed:
+                delay = entry["t"] / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)
+            tasks.append(self.loop.create_task(self.dispatch(entry)))
+        errors = [r for r in await asyncio.gather(*tasks, return_exceptions=True) if isinstance(r, Exception)]
+        elapsed = time.perf_counter() - start
+        self.cog.store.apply()
+        return elapsed, errors
+
+    def report(self, elapsed, errors):
+        kinds = {}
+        timings = []
+        for kind, result in sorted(self.results.items()):
+            n = len(result["timings"])
+            timings.extend(result["timings"])
+            kinds[kind] = stats(
+                result["timings"],
+                p99_ms=round(percentile(result["timings"], 0.99) * 1000, 3),
+                queries_per_event=round(result["queries"] / n, 2),
+                api_calls_per_event=round(result["api_calls"] / n, 2))
+        return {
+            "events": len(timings),
+            "errors": len(errors),
+            "elapsed_s": round(elapsed, 3),
+            "events_per_s": round(len(timings) / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(timings, 0.5) * 1000, 3) if timings else None,
+            "p99_ms": round(percentile(timings, 0.99) * 1000, 3) if timings else None,
+            "background_queries": self.background["queries"],
+            "kinds": kinds,
+        }
+
+    def close(self):
+        self.gyms.event.remove(self.cog.engine, "before_cursor_execute", self.count_query)
+        self.cog._Gyms__unload()
+        self.cog.session.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="NDJSON file written by GYMS_RECORD or !raidrecord")
+    parser.add_argument("--database", required=True, help="SQLite copy of gyms.db from when recording started")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay N times faster, 0 = no waiting")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated Discord API round-trip")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit non-zero when p99 is slower than this")
+    args = parser.parse_args(argv)
+
+    gyms = standins.load_offline()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    header, entries, sent = read_recording(args.recording)
+    replay = Replay(gyms, loop, header, entries, sent, args.database)
+    replay.bot.latency = args.latency_ms / 1000
+    try:
+        elapsed, errors = loop.run_until_complete(replay.run(args.speed))
+        report = replay.report(elapsed, errors)
+    finally:
+        replay.close()
+    for error in errors[:10]:
+        print("Replay error:", repr(error), file=sys.stderr)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.max_p99_ms is not None and report["p99_ms"] is not None and report["p99_ms"] > args.max_p99_ms:
+        print("p99 {}ms is over {}ms".format(report["p99_ms"], args.max_p99_ms), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+    Run the cog as N shard processes over one shared SQLite database.
+
+        python -m tools.shards --shards 1 2 4
+
+    Every process only creates servers that belong to its shard, drives
+    raid creation and reactions for them through the Discord stand-in,
+    and then tries to mark every raid in the database as done. A shard
+    can't fetch another shard's raids, so each raid should be marked done
+    by exactly the process that owns it. Reports throughput per shard
+    count and fails if any raid wasn't marked done exactly once.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import standins
+
+EMOJI_GOING = u"\U0001F44D"
+
+
+def server_ids(shard_id, shard_count, total):
+    # Discord assigns guilds to shards by (guild_id >> 22) % shard_count.
+    return [
+        (i, str((i + 1000 * shard_count) << 22))
+        for i in range(total) if i % shard_count == shard_id
+    ]
+
+
+def prepare(database_url, num_gyms):
+    gyms = standins.load_offline()
+    engine = gyms.create_db_engine(database_url)
+    gyms.Base.metadata.create_all(engine)
+    session = gyms.sessionmaker(bind=engine)()
+    session.add_all([
+        gyms.Gym(id=i + 1, title="Gym {} Memorial".format(i), latitude=51.0 + i * 0.001, longitude=1.0)
+        for i in range(num_gyms)
+    ])
+    session.add(gyms.Pokemon(id=150, name="Mewtwo", raid_level=5))
+    session.commit()
+    session.close()
+
+
+async def drive_server(cog, bot, server_index, server_id, args):
+    server = bot.add_server("server-{}".format(server_index), id=server_id)
+    channel = bot.add_channel(server, "raids")
+    for i in range(args.mirrors):
+        mirror = bot.add_channel(server, "mirror-{}".format(i))
+        cog.set_channel_config(server.id, mirror.id, "mirror", "yes")
+    members = [server.add_member("trainer{}".format(i)) for i in range(args.members)]
+    events = 0
+    for r in range(args.raids):
+        title = "Gym {} Memorial".format(server_index * args.raids + r)
+        await standins.invoke(cog.start_raid, bot.context(channel, members[0]), "30", "5", title)
+        events += 1
+        message_id = next(reversed(channel.messages))
+        for member in members:
+            await cog.on_socket_raw_receive(json.dumps({
+                "t": "MESSAGE_REACTION_ADD",
+                "d": {
+                    "user_id": member.id,
+                    "channel_id": channel.id,
+                    "message_id": message_id,
+                    "guild_id": server.id,
+                    "emoji": {"name": EMOJI_GOING, "id": None},
+                },
+            }))
+            events += 1
+    return events
+
+
+def worker(shard_id, shard_count, directory, args, barrier, results):
+    gyms = standins.load_offline()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = standins.Bot(latency=args.latency_ms / 1000, loop=loop, shard_id=shard_id, shard_count=shard_count)
+    cog = gyms.Gyms(
+        bot,
+        database_url="sqlite:///" + os.path.join(directory, "gyms.db"),
+        snapshot_path=os.path.join(directory, "snapshot-{shard}.json.gz"))
+    loop.run_until_complete(cog.ready.wait())
+    search = standins.MemorySearch(cog).install()
+    for gym in cog.session.query(gyms.Gym):
+        search.add_gym(gym.id, gym.title, gym.latitude, gym.longitude)
+    search.add_pokemon(150, "Mewtwo")
+
+    barrier.wait()
+    start = time.perf_counter()
+    counts = loop.run_until_complete(asyncio.gather(*[
+        drive_server(cog, bot, index, server_id, args)
+        for index, server_id in server_ids(shard_id, shard_count, args.servers)
+    ]))
+    elapsed = time.perf_counter() - start
+
+    # Every shard tries to expire every raid, other shards' raids must not
+    # be loaded into its store.
+    cog.store.apply()
+    barrier.wait()
+    raids = cog.session.query(gyms.Raid).filter(gyms.Raid.done == False).all()
+    claimed = 0
+    for raid in raids:
+        active = cog.store.fetch(raid.id)
+        if active is not None and loop.run_until_complete(cog.mark_done(active)):
+            claimed += 1
+    results.put({
+        "shard_id": shard_id,
+        "events": sum(counts),
+        "elapsed": elapsed,
+        "claimed": claimed,
+        "api_calls": sum(bot.calls.values()),
+    })
+
+
+def run(shard_count, args):
+    directory = tempfile.mkdtemp(prefix="gymsshards")
+    database_url = "sqlite:///" + os.path.join(directory, "gyms.db")
+    try:
+        prepare(database_url, args.servers * args.raids)
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(shard_count)
+        results = context.Queue()
+        processes = [
+            context.Process(target=worker, args=(shard_id, shard_count, directory, args, barrier, results))
+            for shard_id in range(shard_count)
+        ]
+        for process in processes:
+            process.start()
+        shards = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    events = sum(shard["events"] for shard in shards)
+    elapsed = max(shard["elapsed"] for shard in shards)
+    return {
+        "shards": shard_count,
+        "events": events,
+        "elapsed_s": round(elapsed, 3),
+        "events_per_s": round(events / elapsed, 1),
+        "raids": args.servers * args.raids,
+        "claimed": sum(shard["claimed"] for shard in shards),
+        "per_shard": sorted(shards, key=lambda shard: shard["shard_id"]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--servers", type=int, default=8, help="Total servers, split between the shards")
+    parser.add_argument("--raids", type=int, default=5, help="Raids per server")
+    parser.add_argument("--members", type=int, default=20, help="Members reacting to each raid")
+    parser.add_argument("--mirrors", type=int, default=3, help="Mirror channels per server")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Simulated Discord API round-trip")
+    args = parser.parse_args(argv)
+
+    reports = [run(shard_count, args) for shard_count in args.shards]
+    print(json.dumps(reports, indent=2))
+    failed = [report["shards"] for report in reports if report["claimed"] != report["raids"]]
+    if failed:
+        print("Raids were not marked done exactly once with shards:", failed, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,510 @@
+"""
+    In-process stand-ins for Discord and the search backend, so the cog
+    can be driven without a gateway connection, Elasticsearch or a live
+    gyms.db.
+"""
+import asyncio
+import collections
+import itertools
+import math
+import re
+import time
+import uuid
+
+import discord
+import elasticsearch_dsl
+from aiohttp import web
+from discord.ext import commands
+
+from .loader import load_gyms
+
+BOT_ID = "100000000000000001"
+
+# Snowflakes carry their creation time, start from now like Discord's would.
+_snowflakes = itertools.count((int(time.time() * 1000) - 1420070400000) << 22)
+
+
+def snowflake():
+    return str(next(_snowflakes))
+
+
+def load_offline(path=None):
+    # The cog creates its search indexes when it starts, skip that.
+    elasticsearch_dsl.DocType.init = classmethod(lambda cls, index=None, using=None: None)
+    if path is None:
+        return load_gyms()
+    return load_gyms(path)
+
+
+class Permissions:
+    def __init__(self, **overrides):
+        self.overrides = overrides
+
+    def __getattr__(self, name):
+        return self.overrides.get(name, True)
+
+
+class Role:
+    def __init__(self, name, mentionable=True):
+        self.id = snowflake()
+        self.name = name
+        self.mentionable = mentionable
+
+    @property
+    def mention(self):
+        return "<@&{}>".format(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class Member:
+    def __init__(self, server, name, id=None, roles=None, bot=False):
+        self.id = id or snowflake()
+        self.server = server
+        self.name = name
+        self.nick = None
+        self.bot = bot
+        self.roles = list(roles or [])
+        self.server_permissions = Permissions()
+
+    @property
+    def mention(self):
+        return "<@{}>".format(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Member) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class User:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class Server:
+    def __init__(self, bot, name="server", id=None):
+        self.id = id or snowflake()
+        self.name = name
+        self.roles = []
+        self._members = collections.OrderedDict()
+        self.channels = []
+        self.me = self.add_member("bot", id=bot.user.id, bot=True)
+
+    def add_member(self, name, id=None, roles=None, bot=False):
+        member = Member(self, name, id=id, roles=roles, bot=bot)
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, user_id):
+        return self._members.get(str(user_id))
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Server) and other.id == self.id
+
+
+class Channel:
+    def __init__(self, server, name="channel", id=None):
+        self.id = id or snowflake()
+        self.server = server
+        self.name = name
+        self.messages = collections.OrderedDict()
+        server.channels.append(self)
+
+    def permissions_for(self, member):
+        return Permissions()
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Channel) and other.id == self.id
+
+
+class Reaction:
+    def __init__(self, emoji):
+        self.emoji = emoji
+        self.count = 1
+
+
+class Attachment(dict):
+    pass
+
+
+class Message:
+    def __init__(self, channel, author, content=None, embed=None, id=None):
+        self.id = id or snowflake()
+        self.channel = channel
+        self.server = channel.server
+        self.author = author
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.reactions = []
+        self.attachments = []
+
+
+class Context:
+    def __init__(self, bot, message):
+        self.bot = bot
+        self.message = message
+
+
+class Response:
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+def not_found(what):
+    return discord.errors.NotFound(Response(404, "NOT FOUND"), "Unknown {}".format(what))
+
+
+class HTTP:
+    """The raw HTTP API calls the cog makes, served by the stand-in Bot."""
+
+    token = "stand-in"
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def request(self, route, *args, **kwargs):
+        raise NotImplementedError("No stand-in for {} {}".format(route.method, route.path))
+
+    async def delete_message(self, channel_id, message_id, guild_id=None):
+        await self.bot.api("http.delete_message")
+        channel = self.bot.get_channel(channel_id)
+        message = channel.messages.get(str(message_id)) if channel is not None else None
+        if message is None:
+            raise not_found("Message")
+        self.bot.forget_message(message)
+
+    async def delete_messages(self, channel_id, message_ids, guild_id=None):
+        await self.bot.api("http.delete_messages")
+        channel = self.bot.get_channel(channel_id)
+        for message_id in message_ids:
+            message = channel.messages.get(str(message_id)) if channel is not None else None
+            if message is not None:
+                self.bot.forget_message(message)
+
+
+class Bot(commands.Bot):
+    """
+        A commands.Bot whose Discord API calls are served in process.
+
+        Every call sleeps for `latency` seconds to stand in for a HTTP
+        round-trip and is counted by kind in `calls`.
+    """
+
+    def __init__(self, latency=0.0, loop=None, **options):
+        super().__init__(command_prefix="!", loop=loop, **options)
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.http = HTTP(self)
+        self._user = User(BOT_ID, "bot")
+        self.channels = {}
+        self.servers = []
+        self.emojis = []
+
+    @property
+    def user(self):
+        return self._user
+
+    async def wait_until_ready(self):
+        return
+
+    def add_server(self, name="server", id=None):
+        server = Server(self, name, id=id)
+        self.servers.append(server)
+        return server
+
+    def add_channel(self, server, name="channel"):
+        channel = Channel(server, name)
+        self.channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, channel_id):
+        return self.channels.get(str(channel_id))
+
+    def get_all_emojis(self):
+        return iter(self.emojis)
+
+    def get_all_channels(self):
+        return iter(self.channels.values())
+
+    def context(self, channel, author, content=""):
+        return Context(self, Message(channel, author, content))
+
+    async def api(self, kind):
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        await self.api("send_message")
+        message = Message(destination, self.user, content, embed)
+        destination.messages[message.id] = message
+        return message
+
+    async def send_file(self, destination, fp, *, filename=None, content=None, tts=False):
+        await self.api("send_file")
+        message = Message(destination, self.user, content)
+        message.attachments.append(Attachment(filename=filename, size=len(fp.read()) if hasattr(fp, "read") else 0))
+        destination.messages[message.id] = message
+        return message
+
+    async def edit_message(self, message, new_content=None, *, embed=None):
+        await self.api("edit_message")
+        if new_content is not None:
+            message.content = new_content
+        if embed is not None:
+            message.embeds = [embed]
+        return message
+
+    def forget_message(self, message):
+        message.channel.messages.pop(message.id, None)
+        try:
+            self.messages.remove(message)
+        except ValueError:
+            pass
+
+    async def delete_message(self, message):
+        await self.api("delete_message")
+        self.forget_message(message)
+
+    async def delete_messages(self, messages):
+        await self.api("delete_messages")
+        for message in messages:
+            self.forget_message(message)
+
+    async def get_message(self, channel, id):
+        await self.api("get_message")
+        message = channel.messages.get(str(id))
+        if message is None:
+            raise not_found("Message")
+        return message
+
+    async def add_reaction(self, message, emoji):
+        await self.api("add_reaction")
+        # Webhook posts are only known to the cog by id.
+        message = message.channel.messages.get(str(message.id), message)
+        for reaction in message.reactions:
+            if reaction.emoji == emoji:
+                reaction.count += 1
+                return
+        message.reactions.append(Reaction(emoji))
+
+    async def clear_reactions(self, message):
+        await self.api("clear_reactions")
+        message.reactions = []
+
+    async def create_role(self, server, name=None, mentionable=False, **fields):
+        await self.api("create_role")
+        role = Role(name, mentionable)
+        server.roles.append(role)
+        return role
+
+    async def delete_role(self, server, role):
+        await self.api("delete_role")
+        if role in server.roles:
+            server.roles.remove(role)
+        for member in server.members:
+            if role in member.roles:
+                member.roles.remove(role)
+
+    async def add_roles(self, member, *roles):
+        await self.api("add_roles")
+        for role in roles:
+            if role not in member.roles:
+                member.roles.append(role)
+
+    async def remove_roles(self, member, *roles):
+        await self.api("remove_roles")
+        for role in roles:
+            if role in member.roles:
+                member.roles.remove(role)
+
+    async def request_offline_members(self, *servers):
+        return
+
+
+class WebhookServer:
+    """
+        Serves the webhook routes the cog calls on a local port, posting
+        into the stand-in Bot's channels; point gyms.DISCORD_API at `url`.
+        With `limit` set each webhook allows that many requests per
+        `window` seconds and answers 429 beyond it, like Discord does.
+    """
+
+    def __init__(self, bot, limit=None, window=2.0):
+        self.bot = bot
+        self.limit = limit
+        self.window = window
+        self.webhooks = {}
+        self.requests = collections.defaultdict(collections.deque)
+        self.url = None
+        self.server = None
+        self.handler = None
+
+    async def start(self):
+        app = web.Application(loop=self.bot.loop)
+        app.router.add_route("POST", "/channels/{channel_id}/webhooks", self.create)
+        app.router.add_route("POST", "/webhooks/{webhook_id}/{token}", self.execute)
+        app.router.add_route("PATCH", "/webhooks/{webhook_id}/{token}/messages/{message_id}", self.edit)
+        self.handler = app.make_handler()
+        self.server = await self.bot.loop.create_server(self.handler, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def create(self, request):
+        await self.bot.api("webhook.create")
+        channel = self.bot.get_channel(request.match_info["channel_id"])
+        if channel is None:
+            return web.json_response({"message": "Unknown Channel", "code": 10003}, status=404)
+        webhook_id = snowflake()
+        self.webhooks[webhook_id] = (uuid.uuid4().hex, channel)
+        return web.json_response({"id": webhook_id, "token": self.webhooks[webhook_id][0], "channel_id": channel.id})
+
+    def check(self, request):
+        # Returns (channel, None) or (None, error response).
+        webhook_id = request.match_info["webhook_id"]
+        token, channel = self.webhooks.get(webhook_id, (None, None))
+        if token is None or token != request.match_info["token"]:
+            return None, web.json_response({"message": "Unknown Webhook", "code": 10015}, status=404)
+        if self.limit is not None:
+            now = time.monotonic()
+            recent = self.requests[webhook_id]
+            while recent and recent[0] <= now - self.window:
+                recent.popleft()
+            if len(recent) >= self.limit:
+                retry = recent[0] + self.window - now
+                return None, web.json_response(
+                    {"message": "You are being rate limited."}, status=429, headers={"Retry-After": str(retry)})
+            recent.append(now)
+        return channel, None
+
+    async def execute(self, request):
+        await self.bot.api("webhook.execute")
+        channel, error = self.check(request)
+        if error is not None:
+            return error
+        data = await request.json()
+        author = User(request.match_info["webhook_id"], data.get("username") or "webhook")
+        embeds = data.get("embeds") or []
+        message = Message(channel, author, data.get("content"), discord.Embed.from_data(embeds[0]) if embeds else None)
+        channel.messages[message.id] = message
+        return web.json_response({"id": message.id, "channel_id": channel.id, "webhook_id": author.id})
+
+    async def edit(self, request):
+        await self.bot.api("webhook.edit")
+        channel, error = self.check(request)
+        if error is not None:
+            return error
+        message = channel.messages.get(request.match_info["message_id"])
+        if message is None or message.author.id != request.match_info["webhook_id"]:
+            return web.json_response({"message": "Unknown Message", "code": 10008}, status=404)
+        data = await request.json()
+        if data.get("embeds"):
+            message.embeds = [discord.Embed.from_data(data["embeds"][0])]
+        return web.json_response({"id": message.id, "channel_id": channel.id})
+
+
+class Hit:
+    """Looks like an elasticsearch_dsl search hit for a gym or pokemon."""
+
+    def __init__(self, id, **fields):
+        self.meta = {"id": id}
+        self.__dict__.update(fields)
+
+
+RE_WORD = re.compile(r"\w+")
+
+
+class MemorySearch:
+    """
+        Replaces the Elasticsearch gym and pokemon lookups with an in-memory
+        token index, ranked by shared words then distance to the channel.
+    """
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.gyms = {}
+        self.tokens = collections.defaultdict(set)
+        self.pokemon = {}
+
+    def install(self):
+        # Replaces the backend lookups, the caching and metrics wrappers
+        # around them still run.
+        self.cog._find_gym = self.find_gym
+        self.cog._find_pokemon = self.find_pokemon
+        self.cog.search_ready.set()
+        return self
+
+    def add_gym(self, id, title, latitude, longitude):
+        hit = Hit(id, title=title, location={"lat": latitude, "lon": longitude})
+        self.gyms[id] = hit
+        for word in RE_WORD.findall(title.lower()):
+            self.tokens[word].add(id)
+        return hit
+
+    def add_pokemon(self, id, name):
+        self.pokemon[name.lower()] = Hit(id, name=name)
+
+    async def find_gym(self, gym, channel=None):
+        words = RE_WORD.findall(gym.lower())
+        scores = collections.Counter()
+        for word in words:
+            for gym_id in self.tokens.get(word, ()):
+                scores[gym_id] += 1
+        if not scores:
+            return None
+        origin = None
+        if channel is not None:
+            location = self.cog.get_config(channel, "location", None)
+            if location:
+                origin = [float(x) for x in location.replace(" ", "").split(",")]
+        best = max(scores.values())
+
+        def distance(gym_id):
+            if origin is None:
+                return 0
+            hit = self.gyms[gym_id]
+            return math.hypot(hit.location["lat"] - origin[0], hit.location["lon"] - origin[1])
+
+        candidates = [gym_id for gym_id, score in scores.items() if score == best]
+        return self.gyms[min(candidates, key=distance)]
+
+    async def find_pokemon(self, pokemon):
+        return self.pokemon.get(pokemon.lower())
+
+
+async def invoke(callback, ctx, *args, **kwargs):
+    # Bot.say finds its destination by looking for these in the calling frames.
+    _internal_channel = ctx.message.channel
+    _internal_author = ctx.message.author
+    return await callback(ctx, *args, **kwargs)
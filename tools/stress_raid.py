@@ -0,0 +1,193 @@
+"""
+    Hammer one gym with concurrent raid reports.
+
+        python -m tools.stress_raid --processes 4 --reports 10
+
+    Every process (a shard over one shared SQLite database) fires
+    `--reports` reports of the same raid at the same gym from each of its
+    reporting channels at once, mixing eggs and hatched pokemon with
+    slightly different times, and every `--ingest-every`th through bulk
+    ingest instead of !raid. Shards don't share raids, so each shard
+    should end up with exactly one raid on the gym, and every channel it
+    reported from with exactly one embed, of that raid. Exits non-zero
+    otherwise.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import standins
+from .shards import server_ids
+
+GYM_TITLE = "Gym 0 Memorial"
+
+
+def prepare(database_url):
+    gyms = standins.load_offline()
+    engine = gyms.create_db_engine(database_url)
+    gyms.Base.metadata.create_all(engine)
+    session = gyms.sessionmaker(bind=engine)()
+    session.add(gyms.Gym(id=1, title=GYM_TITLE, latitude=51.0, longitude=1.0))
+    session.add(gyms.Pokemon(id=150, name="Mewtwo", raid_level=5))
+    session.commit()
+    session.close()
+
+
+def report_args(i):
+    # An egg hatching in 29-31 minutes, or the boss with 29-31 minutes
+    # left, all within the window start_raid treats as one raid.
+    minutes = str(29 + i % 3)
+    return (minutes, "5") if i % 2 else (minutes, "Mewtwo")
+
+
+def ingest_record(i):
+    # The same raid as report_args(i), as a scanner would send it.
+    minutes, pokemon = report_args(i)
+    end = datetime.datetime.utcnow() + datetime.timedelta(minutes=int(minutes))
+    if pokemon == "5":
+        return {"gym_id": 1, "end": (end + datetime.timedelta(minutes=45)).strftime("%Y-%m-%dT%H:%M:%S"), "level": 5}
+    return {"gym_id": 1, "end": end.strftime("%Y-%m-%dT%H:%M:%S"), "pokemon_id": 150}
+
+
+def is_ingest(i, args):
+    return args.ingest_every and i % args.ingest_every == args.ingest_every - 1
+
+
+def report(cog, bot, channel, member, i, args):
+    if is_ingest(i, args):
+        return cog.ingest_raids(channel.server, [ingest_record(i)])
+    minutes, pokemon = report_args(i)
+    return standins.invoke(cog.start_raid, bot.context(channel, member), minutes, pokemon, GYM_TITLE)
+
+
+def worker(process_id, process_count, directory, args, barrier, results):
+    gyms = standins.load_offline()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = standins.Bot(latency=args.latency_ms / 1000, loop=loop, shard_id=process_id, shard_count=process_count)
+    cog = gyms.Gyms(
+        bot,
+        database_url="sqlite:///" + os.path.join(directory, "gyms.db"),
+        snapshot_path=os.path.join(directory, "snapshot-{shard}.json.gz"))
+    loop.run_until_complete(cog.ready.wait())
+    search = standins.MemorySearch(cog).install()
+    search.add_gym(1, GYM_TITLE, 51.0, 1.0)
+    search.add_pokemon(150, "Mewtwo")
+
+    reports = []
+    channels = []
+    for index, server_id in server_ids(process_id, process_count, args.servers):
+        server = bot.add_server("server-{}".format(index), id=server_id)
+        member = server.add_member("trainer")
+        for i in range(args.channels):
+            # Ids derived from the server's, so they're unique across processes.
+            channel = standins.Channel(server, "raids-{}".format(i), id=str(int(server_id) + i + 1))
+            bot.channels[channel.id] = channel
+            if any(not is_ingest(n, args) for n in range(args.reports)):
+                channels.append(channel.id) # Ingest doesn't post to the channel, !raid does
+            reports += [(channel, member, n) for n in range(args.reports)]
+
+    barrier.wait()
+    start = time.perf_counter()
+    outcomes = loop.run_until_complete(asyncio.gather(*[
+        report(cog, bot, channel, member, n, args) for channel, member, n in reports
+    ], return_exceptions=True))
+    elapsed = time.perf_counter() - start
+    cog.store.apply()
+    errors = [repr(outcome) for outcome in outcomes if isinstance(outcome, Exception)]
+    cog._Gyms__unload()
+    cog.session.close()
+    results.put({
+        "process_id": process_id,
+        "reports": len(reports),
+        "elapsed": elapsed,
+        "errors": errors[:10],
+        "channels": channels,
+        "api_calls": sum(bot.calls.values()),
+    })
+
+
+def check(database_url, process_count, workers):
+    # Per shard: the raids on the gym of its servers, and its reporting
+    # channels that don't have exactly one embed of its raid.
+    gyms = standins.load_offline()
+    session = gyms.sessionmaker(bind=gyms.create_db_engine(database_url))()
+    raids = collections.defaultdict(list)
+    for raid in session.query(gyms.Raid).filter(gyms.Raid.gym_id == 1, gyms.Raid.done == False).order_by(gyms.Raid.id):
+        raids[(raid.server_id >> 22) % process_count].append(raid.id)
+    shards = []
+    for w in workers:
+        if not w["channels"]:
+            continue
+        own = raids[w["process_id"]]
+        embeds = collections.Counter()
+        if own:
+            embeds.update(str(embed.channel_id) for embed in session.query(gyms.Embed).filter_by(raid_id=own[0]))
+        shards.append({
+            "process_id": w["process_id"],
+            "raids": own,
+            "channels_without_one_embed": [channel_id for channel_id in w["channels"] if embeds[channel_id] != 1],
+        })
+    session.close()
+    return shards
+
+
+def run(process_count, args):
+    directory = tempfile.mkdtemp(prefix="gymsstress")
+    database_url = "sqlite:///" + os.path.join(directory, "gyms.db")
+    try:
+        prepare(database_url)
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(process_count)
+        results = context.Queue()
+        processes = [
+            context.Process(target=worker, args=(process_id, process_count, directory, args, barrier, results))
+            for process_id in range(process_count)
+        ]
+        for process in processes:
+            process.start()
+        workers = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+        shards = check(database_url, process_count, workers)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "processes": process_count,
+        "reports": sum(w["reports"] for w in workers),
+        "elapsed_s": round(max(w["elapsed"] for w in workers), 3),
+        "shards": shards,
+        "errors": [error for w in workers for error in w["errors"]],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--servers", type=int, default=4, help="Total servers, split between the processes")
+    parser.add_argument("--channels", type=int, default=2, help="Reporting channels per server")
+    parser.add_argument("--reports", type=int, default=10, help="Concurrent reports from each channel")
+    parser.add_argument("--ingest-every", type=int, default=4, help="Send every Nth report through bulk ingest, 0 = never")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Simulated Discord API round-trip")
+    args = parser.parse_args(argv)
+
+    reports = [run(process_count, args) for process_count in args.processes]
+    print(json.dumps(reports, indent=2))
+    failed = [report["processes"] for report in reports if report["errors"] or any(
+        len(shard["raids"]) != 1 or shard["channels_without_one_embed"] for shard in report["shards"])]
+    if failed:
+        print("Duplicate or missing raids, or reports not redirected, with processes:", failed, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())